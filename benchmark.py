@@ -0,0 +1,200 @@
+# Headless render benchmark
+# Renders a scripted camera path with Gamemap.render and reports the frame times
+#
+# Usage:
+#   python benchmark.py
+#   python benchmark.py --maps maps/test_map.dat --frames 600 --json bench.json
+#   python benchmark.py --path camera_path.json --fail-above 16.6
+#   python benchmark.py --floor-casting both
+#   python benchmark.py --resolutions 320x192 640x384 1280x768
+#
+# A camera path file is a json list of [x, y, angle] entries, x and y in map tiles and the angle in radians
+
+import os
+
+# Use the dummy drivers so no window (or audio device) is needed
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import sys
+import json
+import math
+import time
+import argparse
+import numpy as np
+import pygame
+from settings import *
+from game.world import World
+from game.entity import Entity
+from game.camera import Camera
+from game.gamemap import Gamemap
+import game.gamemap as gamemap_module
+import game.textures as textures
+import game.frame_timer as frame_timer
+import game.jit_cache as jit_cache
+
+# Frames rendered before measuring (the kernels are already loaded by Gamemap.numba_load)
+DEFAULT_WARMUP = 5
+DEFAULT_FRAMES = 300
+
+
+# Build the default camera path, a full turn in place at the player spawn
+def make_spin_path(spawn, frames):
+    x, y = spawn
+    return [(x, y, math.pi * 2 * i / frames) for i in range(frames)]
+
+
+# Parse a resolution like 640x384
+def parse_resolution(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+# Load a camera path from a json file
+def load_path(filepath):
+    with open(filepath, 'r') as f:
+        return [(float(x), float(y), float(angle)) for (x, y, angle) in json.load(f)]
+
+
+# Load a level and create the entities that have a sprite
+# Enemies are created as plain entities, so there's no AI or sound running while benchmarking
+def load_map(gamemap, filepath):
+    World.clear()
+
+    spawn = None
+    objects = gamemap.load_level(filepath)
+    gamemap.load_pvs()
+    for (id, x, y) in objects:
+        # Center the objects in their tiles
+        pos_x = (x + 0.5) * gamemap.tilesize
+        pos_y = (y + 0.5) * gamemap.tilesize
+
+        match id:
+            case "player":
+                spawn = (x + 0.5, y + 0.5)
+            case "red_ogre":
+                ent = Entity((pos_x, pos_y))
+                ent.sprite = 0
+
+    # Without a player start in the middle of the map
+    if spawn is None:
+        spawn = (gamemap.width / 2, gamemap.height / 2)
+
+    return spawn
+
+
+# Render every frame of the path and return the frame times in seconds, and the overdraw of every frame
+def run_path(gamemap, surface, path, warmup):
+    times = np.zeros([len(path)])
+    overdraw = np.zeros([len(path)])
+
+    for i in range(-warmup, len(path)):
+        x, y, angle = path[i % len(path)]
+        Camera.look_at(angle)
+
+        # Only keep the stage timings of the measured frames
+        if i == 0:
+            frame_timer.reset()
+
+        frame_timer.begin_frame()
+        start = time.perf_counter()
+        gamemap.render(surface, (x * gamemap.tilesize, y * gamemap.tilesize))
+        end = time.perf_counter()
+        frame_timer.end_frame()
+
+        if i >= 0:
+            times[i] = end - start
+            overdraw[i] = gamemap.get_overdraw()
+
+    return times, overdraw
+
+
+def summarize(times, overdraw):
+    times_ms = times * 1000
+    median = float(np.median(times_ms))
+    return {
+        "frames": len(times_ms),
+        "min_ms": float(np.min(times_ms)),
+        "median_ms": median,
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "fps": 0 if median == 0 else 1000 / median,
+        "overdraw": float(np.median(overdraw)),
+        "stages_median_ms": frame_timer.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless render benchmark")
+    parser.add_argument("--maps", nargs="+", default=["maps/test_map.dat"], help="Map files to benchmark")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="Frames rendered for the default path")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="Frames rendered before measuring")
+    parser.add_argument("--path", default=None, help="Json camera path file (used instead of the default path)")
+    parser.add_argument("--json", default=None, help="Write the results to this json file")
+    parser.add_argument("--resolutions", nargs="+", type=parse_resolution, default=[(WIDTH, HEIGHT)], help="Internal resolutions to render at (WIDTHxHEIGHT)")
+    parser.add_argument("--floor-casting", choices=["vertical", "horizontal", "both"], default=None, help="Floor casting mode (both runs every map once per mode)")
+    parser.add_argument("--fail-above", type=float, default=None, help="Exit with an error if a median frame time (ms) is above this value")
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    textures.generate_textures()
+    Camera.init()
+
+    gamemap = Gamemap()
+    World.add_gamemap(gamemap)
+
+    # Load the kernels from the numba cache (or compile them) before timing anything
+    jit_cache.print_report(gamemap.numba_load(pygame.surface.Surface((WIDTH, HEIGHT), 0, 32)))
+
+    if args.floor_casting is None:
+        floor_modes = [gamemap_module.FLOOR_CASTING]
+    elif args.floor_casting == "both":
+        floor_modes = ["vertical", "horizontal"]
+    else:
+        floor_modes = [args.floor_casting]
+
+    results = []
+    for filepath in args.maps:
+        spawn = load_map(gamemap, filepath)
+        path = load_path(args.path) if args.path else make_spin_path(spawn, args.frames)
+
+        for resolution in args.resolutions:
+            # The renderer follows the size of the surface
+            surface = pygame.surface.Surface(resolution, 0, 32)
+
+            for floor_mode in floor_modes:
+                gamemap_module.FLOOR_CASTING = floor_mode
+
+                result = summarize(*run_path(gamemap, surface, path, args.warmup))
+                result["map"] = filepath
+                result["resolution"] = f"{resolution[0]}x{resolution[1]}"
+                result["floor_casting"] = floor_mode
+                results.append(result)
+
+    # Report
+    print()
+    print(f"{'MAP':<24} {'RESOLUTION':>10} {'FLOORS':>10} {'FRAMES':>7} {'MIN ms':>8} {'MEDIAN ms':>10} {'P99 ms':>8} {'FPS':>7} {'OVERDRAW':>9}")
+    for r in results:
+        print(f"{r['map']:<24} {r['resolution']:>10} {r['floor_casting']:>10} {r['frames']:>7} {r['min_ms']:>8.2f} {r['median_ms']:>10.2f} {r['p99_ms']:>8.2f} {r['fps']:>7.1f} {r['overdraw']:>9.3f}")
+
+        # Only the render stages are timed here
+        stages = ", ".join(f"{stage} {ms:.2f}" for stage, ms in r["stages_median_ms"].items() if ms > 0)
+        print(f"    median ms per stage: {stages}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    pygame.quit()
+
+    # Used by CI to catch renderer regressions
+    if args.fail_above is not None:
+        for r in results:
+            if r["median_ms"] > args.fail_above:
+                print(f"ERROR: {r['map']} ({r['resolution']}, {r['floor_casting']} floors) median frame time {r['median_ms']:.2f}ms is above {args.fail_above}ms")
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
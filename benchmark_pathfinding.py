@@ -0,0 +1,160 @@
+# Headless pathfinding benchmark
+# Runs the same random searches with the legacy python A* and the numba A* (see game/pathfinding.py) on generated
+# maps of several sizes (and on map files) and reports the search times
+#
+# Usage:
+#   python benchmark_pathfinding.py
+#   python benchmark_pathfinding.py --sizes 64 256 1024 --queries 500
+#   python benchmark_pathfinding.py --maps maps/test_map.dat --json pathfinding.json
+#
+# The legacy A* gets slow quickly on big maps, it only runs --legacy-queries searches on maps up to --legacy-max-size
+
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+from collections import namedtuple
+from game.world import World
+import game.pathfinding as pathfinding
+import game.hpa as hpa
+from game.pathfinding import PathFinder
+
+DEFAULT_SIZES = [32, 64, 128, 256, 512]
+DEFAULT_QUERIES = 200
+DEFAULT_LEGACY_QUERIES = 20
+DEFAULT_LEGACY_MAX_SIZE = 128
+
+# Part of the tiles that are walls on the generated maps
+WALL_DENSITY = 0.25
+
+# What the legacy PathFinder needs from the gamemap
+BenchmarkMap = namedtuple("BenchmarkMap", ["mapW", "width", "height"])
+
+# name, engine, allow_diagonals, jump_points, path cache
+# With the path cache the searches are run once before timing, so the timed ones are all cache hits
+ENGINES = [
+    ("legacy",          "legacy", False, False, False),
+    ("numba",           "numba",  False, False, False),
+    ("numba 8-dir",     "numba",  True,  False, False),
+    ("numba 8-dir jps", "numba",  True,  True,  False),
+    ("numba cached",    "numba",  False, False, True),
+    ("hierarchical",    "hierarchical", False, False, False),
+]
+
+
+# Random walls with a border, the same seed always gives the same map
+def make_map(size, seed):
+    rng = np.random.default_rng(seed)
+    mapW = (rng.random((size, size)) < WALL_DENSITY).astype(np.uint8)
+    mapW[0, :] = mapW[-1, :] = mapW[:, 0] = mapW[:, -1] = 1
+    return mapW
+
+
+def load_map(filepath):
+    with open(filepath, 'rb') as f:
+        width, height, mapF, mapW, mapC, objects = pickle.load(f)
+    return np.array(mapW, dtype=np.uint8)
+
+
+# Random start and end pairs of open tiles
+def make_queries(mapW, count, seed):
+    rng = np.random.default_rng(seed)
+    open_tiles = np.argwhere(mapW == 0)[:, ::-1] # x, y
+    starts = open_tiles[rng.integers(len(open_tiles), size=count)]
+    ends = open_tiles[rng.integers(len(open_tiles), size=count)]
+    return [(tuple(start), tuple(end)) for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def run_engine(mapW, queries, engine, allow_diagonals, jump_points, cache):
+    World.gamemap = BenchmarkMap(mapW, mapW.shape[1], mapW.shape[0])
+    pathfinding.ENGINE = engine
+    pathfinding.HIERARCHICAL_MIN_SIZE = -1 # Only the "hierarchical" engine uses it, so the numba rows are always the flat A*
+    pathfinding.JUMP_POINT_SEARCH = jump_points
+    pathfinding.PATH_CACHE = cache
+    pathfinding.clear_path_cache()
+    finder = PathFinder()
+
+    # The hierarchical graph is built before timing, like when a level is loaded
+    if engine == "hierarchical":
+        hpa.get_graph(mapW, parallel=True)
+
+    if cache:
+        for start, end in queries:
+            finder.search_path(end, start_pos=start, allow_diagonals=allow_diagonals)
+
+    times = np.zeros((len(queries)))
+    costs = []
+    expansions = 0
+    for i, (start, end) in enumerate(queries):
+        t = time.perf_counter()
+        path = finder.search_path(end, start_pos=start, allow_diagonals=allow_diagonals)
+        times[i] = time.perf_counter() - t
+
+        if len(path) > 0:
+            costs.append(pathfinding.get_path_cost(path))
+        expansions += pathfinding.last_expansions
+
+    times_ms = times * 1000
+    return {
+        "queries": len(queries),
+        "found": len(costs),
+        "median_ms": float(np.median(times_ms)),
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "total_ms": float(np.sum(times_ms)),
+        "mean_cost": float(np.mean(costs)) if costs else 0.0,
+        "mean_expansions": expansions / len(queries) if engine == "numba" and not cache else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless pathfinding benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Sizes of the generated maps (in tiles)")
+    parser.add_argument("--maps", nargs="+", default=[], help="Map files to benchmark too")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES, help="Searches per map")
+    parser.add_argument("--legacy-queries", type=int, default=DEFAULT_LEGACY_QUERIES, help="Searches per map for the legacy A*")
+    parser.add_argument("--legacy-max-size", type=int, default=DEFAULT_LEGACY_MAX_SIZE, help="Biggest map the legacy A* runs on")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated maps and the searches")
+    parser.add_argument("--json", default=None, help="Write the results to this json file")
+    args = parser.parse_args()
+
+    maps = [(f"generated {size}x{size}", make_map(size, args.seed + size)) for size in args.sizes]
+    maps += [(filepath, load_map(filepath)) for filepath in args.maps]
+
+    # Compile (or load from the numba cache) the kernels before timing anything
+    warmup_map = np.zeros((40, 40), dtype=np.uint8)
+    for _, engine, allow_diagonals, jump_points, _ in ENGINES:
+        if engine == "numba":
+            pathfinding.find_path(warmup_map, (1, 1), (38, 38), allow_diagonals, jump_points)
+        elif engine == "hierarchical":
+            hpa.find_path(warmup_map, (1, 1), (38, 38))
+
+    results = []
+    for name, mapW in maps:
+        queries = make_queries(mapW, args.queries, args.seed)
+
+        for engine_name, engine, allow_diagonals, jump_points, cache in ENGINES:
+            engine_queries = queries
+            if engine == "legacy":
+                if max(mapW.shape) > args.legacy_max_size:
+                    continue
+                engine_queries = queries[:args.legacy_queries]
+
+            result = run_engine(mapW, engine_queries, engine, allow_diagonals, jump_points, cache)
+            result["map"] = name
+            result["engine"] = engine_name
+            results.append(result)
+
+    # Report
+    print(f"{'MAP':<24} {'ENGINE':<16} {'QUERIES':>7} {'FOUND':>6} {'MEDIAN ms':>10} {'P99 ms':>8} {'COST':>8} {'EXPANDED':>9}")
+    for r in results:
+        expanded = "-" if r["mean_expansions"] is None else f"{r['mean_expansions']:.0f}"
+        print(f"{r['map']:<24} {r['engine']:<16} {r['queries']:>7} {r['found']:>6} {r['median_ms']:>10.3f} {r['p99_ms']:>8.3f} {r['mean_cost']:>8.1f} {expanded:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
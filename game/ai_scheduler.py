@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+
+# AI scheduler
+# Expensive AI work (path searches) is queued instead of done on the spot, and run spends at most BUDGET_MS per frame
+# on it, what doesn't fit waits for the next frame. So when many enemies want a new path on the same tick the cost is
+# spread over a few frames instead of making that one hitch
+# Enemies also think less often when they are far from the player or the player can't see them (see get_update_interval)
+#
+# Usage:
+#   ai_scheduler.request(enemy, enemy.find_path) # Runs later, a new request with the same key replaces the old one
+#   ai_scheduler.run()                           # Once per frame, after the simulation ticks
+#   ai_scheduler.get_stats()
+
+# Time spent on queued jobs per frame (in milliseconds)
+# At least one job runs every frame, so a job slower than the budget can't block the queue forever
+BUDGET_MS = 1.0
+
+# Update level of detail: (distance to the player in world units, ticks between updates when seen, when not seen)
+# An enemy the player can't see doesn't need smooth movement, one far away doesn't need quick reactions
+UPDATE_LOD = [
+    (256,  1, 1),
+    (768,  1, 2),
+    (1536, 2, 4),
+]
+FAR_UPDATE_INTERVAL = 8 # Beyond the last distance
+
+# Jobs waiting to run, by key, in the order they were first requested
+queue = OrderedDict()
+
+# Stats of the last frame (see get_stats)
+jobs_run = 0
+jobs_deferred = 0   # Left in the queue when the budget ran out
+updates_run = 0
+updates_skipped = 0 # Updates an enemy skipped because of its update interval
+time_spent = 0.0    # In seconds
+
+# Updates counted in the frame being simulated, they become the stats of the last frame in run
+frame_updates_run = 0
+frame_updates_skipped = 0
+
+# Totals since the start
+total_jobs_run = 0
+total_jobs_replaced = 0 # Requests that replaced one that was still queued (that work was never done)
+max_queue_depth = 0
+
+
+# Queue a job, if there's already one with that key it's replaced (it keeps its place in the queue)
+def request(key, job):
+    global total_jobs_replaced, max_queue_depth
+
+    if key in queue:
+        total_jobs_replaced += 1
+    queue[key] = job
+    max_queue_depth = max(max_queue_depth, len(queue))
+
+# Forget the queued job of a key (the entity was removed, or doesn't need it anymore)
+def cancel(key):
+    queue.pop(key, None)
+
+def is_queued(key):
+    return key in queue
+
+# Remove every job, Gamemap.load_level calls it
+def clear():
+    queue.clear()
+
+# Run queued jobs until the budget of this frame is spent
+def run(budget_ms=None):
+    global jobs_run, jobs_deferred, time_spent, total_jobs_run, updates_run, updates_skipped
+
+    budget = (BUDGET_MS if budget_ms is None else budget_ms) / 1000
+    start = time.perf_counter()
+
+    count = 0
+    while len(queue) > 0:
+        if count > 0 and time.perf_counter() - start >= budget:
+            break
+
+        _, job = queue.popitem(last=False)
+        job()
+        count += 1
+
+    time_spent = time.perf_counter() - start
+    jobs_run = count
+    jobs_deferred = len(queue)
+    total_jobs_run += count
+
+    updates_run, updates_skipped = frame_updates_run, frame_updates_skipped
+    reset_frame_updates()
+
+def reset_frame_updates():
+    global frame_updates_run, frame_updates_skipped
+    frame_updates_run = 0
+    frame_updates_skipped = 0
+
+# Ticks between updates of an enemy at that distance from the player
+def get_update_interval(distance, seen):
+    for max_distance, seen_interval, unseen_interval in UPDATE_LOD:
+        if distance < max_distance:
+            return seen_interval if seen else unseen_interval
+    return FAR_UPDATE_INTERVAL
+
+# Count an enemy update that ran or was skipped (for the stats)
+def count_update(skipped):
+    global frame_updates_run, frame_updates_skipped
+    if skipped:
+        frame_updates_skipped += 1
+    else:
+        frame_updates_run += 1
+
+def get_stats():
+    return {
+        "queue_depth": len(queue),
+        "jobs_run": jobs_run,
+        "jobs_deferred": jobs_deferred,
+        "time_ms": time_spent * 1000,
+        "updates_run": updates_run,
+        "updates_skipped": updates_skipped,
+        "total_jobs_run": total_jobs_run,
+        "total_jobs_replaced": total_jobs_replaced,
+        "max_queue_depth": max_queue_depth,
+    }
@@ -0,0 +1,83 @@
+import math
+from numba import njit
+
+# Circle vs wall map collision
+# Every entity is a circle (World.radii) moved by its motion in one kernel call
+# It's serial, it runs every tick while the render thread is running its parallel kernels (see render_pipeline)
+# The motion is split in steps no longer than half the radius, so a fast entity can't go through a wall or a corner,
+# and after each step the circle is pushed out of every wall tile it overlaps, from the closest point of the tile
+# That also handles the corners, and pushing only along that direction makes it slide along the walls
+# Tiles outside of the map are open, like Gamemap.get_tile_at
+#
+# Usage:
+#   collision.move_circles(mapW, tilesize, positions, motions, radii) # positions are moved in place
+
+
+# Push a circle (in tiles) out of the wall tiles it overlaps, returns the new center
+@njit(cache=True)
+def push_out(mapW, x, y, r):
+    height, width = mapW.shape
+
+    for ty in range(int(math.floor(y - r)), int(math.floor(y + r)) + 1):
+        for tx in range(int(math.floor(x - r)), int(math.floor(x + r)) + 1):
+            if not (tx >= 0 and tx < width and ty >= 0 and ty < height) or mapW[ty][tx] == 0:
+                continue
+
+            # Closest point of the tile to the center
+            dx = x - min(max(x, tx), tx + 1)
+            dy = y - min(max(y, ty), ty + 1)
+            dist_sq = dx * dx + dy * dy
+            if dist_sq >= r * r:
+                continue
+
+            if dist_sq > 0:
+                dist = math.sqrt(dist_sq)
+                x += dx / dist * (r - dist)
+                y += dy / dist * (r - dist)
+            else:
+                # The center is inside of the tile, out through the closest side
+                left, right = x - tx + r, tx + 1 - x + r
+                top, bottom = y - ty + r, ty + 1 - y + r
+                shortest = min(left, right, top, bottom)
+                if shortest == left:
+                    x -= left
+                elif shortest == right:
+                    x += right
+                elif shortest == top:
+                    y -= top
+                else:
+                    y += bottom
+    return x, y
+
+# Move every circle by its motion (world units) and resolve the walls, the positions are written in place
+# Rows with no motion aren't touched
+@njit(nogil=True, cache=True)
+def move_circles(mapW, tilesize, positions, motions, radii):
+    for i in range(len(positions)):
+        mx, my = motions[i][0] / tilesize, motions[i][1] / tilesize
+        if mx == 0 and my == 0:
+            continue
+
+        x, y = positions[i][0] / tilesize, positions[i][1] / tilesize
+        r = radii[i] / tilesize
+
+        # Entities without a collider just move
+        if r <= 0:
+            positions[i][0] += motions[i][0]
+            positions[i][1] += motions[i][1]
+            continue
+
+        # Swept: steps of half the radius at most
+        steps = max(1, int(math.ceil(math.sqrt(mx * mx + my * my) / (r * 0.5))))
+        step_x, step_y = mx / steps, my / steps
+
+        for _ in range(steps):
+            x += step_x
+            y += step_y
+
+            # Getting out of one tile can push into the one next to it, a second pass settles it
+            x, y = push_out(mapW, x, y, r)
+            x, y = push_out(mapW, x, y, r)
+
+        positions[i][0] = x * tilesize
+        positions[i][1] = y * tilesize
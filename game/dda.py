@@ -0,0 +1,68 @@
+import math
+from numba import njit
+
+# DDA ray walk over the tile grid
+# A ray from (rx, ry) in the direction (rdir_x, rdir_y) (in tiles) goes through the tiles it touches one by one, crossing
+# one x or y side of the grid at a time. Every ray that walks the wall map uses it (the wall rays of the renderer and
+# the sight lines), each one decides what to do with the tiles (stop at walls, leave the map...)
+#
+# Usage (inside of a kernel):
+#   ray = dda.start(rx, ry, rdir_x, rdir_y)
+#   while True:
+#       ray, side, distance = dda.step(ray)
+#       mx, my = ray[0], ray[1] # The tile it went into
+#
+# The state of a ray is (mx, my, step_x, step_y, side_dist_x, side_dist_y, delta_dist_x, delta_dist_y)
+# The side dists are how far along the ray the next x and y sides are, in lengths of (rdir_x, rdir_y)
+#
+# The kernels that call it keep their disk cache when only this file changes (numba only checks the file of the kernel),
+# delete the __pycache__ folders after changing it
+
+
+# Start a ray at (rx, ry), in the tile that point is in
+@njit(cache=True)
+def start(rx, ry, rdir_x, rdir_y):
+    mx = int(math.floor(rx))
+    my = int(math.floor(ry))
+
+    # Distance between two x (or y) sides (if the direction is straight then it's essentially infinite to that perpendicular direction)
+    delta_dist_x = 1e30 if (rdir_x == 0) else abs(1 / rdir_x)
+    delta_dist_y = 1e30 if (rdir_y == 0) else abs(1 / rdir_y)
+
+    # If the ray is going to the left, the step in the tile map is of -1, or else 1, same thing for up and down direction
+    # The distance to the first side is the ray position in float minus the fixed map grid position,
+    # multiplied by the delta distance
+    if (rdir_x < 0):
+        step_x = -1
+        side_dist_x = (rx - mx) * delta_dist_x
+    else:
+        step_x = 1
+        side_dist_x = (mx + 1.0 - rx) * delta_dist_x
+
+    if (rdir_y < 0):
+        step_y = -1
+        side_dist_y = (ry - my) * delta_dist_y
+    else:
+        step_y = 1
+        side_dist_y = (my + 1.0 - ry) * delta_dist_y
+
+    return (mx, my, step_x, step_y, side_dist_x, side_dist_y, delta_dist_x, delta_dist_y)
+
+# Go into the next tile, returns the new state, the side it crossed (0 an x side, 1 a y side) and how far along the ray
+# that side is (it's the perpendicular distance to a wall in that tile, no fish eye)
+@njit(cache=True)
+def step(ray):
+    mx, my, step_x, step_y, side_dist_x, side_dist_y, delta_dist_x, delta_dist_y = ray
+
+    if (side_dist_x < side_dist_y):
+        distance = side_dist_x
+        side_dist_x += delta_dist_x
+        mx += step_x
+        side = 0
+    else:
+        distance = side_dist_y
+        side_dist_y += delta_dist_y
+        my += step_y
+        side = 1
+
+    return (mx, my, step_x, step_y, side_dist_x, side_dist_y, delta_dist_x, delta_dist_y), side, distance
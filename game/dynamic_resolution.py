@@ -0,0 +1,65 @@
+from settings import *
+
+# Dynamic resolution
+# Scales the internal resolution (the game surface) down when rendering takes longer than the target frame time
+# And back up when there's time to spare, so busy scenes lose resolution instead of frame rate
+# The output is still scaled to the window, only the rendered frame gets smaller
+#
+# Usage:
+#   dynamic_resolution.update(render_time)
+#   size = dynamic_resolution.get_resolution()
+
+ENABLED = True
+
+# Render time to hold (in seconds), frame time minus everything that isn't rendering
+TARGET_FRAME_TIME = 1 / 60
+
+# Scale of WIDTH and HEIGHT
+MIN_SCALE = 0.5
+MAX_SCALE = 1.0
+SCALE_STEP = 0.05
+
+# Frames averaged before deciding, and how much of the target needs to be free to scale up again
+# Scaling up waits for more headroom than scaling down, so it doesn't go up and down every few frames
+SAMPLE_FRAMES = 20
+SCALE_UP_BELOW = 0.75
+
+# The width is a multiple of this (and the height keeps the aspect ratio)
+WIDTH_ALIGNMENT = 8
+
+scale = MAX_SCALE
+
+# Render times since the last change
+samples = []
+
+
+# Add the render time of a frame and change the scale if needed
+def update(render_time):
+    global scale
+
+    if not ENABLED:
+        return
+
+    samples.append(render_time)
+    if len(samples) < SAMPLE_FRAMES:
+        return
+
+    average = sum(samples) / len(samples)
+    samples.clear()
+
+    if average > TARGET_FRAME_TIME:
+        scale = max(scale - SCALE_STEP, MIN_SCALE)
+    elif average < TARGET_FRAME_TIME * SCALE_UP_BELOW:
+        scale = min(scale + SCALE_STEP, MAX_SCALE)
+
+# Set the scale directly (and forget the samples)
+def set_scale(value):
+    global scale
+    scale = min(max(value, MIN_SCALE), MAX_SCALE)
+    samples.clear()
+
+# Internal resolution for the current scale
+def get_resolution():
+    width = max(int(WIDTH * scale) // WIDTH_ALIGNMENT * WIDTH_ALIGNMENT, WIDTH_ALIGNMENT)
+    height = max(round(width * HEIGHT / WIDTH), 1)
+    return width, height
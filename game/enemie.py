@@ -1,6 +1,8 @@
 from pygame import Vector2
 from game.entity import *
 from game.pathfinding import PathFinder
+import game.flowfield as flowfield
+import game.ai_scheduler as ai_scheduler
 
 # Enemy state
 PATROLLING_STATE  = 0 # Patrolling a defined path
@@ -10,9 +12,12 @@ SEARCHING_STATE   = 3 # Investigating last place it know the player was
 
 class Enemie(Entity):
 
+    __slots__ = ("pathfinder", "sound2d", "pathfinding_timer_start", "pathfinding_timer", "path", "patrolling_path",
+                 "current_ai_state", "seen_by_player", "following_field", "skipped_ticks", "skipped_dt")
+
     def __init__(self, pos, angle=0) -> None:
         super().__init__(pos, angle)
-        self.sprite = textures.sprites[0]
+        self.sprite = 0 # Red ogre
         self.speed = 75
 
         self.pathfinder = PathFinder(linked_entity=self) 
@@ -27,11 +32,21 @@ class Enemie(Entity):
         #self.t = 0
         self.path = []
 
+        # Is it stepping down the flow field to the player? (the path is only the next tile then)
+        self.following_field = False
+
+        # Ticks (and time) since the last update, far away or unseen enemies don't update every tick (see ai_scheduler)
+        self.skipped_ticks = 0
+        self.skipped_dt = 0.0
+
         # Enemy state
         self.patrolling_path = []
 
         self.current_ai_state  = PATROLLING_STATE
 
+        # Is it on the player screen with no wall in the way? (see Gamemap.is_visible and World.update_sight)
+        self.seen_by_player = False
+
     def follow_path(self, dt):
         if len(self.path) == 0:
             return
@@ -42,49 +57,105 @@ class Enemie(Entity):
         target_pos = self.path[0]
 
         # Get angle to the target
-        self.angle = math.atan2(target_pos[1] - self.pos[1], target_pos[0] - self.pos[0])
+        x, y = self.pos.tolist()
+        self.angle = math.atan2(target_pos[1] - y, target_pos[0] - x)
 
-        motion[0] = math.cos(self.angle) * self.speed
-        motion[1] = math.sin(self.angle) * self.speed
+        # The last step stops on the target instead of going past it (and coming back forever)
+        step = min(self.speed * dt, math.sqrt((target_pos[0] - x)**2 + (target_pos[1] - y)**2))
+        motion[0] = math.cos(self.angle) * step
+        motion[1] = math.sin(self.angle) * step
 
-        self.move_and_collide(motion * dt)
+        # Applied at the end of the tick with the other enemies (see World.apply_motions)
+        self.move(motion)
 
-        # If we arrived at the position we remove it
-        if math.isclose(self.pos[0], target_pos[0], rel_tol=0.001) and math.isclose(self.pos[1], target_pos[1], rel_tol=0.001):
+    # If we arrived at the next position of the path we remove it
+    def pop_reached_point(self):
+        if len(self.path) == 0:
+            return
+
+        target_pos = self.path[0]
+        x, y = self.pos.tolist()
+        if math.isclose(x, target_pos[0], rel_tol=0.001) and math.isclose(y, target_pos[1], rel_tol=0.001):
             self.path.pop(0)
 
 
+    # Search a path to the player, it's queued in the AI scheduler so it can run a few frames later
+    def find_path(self):
+        # The flow field took over while it was waiting
+        if self.following_field:
+            return
+
+        gamemap = World.gamemap
+        path = self.pathfinder.search_path(end_pos=World.player.get_map_pos(), allow_diagonals=False)
+
+        # We offset the positions by a value of 0.5, so they are all centered in the tiles, we also multiply by the tilesize
+        self.path = [[(pos[0] + 0.5) * gamemap.tilesize, (pos[1] + 0.5) * gamemap.tilesize] for pos in path]
+
     def update(self, dt):
         motion = pygame.Vector2()
 
         player = World.player
         gamemap = World.gamemap
 
+        # Far away or unseen enemies update less often, the ticks they skipped are simulated in one go
+        player_x, player_y = player.pos.tolist()
+        ent_x, ent_y = self.pos.tolist()
+        dist = math.sqrt((player_x - ent_x)**2 + (player_y - ent_y)**2)
+
+        self.skipped_ticks += 1
+        self.skipped_dt += dt
+        if self.skipped_ticks < ai_scheduler.get_update_interval(dist, self.seen_by_player):
+            ai_scheduler.count_update(skipped=True)
+            return
+
+        dt = self.skipped_dt
+        self.skipped_ticks = 0
+        self.skipped_dt = 0.0
+        ai_scheduler.count_update(skipped=False)
+
+        # The move of the last update was only applied at the end of that tick
+        self.pop_reached_point()
+
+        # Close to the player, step down the shared flow field one tile at a time
+        flowfield.update(gamemap.mapW, player.get_map_pos())
+        tile = self.get_map_pos()
+        if flowfield.get_distance(tile) != -1:
+            if not self.following_field:
+                # Get to the middle of the tile first, like the A* paths do
+                self.path = [[(tile[0] + 0.5) * gamemap.tilesize, (tile[1] + 0.5) * gamemap.tilesize]]
+                self.following_field = True
+                ai_scheduler.cancel(self)
+
+            if len(self.path) == 0:
+                next_tile = flowfield.get_next_tile(tile)
+                if next_tile is not None:
+                    self.path = [[(next_tile[0] + 0.5) * gamemap.tilesize, (next_tile[1] + 0.5) * gamemap.tilesize]]
+
         # Perform path finding
-        if self.pathfinding_timer <= 0:
-            path = self.pathfinder.search_path(end_pos=player.get_map_pos(), allow_diagonals=False)
+        elif self.following_field or self.pathfinding_timer <= 0:
+            self.following_field = False
 
-            # We offset the positions by a value of 0.5, so they are all centered in the tiles, we also multiply by the tilesize
-            self.path = [[(pos[0] + 0.5) * gamemap.tilesize, (pos[1] + 0.5) * gamemap.tilesize] for pos in path]
+            ai_scheduler.request(self, self.find_path)
             self.pathfinding_timer = self.pathfinding_timer_start
         else:
             self.pathfinding_timer -= dt#1 * dt when dt gets too big things explode
 
         
 
-        # Get player direction
-        player_x, player_y = player.pos
-        ent_x, ent_y = self.pos
-
         #if enemy is looking forward and player in the 90 front of enemy do this
         # !!! 
         # !!!
         # !!!
-        collisions, ray_hit = self.cast_ray((player_x, player_y), only=player)
-        self.ray_hit = ray_hit
+        # The player can only see us if our tile was drawn in the last frame and no wall is in the way
+        # The PVS rules out enemies in other rooms first
+        # The sight line to the player was cast for every entity at once at the start of the tick (see World.update_sight)
+        self.seen_by_player = (gamemap.can_see(player.pos, self.pos) and gamemap.is_visible(self.pos)
+                               and not World.sight_blocked[self.index])
+        if self.seen_by_player:
+            self.ray_hit = tuple(World.sight_ends[self.index].tolist())
+        else:
+            self.ray_hit = None
 
-        # Dist to the player
-        dist = math.sqrt((player_x - ent_x)**2 + (player_y - ent_y)**2)
         # If it's too close stop following
         if (dist > self.collider_radius) and dist < 200:
             self.angle = math.atan2(player_y - ent_y, player_x - ent_x)
@@ -92,7 +163,7 @@ class Enemie(Entity):
             motion[0] = math.cos(self.angle) * self.speed
             motion[1] = math.sin(self.angle) * self.speed
 
-            self.move_and_collide(motion * dt)
+            self.move(motion * dt)
         else:
             # Follow path if there is one
             motion = self.follow_path(dt)
\ No newline at end of file
@@ -5,6 +5,9 @@ from game.world import World
 from settings import *
 import game.textures as textures
 import game.sound as sound
+import game.line_of_sight as line_of_sight
+import game.collision as collision
+import numpy as np
 
 
 def circle_circle(circle, circle2):
@@ -62,25 +65,77 @@ def sign(x):
     return -1
 
 
+# The position, angle, collider radius and sprite of an entity live in the World arrays (row self.index)
+# So the renderer, collision and sound can read every entity at once, the properties below read and write its row
+# pos and prev_pos are numpy views of the row, copy them to keep a position around
+# Subclasses need __slots__ too, any attribute has to be declared
 class Entity:
 
+    __slots__ = ("index", "cell", "speed", "ray_hit")
+
     def __init__(self, pos=pygame.Vector2(), angle=0) -> None:
-        self.pos = pygame.Vector2(pos)
-        self.sprite = 0 # Sprite index
+        # Add itself to the world
+        World.add_entity(self)
+
+        self.collider_radius = 16#8 # Every can have a circle type collider
+        self.pos = pos
+        self.prev_pos = pos # Position at the previous simulation tick (used to interpolate)
+        self.sprite = -1 # Sprite index (-1 means no sprite)
         self.angle = angle
         self.speed = 100
-        self.texture = None
-        self.collider_radius = 16#8 # Every can have a circle type collider
 
         print("RAY HIT DELETAR VARIAVEL SO DEBUG")
         self.ray_hit = None
 
-        # Add itself to the world
-        World.add_entity(self)
+    @property
+    def pos(self):
+        return World.positions[self.index]
+
+    # Setting the position moves the entity in the spatial hash too
+    @pos.setter
+    def pos(self, value):
+        World.positions[self.index] = value
+        World.update_cell(self)
+
+    @property
+    def prev_pos(self):
+        return World.prev_positions[self.index]
+
+    @prev_pos.setter
+    def prev_pos(self, value):
+        World.prev_positions[self.index] = value
+
+    @property
+    def angle(self):
+        return World.angles[self.index]
+
+    @angle.setter
+    def angle(self, value):
+        World.angles[self.index] = value
+
+    @property
+    def collider_radius(self):
+        return World.radii[self.index]
+
+    @collider_radius.setter
+    def collider_radius(self, value):
+        World.radii[self.index] = value
+
+    @property
+    def sprite(self):
+        return World.entity_sprites[self.index]
+
+    @sprite.setter
+    def sprite(self, value):
+        World.entity_sprites[self.index] = value
 
     def define_path(self, points, time_seconds, circular):
         pass
 
+    # Position between the previous tick (alpha 0) and the current one (alpha 1), used for rendering
+    def get_interpolated_pos(self, alpha):
+        return self.prev_pos + (self.pos - self.prev_pos) * alpha
+
     def get_map_pos(self, truncate=True):
         gamemap = World.gamemap
 
@@ -91,116 +146,87 @@ class Entity:
                 return pygame.Vector2(int(pos[0]), int(pos[1]))
             return pos
         
-        return self.pos
+        return self.pos.copy()
     
+    # Cast a ray to end_pos, it stops at the first wall
+    # Returns the entities it goes through (closest first) and where it ends (the wall hit, or end_pos if there's none)
+    # With only, that's the only entity that can be in the collisions, if not the ignored ones are left out
     def cast_ray(self, end_pos, only=None, ignore=None):
         # Ignoring entities
         ignore = [] if ignore is None else ignore
 
-        # Only entity to target, if this is used ignore wont be used
-        # only
+        rx, ry = self.pos.tolist()
+        rx2, ry2 = float(end_pos[0]), float(end_pos[1])
 
-        collisions = []
-
-        rx, ry = self.pos
-        rx2, ry2 = end_pos
-
-        # Cast a ray at a position and return entity collisions
         # First check where it ends in the map
         gamemap = World.gamemap
-
-        hit, pos = gamemap.cast_ray(self.pos/gamemap.tilesize, (end_pos[0]/gamemap.tilesize, end_pos[0]/gamemap.tilesize))
+        blocked, _, distances = line_of_sight.cast(gamemap.mapW, gamemap.tilesize, [(rx, ry)], [(rx2, ry2)])
 
         # Limit the ray to finish in the hit position
-        if hit:
-            rx2, ry2 = pos[0]*gamemap.tilesize, pos[1]*gamemap.tilesize
+        if blocked[0]:
+            length = math.sqrt((rx2 - rx)**2 + (ry2 - ry)**2)
+            fraction = 0 if length == 0 else distances[0] / length
+            rx2, ry2 = rx + (rx2 - rx) * fraction, ry + (ry2 - ry) * fraction
 
         if only:
-            entities = [only]
+            collisions = [ent for ent in World.query_ray((rx, ry), (rx2, ry2), ignore=self) if ent is only]
         else:
-            entities = World.get_entities(ignore=ignore)
-        
+            collisions = [ent for ent in World.query_ray((rx, ry), (rx2, ry2), ignore=self) if ent not in ignore]
+
         # Return the collisions and the hit position of the line (If there was one, if not just return the position inputted)
         return collisions, (rx2, ry2)
 
+    # Slide along the entities in the way, returns the motion (mx, my) without the part towards them
+    # (it only stops the motion towards them, so they can still move apart)
+    def slide_along_entities(self, motion):
+        px, py = self.pos.tolist()
+        mx, my = float(motion[0]), float(motion[1])
+
+        for ent in World.query_radius((px + mx, py + my), float(self.collider_radius), ignore=self):
+            ex, ey = ent.pos.tolist()
+            normal_x, normal_y = ex - px, ey - py
+            dist = math.sqrt(normal_x**2 + normal_y**2)
+            if dist == 0:
+                continue
+
+            towards = (mx * normal_x + my * normal_y) / dist
+            if towards > 0:
+                mx -= normal_x / dist * towards
+                my -= normal_y / dist * towards
+        return mx, my
+
+    # Move now, sliding along the entities and the walls, returns the motion it really did
     def move_and_collide(self, motion):
-        # We are gonna fix the motion vector based on collisions
-        # == MAP COLLISION ==
-        # ENEMIES DONT NEED TO DO THIS I GUESS BECAUSE THEY WILL NEVER WALK INTO A WALL
         gamemap = World.gamemap
 
-        px, py = self.pos
-        pr = self.collider_radius
-        mx, my = motion
-
-        # Get movement direction
-        dir_x = sign(mx)
-        dir_y = sign(my)
+        # == ENTITY COLLISION ==
+        # It's done before the map collision so the slide can't go into a wall
+        mx, my = self.slide_along_entities(motion)
 
+        # == MAP COLLISION ==
+        # The same kernel World.apply_motions uses for every entity at once, with only this row
+        i = self.index
+        start_x, start_y = World.positions[i].tolist()
         if gamemap:
-            # Get entity coordinates and radius based on map tile (float)
-            player_tx, player_ty = (px / gamemap.tilesize, py / gamemap.tilesize)
-            player_tr = self.collider_radius / gamemap.tilesize# Collision radius in map tilesize
-
-            # Get motion in tile coordinates (float)
-            motion_tx, motion_ty = mx / gamemap.tilesize, my / gamemap.tilesize
-
-            # next position in tile coords (also account for the radius)
-            next_x = player_tx + motion_tx + (player_tr * dir_x)
-            next_y = player_ty
-
-            # Get tile coordinate for this next tile 
-            tile_x, tile_y = int(next_x), int(next_y)
-
-            # HORIZONTAL DETECTION
-            if dir_x != 0:
-                # Get which tile we will be at
-                tile_id = gamemap.get_tile_at((tile_x, tile_y))
-
-                # Collision detected
-                if tile_id > 0:
-                    tile_rect = (tile_x, tile_y, tile_x + 1, tile_y + 1)
-                    if circle_rect((next_x, tile_y, player_tr), tile_rect):
-                        motion.x = 0
-                        # Fix position aand convert back to world coords
-                        if dir_x == -1:
-                            self.pos.x = (tile_x + 1 + player_tr)*gamemap.tilesize
-                        else:
-                            self.pos.x = (tile_x - player_tr)*gamemap.tilesize
-
-            # VERTICAL DETECTION
-            next_x = player_tx
-            next_y = player_ty + motion_ty + (player_tr * dir_y)
-
-            # Get tile coordinate for this next tile 
-            tile_x, tile_y = int(next_x), int(next_y)
-
-            if dir_y != 0:
-                # Get which tile we will be at
-                tile_id = gamemap.get_tile_at((tile_x, tile_y))
-
-                # Collision detected
-                if tile_id > 0:
-                    tile_rect = (tile_x, tile_y, tile_x + 1, tile_y + 1)
-                    if circle_rect((next_x, tile_y, player_tr), tile_rect):
-                        motion.y = 0
-                        # Fix position aand convert back to world coords
-                        if dir_y == -1:
-                            self.pos.y = (tile_y + 1 + player_tr)*gamemap.tilesize
-                        else:
-                            self.pos.y = (tile_y - player_tr)*gamemap.tilesize
-
-        # Check collisions with entities
-        entities = World.get_entities(ignore=[self])
-
-        for ent in entities:
-            ex, ey = ent.pos
-            er = ent.collider_radius
-            colliding = circle_circle((px, py, pr), (ex, ey, er))
-
-        self.pos += motion
+            collision.move_circles(gamemap.mapW, float(gamemap.tilesize), World.positions[i:i + 1], np.array([[mx, my]]), World.radii[i:i + 1])
+        else:
+            World.positions[i] += (mx, my)
+        World.update_cell(self)
+
+        # Pressing against a wall leaves a rounding error of motion
+        x, y = World.positions[i].tolist()
+        motion = pygame.Vector2(x - start_x, y - start_y)
+        if abs(motion.x) < 1e-6:
+            motion.x = 0
+        if abs(motion.y) < 1e-6:
+            motion.y = 0
         return motion
 
+    # Move at the end of the tick, with every other entity that moves (see World.apply_motions)
+    def move(self, motion):
+        World.motions[self.index][0] += motion[0]
+        World.motions[self.index][1] += motion[1]
+
     def handle_event(self, event):
         pass
 
@@ -214,8 +240,8 @@ class Entity:
         pygame.draw.circle(surface, (255, 0, 0), self.pos, self.collider_radius)
 
         # Draw line pointing the direction
-        start_line = (self.pos.x, self.pos.y)
-        end_line   = (self.pos.x + math.cos(self.angle) * 20, self.pos.y + math.sin(self.angle) * 20)
+        start_line = (self.pos[0], self.pos[1])
+        end_line   = (self.pos[0] + math.cos(self.angle) * 20, self.pos[1] + math.sin(self.angle) * 20)
 
         if self.ray_hit:
             pygame.draw.line(surface, (0, 255, 0), start_line, self.ray_hit)
@@ -0,0 +1,119 @@
+import time
+import numpy as np
+from numba import njit
+
+# Flow field (Dijkstra map) toward the player
+# Every enemy chases the same tile, so instead of one A* per enemy there's one distance field for all of them:
+# the steps from every tile to the target, built with a breadth first search over the walls when the target changes tile
+# An enemy steps to the neighbour tile that is one step closer (get_next_tile), so the cost doesn't grow with the enemies
+# The field only reaches MAX_DISTANCE steps, enemies further away (or in parts of the map it can't reach) use their A*
+#
+# Usage:
+#   flowfield.update(gamemap.mapW, player.get_map_pos()) # Does nothing unless the target tile (or the map) changed
+#   next_tile = flowfield.get_next_tile(enemy.get_map_pos())
+
+# Steps from the target the field reaches, -1 for the whole map
+MAX_DISTANCE = 48
+
+# Straight directions only, like the enemies A* (allow_diagonals=False)
+DIRECTIONS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0)], dtype=np.int64)
+
+# Steps to the target of every tile (y, x), -1 if it's a wall, can't reach it, or is too far
+distances = np.zeros((0, 0), dtype=np.int64)
+queue = np.zeros((0), dtype=np.int64) # Scratch queue of the search
+
+# What the current field was built for
+field_map = None
+target = None
+
+# How many times the field was built and how long the last build took (in seconds)
+builds = 0
+build_time = 0.0
+
+
+# Breadth first search from the target tile over the open tiles
+@njit(nogil=True, cache=True)
+def build_distances(mapW, target_x, target_y, max_distance, distances, queue):
+    height, width = mapW.shape
+    distances[:] = -1
+
+    if not (target_x >= 0 and target_x < width and target_y >= 0 and target_y < height) or mapW[target_y][target_x] != 0:
+        return
+
+    distances[target_y][target_x] = 0
+    queue[0] = target_y * width + target_x
+    head = 0
+    tail = 1
+
+    while head < tail:
+        tile = queue[head]
+        head += 1
+
+        x = tile % width
+        y = tile // width
+        distance = distances[y][x]
+        if distance == max_distance:
+            continue
+
+        for i in range(len(DIRECTIONS)):
+            nx = x + DIRECTIONS[i][0]
+            ny = y + DIRECTIONS[i][1]
+            if not (nx >= 0 and nx < width and ny >= 0 and ny < height):
+                continue
+
+            if mapW[ny][nx] != 0 or distances[ny][nx] != -1:
+                continue
+
+            distances[ny][nx] = distance + 1
+            queue[tail] = ny * width + nx
+            tail += 1
+
+# Build the field again if the target moved to another tile (or the map changed)
+def update(mapW, target_tile):
+    global distances, queue, field_map, target, builds, build_time
+
+    tile = (int(target_tile[0]), int(target_tile[1]))
+    if mapW is field_map and tile == target:
+        return
+
+    if distances.shape != mapW.shape:
+        distances = np.zeros(mapW.shape, dtype=np.int64)
+        queue = np.zeros((mapW.size), dtype=np.int64)
+
+    start = time.perf_counter()
+    build_distances(mapW, tile[0], tile[1], MAX_DISTANCE, distances, queue)
+    build_time = time.perf_counter() - start
+    builds += 1
+
+    field_map = mapW
+    target = tile
+
+# Throw the field away, the next update builds it again (used when the walls change)
+def invalidate():
+    global field_map, target
+    field_map = None
+    target = None
+
+# Listener of Gamemap.set_tile, any wall change can change the distances
+def on_tile_changed(x, y, old_tile, new_tile):
+    invalidate()
+
+# Steps from a tile to the target, -1 if the field doesn't reach it
+def get_distance(tile):
+    x, y = int(tile[0]), int(tile[1])
+    height, width = distances.shape
+    if not (x >= 0 and x < width and y >= 0 and y < height):
+        return -1
+    return int(distances[y][x])
+
+# Next tile toward the target, None if the field doesn't reach the tile or it's the target
+def get_next_tile(tile):
+    distance = get_distance(tile)
+    if distance <= 0:
+        return None
+
+    x, y = int(tile[0]), int(tile[1])
+    for dx, dy in DIRECTIONS.tolist():
+        if get_distance((x + dx, y + dy)) == distance - 1:
+            return (x + dx, y + dy)
+    return None
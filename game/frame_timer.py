@@ -0,0 +1,123 @@
+import time
+import json
+import numpy as np
+
+# Per-stage frame timing
+# Every stage of a frame adds its duration to the current row of a ring buffer holding the last FRAMES_KEPT frames
+# It's cheap enough to be always on (one perf_counter call and one array write per stage)
+# With the render pipeline the render stages are marked by the render thread, in the frame they finish in
+#
+# Usage:
+#   start = frame_timer.begin_frame()
+#   ...
+#   start = frame_timer.mark(frame_timer.EVENTS, start)
+#   ...
+#   frame_timer.end_frame()
+
+# Stages of a frame, in the order they happen
+STAGES = [
+    "events",
+    "entities_update",
+    "sound_update",
+    "ai_jobs",
+    "snapshot",
+    "render_skybox",
+    "render_walls_and_floors",
+    "sprite_sort",
+    "render_sprites",
+    "blit_array",
+    "scale",
+    "flip",
+    "frame_limit",
+]
+
+# Stage ids
+EVENTS                  = 0
+ENTITIES_UPDATE         = 1
+SOUND_UPDATE            = 2
+AI_JOBS                 = 3
+SNAPSHOT                = 4
+RENDER_SKYBOX           = 5
+RENDER_WALLS_AND_FLOORS = 6
+SPRITE_SORT             = 7
+RENDER_SPRITES          = 8
+BLIT_ARRAY              = 9
+SCALE                   = 10
+FLIP                    = 11
+FRAME_LIMIT             = 12
+
+# How many frames are kept in the ring buffer
+FRAMES_KEPT = 600
+
+# Ring buffer, each row is a frame and each column a stage (in seconds)
+frames = np.zeros((FRAMES_KEPT, len(STAGES)))
+
+# Row of the frame being timed and total of frames timed so far
+frame_index = 0
+frame_count = 0
+
+
+# Forget every timed frame
+def reset():
+    global frame_index, frame_count
+    frames[:] = 0
+    frame_index = 0
+    frame_count = 0
+
+# Start timing a new frame, returns the start time for the first stage
+def begin_frame():
+    frames[frame_index] = 0
+    return time.perf_counter()
+
+# Add the time since start to a stage of the current frame, returns the start time of the next stage
+def mark(stage, start):
+    now = time.perf_counter()
+    frames[frame_index, stage] += now - start
+    return now
+
+# Finish the current frame and move to the next row
+def end_frame():
+    global frame_index, frame_count
+    frame_count += 1
+    frame_index = frame_count % FRAMES_KEPT
+
+# Get the timed frames from the oldest to the newest (in seconds)
+def get_frames():
+    if frame_count < FRAMES_KEPT:
+        return frames[:frame_count].copy()
+    return np.roll(frames, -frame_index, axis=0)
+
+# Median time of each stage in milliseconds
+def summary():
+    timed = get_frames()
+    if len(timed) == 0:
+        return {stage: 0.0 for stage in STAGES}
+
+    medians = np.median(timed, axis=0) * 1000
+    return {stage: float(medians[i]) for i, stage in enumerate(STAGES)}
+
+# Dump the timed frames to a csv file (in milliseconds)
+def dump_csv(filepath):
+    timed = get_frames() * 1000
+    first_frame = frame_count - len(timed)
+
+    with open(filepath, 'w') as f:
+        f.write("frame," + ",".join(STAGES) + ",total\n")
+        for i, row in enumerate(timed):
+            values = ",".join(f"{value:.4f}" for value in row)
+            f.write(f"{first_frame + i},{values},{row.sum():.4f}\n")
+
+# Dump the timed frames to a json file (in milliseconds)
+def dump_json(filepath):
+    timed = get_frames() * 1000
+    first_frame = frame_count - len(timed)
+
+    data = {
+        "stages": STAGES,
+        "first_frame": first_frame,
+        "frames": timed.tolist(),
+        "median": summary(),
+    }
+
+    with open(filepath, 'w') as f:
+        json.dump(data, f, indent=4)
@@ -1,16 +1,28 @@
 import pygame
 import math
+import time
 import pickle
 from game.camera import Camera
 import game.textures as textures
+import game.frame_timer as frame_timer
+import game.jit_cache as jit_cache
+import game.pvs as pvs
+import game.pathfinding as pathfinding
+import game.flowfield as flowfield
+import game.hpa as hpa
+import game.ai_scheduler as ai_scheduler
+import game.line_of_sight as line_of_sight
+import game.dda as dda
+import game.collision as collision
 import numpy as np
 from settings import *
-from game.world import World
+from game.world import World, gather_sprite_rows
 
 import numba as nb
 from numba import jit, njit
 from numba.experimental import jitclass
 from enum import Enum
+from collections import namedtuple
 
 from line_profiler import profile
 
@@ -19,52 +31,74 @@ TWO_PI = math.pi*2
 # Get texture properties
 TEX_WIDTH  = textures.TEX_WIDTH
 TEX_HEIGHT = textures.TEX_HEIGHT
+MIP_LEVELS  = textures.MIP_LEVELS
+MIP_OFFSETS = textures.MIP_OFFSETS
 
 # Some properties
 CEILING_THICKNESS = 16#8
 WALL_AMPLIFIER = 1#.5
+SPRITE_MAX_DEPTH = 32 # Sprites further away than this (in tiles) are not drawn
+
+# Framebuffer
+# When enabled the kernels write straight into the pixels of the target surface (pygame.surfarray.pixels2d)
+# So there's no full buffer copy every frame, it needs a 32 bit surface with the packed layout (see textures.pack_rgb)
+# With it disabled, or with any other surface, the frame is drawn in Gamemap.buffer and then copied
+DIRECT_FRAMEBUFFER = True
+PACKED_MASKS = (0xFF0000, 0x00FF00, 0x0000FF)
 
 # TODO
 # Performance Hit: Low
 DISABLE_FLOOR_SHDADOWS = False # Open ceiling / sky shadow dont work in the floors, and they have the normal color
 
+# How the floors and ceilings are drawn
+# "vertical":   column by column, right after the wall of each column
+# "horizontal": row by row after all the walls, every row has one distance so it's walked with a constant step
+# Which one is faster depends on the resolution and the machine (see benchmark.py --floor-casting)
+FLOOR_CASTING = "vertical"
+
+# Distant walls, floors and sprites sample smaller versions of their textures (see textures.texture_mips)
+# Better for the cache, and there's less aliasing
+MIPMAPPING = True
+
 # Performance Hit: Medium
 DISABLE_SHADE = False # Disable shade in farther away walls and floors (When activated it doesn't work with walls and floors with a open ceiling)
 DISABLE_SPRITE_SHADE = False
 
-# Pre-calculations (Optimizations)
-# Get half of the skybox color, used to merge some colors
-SKYBOX_HALF_LIGHT_COLOR = None
+# The 2D map only shows the tiles the camera has seen (see Gamemap.explored_tiles)
+FOG_OF_WAR = True
 
-# Generate look up table for current distance (Used when rendering the floor)
-current_distances_lookup = np.zeros([0])
+# Colormap light levels (see textures.colormap)
+FULL_LIGHT_LEVEL    = textures.LIGHT_LEVELS - 1
+HALF_LIGHT_LEVEL    = round(0.5 * (textures.LIGHT_LEVELS - 1))  # Floors, ceilings and side walls
+QUARTER_LIGHT_LEVEL = round(0.25 * (textures.LIGHT_LEVELS - 1)) # Ceiling thickness
+SKY_LIT_LEVEL       = textures.SKY_LIT_LEVEL                     # Floors with an open ceiling
 
-# Recommended to call after loading the textures
-# And 
-# 1: Skybox is changed
-# 2: Screen height is changed
-def pre_calculate():
-    global SKYBOX_HALF_LIGHT_COLOR, current_distances_lookup
-
-    # Generate current distance lookup table values (Only when its the first time or the screen height was changed)
-    if len(current_distances_lookup) != HEIGHT:
-        current_distances_lookup = np.zeros([HEIGHT])
+# Pre-calculations (Optimizations)
+# Look up table for the distance of the floor (and ceiling) drawn at each row of a screen with that height
+# Gamemap keeps one for its current resolution (see Gamemap.set_resolution)
+def calculate_row_distances(screen_height):
+    row_distances = np.zeros([screen_height])
 
-        for y in range(0, HEIGHT):
-            current_dist_calc = (2.0 * y - HEIGHT)
+    for y in range(0, screen_height):
+        current_dist_calc = (2.0 * y - screen_height)
 
-            if current_dist_calc == 0:
-                current_dist_calc = 1e30
-            else:
-                current_dist_calc = HEIGHT / current_dist_calc
-            
-            current_distances_lookup[y] = current_dist_calc
+        if current_dist_calc == 0:
+            current_dist_calc = 1e30
+        else:
+            current_dist_calc = screen_height / current_dist_calc
+        
+        row_distances[y] = current_dist_calc
 
-    SKYBOX_HALF_LIGHT_COLOR = (0.5 * textures.SKYBOX_LIGHT_COLOR)
+    return row_distances
 
 # END OF PRE CALCULATIONS
 
 
+# Game state a frame is drawn from (see Gamemap.take_snapshot)
+# Sprite positions are in tiles
+RenderSnapshot = namedtuple("RenderSnapshot", ["pos_x", "pos_y", "plane_x", "plane_y", "dir_x", "dir_y", "sprite_positions", "sprite_ids", "bank"])
+
+
 class Walls(Enum):
     AIR = 0
     WALL = 1
@@ -104,12 +138,51 @@ class Gamemap:
 
         self.width  = len(self.mapW[0])
         self.height = len(self.mapW)
-        self.tilesize = 64
+        self.tilesize = TILE_SIZE
+
+        # Tiles the camera sees, filled by the wall pass
+        self.reset_visibility()
+
+        # Which parts of the map can see each other (see game/pvs.py)
+        self.pvs = pvs.build(self.mapW)
+
+        # Called with (x, y, old tile, new tile) when set_tile changes a wall tile
+        # The cached paths and the flow field depend on the walls
+        self.tile_listeners = [self.on_tile_changed, pathfinding.on_tile_changed, flowfield.on_tile_changed, hpa.on_tile_changed]
+
+        # Surface with the packed layout, used to copy the buffer into surfaces with a different pixel format
+        self.buffer_surface = None
 
-        self.buffer = np.zeros((WIDTH, HEIGHT, 3), dtype=np.uint8)#np.zeros([HEIGHT, WIDTH], dtype=np.uint32)
+        # Internal resolution, it follows the size of the surface given to render
+        self.set_resolution(WIDTH, HEIGHT)
+
+    # Change the internal resolution, every buffer that depends on it is allocated again
+    # The kernels get the size from the buffers, so they don't need to be compiled again
+    def set_resolution(self, width, height):
+        self.resolution = (width, height)
+
+        # Packed pixels buffer, only used when the frame can't be written directly into the surface
+        self.buffer = np.zeros((width, height), dtype=np.uint32)
 
         # 1D ZBuffer # Store each vertical stripe distance (of the wall)
-        self.zbuffer = np.zeros((WIDTH), dtype=np.uint8)
+        self.zbuffer = np.zeros((width), dtype=np.float64)
+
+        # First floor row of each column (the row below the wall)
+        self.floor_starts = np.zeros((width), dtype=np.int64)
+
+        # Rows above the wall of each column (sky, ceiling or ceiling thickness), the wall starts at this row
+        self.open_tops = np.zeros((width), dtype=np.int64)
+
+        # Skybox column of each screen column and skybox row of each screen row, filled every frame (see build_sky_lookup)
+        self.sky_columns = np.zeros((width), dtype=np.int64)
+        self.sky_rows = np.zeros((height), dtype=np.int64)
+
+        # Pixels written in the last frame, by the kernels that go column by column and the ones that go row by row
+        self.column_writes = np.zeros((width), dtype=np.int64)
+        self.row_writes = np.zeros((height + 1), dtype=np.int64)
+
+        # Distance of the floor drawn at each row (Used when rendering the floor)
+        self.row_distances = calculate_row_distances(height)
 
     # Load a map level
     def load_level(self, filepath):
@@ -121,8 +194,95 @@ class Gamemap:
         self.mapF = np.array(mapF, dtype=np.uint8)
         self.mapW = np.array(mapW, dtype=np.uint8)
         self.mapC = np.array(mapC, dtype=np.uint8)
+        self.reset_visibility()
+
+        # Nothing is culled until load_pvs loads (or bakes) the visibility set, it can take a while on big maps
+        self.pvs = pvs.make_unknown(self.mapW)
+        self.level_filepath = filepath
+
+        # The queued AI jobs and the hierarchical graph are for the last level
+        ai_scheduler.clear()
+        hpa.clear()
+
+        # Maps searched hierarchically get the graph now instead of on the first search, on every thread as the
+        # render thread isn't running yet
+        if pathfinding.uses_hierarchical(self.mapW):
+            hpa.get_graph(self.mapW, parallel=True)
         return objects
 
+    # Load the visibility set of the level, or bake it if it's missing or out of date
+    # main runs it behind the loading screen
+    def load_pvs(self):
+        self.pvs = pvs.load_or_build(self.level_filepath, self.mapW)
+
+    # Forget which tiles were seen, the arrays have the size of the map
+    def reset_visibility(self):
+        # Frame in which each tile was last crossed by a wall ray, the rays go through every tile the camera can see
+        # So the tiles seen in the last frame are the ones with visible_tiles >= visible_frame
+        self.visible_tiles = np.full((self.height, self.width), -1, dtype=np.int64)
+
+        # Tiles seen at least once
+        self.explored_tiles = np.zeros((self.height, self.width), dtype=np.bool_)
+
+        # Last frame whose walls were drawn, 0 means nothing was rendered yet
+        self.visible_frame = 0
+
+    # Was the tile (in map coordinates) seen in the last frame?
+    # Before the first frame nothing is known, so every tile counts as visible
+    def is_tile_visible(self, tile_x, tile_y):
+        if self.visible_frame == 0:
+            return True
+
+        if not (tile_x >= 0 and tile_x < self.width and tile_y >= 0 and tile_y < self.height):
+            return False
+        return self.visible_tiles[tile_y][tile_x] >= self.visible_frame
+
+    # Can the camera see something at this world position?
+    # Something standing in a tile can stick out of it, so the tiles around it count too
+    def is_visible(self, pos):
+        if self.visible_frame == 0:
+            return True
+
+        return tile_area_visible(self.visible_tiles, self.visible_frame, int(pos[0] // self.tilesize), int(pos[1] // self.tilesize))
+
+    # Tiles seen in the last frame, as an array of (x, y) map coordinates
+    def get_visible_tiles(self):
+        return np.argwhere(self.visible_tiles >= self.visible_frame)[:, ::-1]
+
+    # Can anything at pos_a possibly see anything at pos_b? (world positions)
+    # A lookup in the PVS, False means there's no way, True that there might be
+    def can_see(self, pos_a, pos_b):
+        tilesize = self.tilesize
+        return pvs.can_see(self.pvs, int(pos_a[0] // tilesize), int(pos_a[1] // tilesize), int(pos_b[0] // tilesize), int(pos_b[1] // tilesize))
+
+    def is_tile_explored(self, tile_x, tile_y):
+        if not (tile_x >= 0 and tile_x < self.width and tile_y >= 0 and tile_y < self.height):
+            return False
+        return self.explored_tiles[tile_y][tile_x]
+
+    # Change a wall tile (doors, scripted walls), 0 opens it
+    def set_tile(self, pos, tile_id):
+        x, y = int(pos[0]), int(pos[1])
+        if not (x >= 0 and x < self.width and y >= 0 and y < self.height):
+            return
+
+        old_tile = int(self.mapW[y][x])
+        if old_tile == tile_id:
+            return
+
+        self.mapW[y][x] = tile_id
+        for listener in self.tile_listeners:
+            listener(x, y, old_tile, tile_id)
+
+    def add_tile_listener(self, listener):
+        self.tile_listeners.append(listener)
+
+    # The PVS was built for the old walls, a new wall only makes it see too much (still right)
+    # An opened one can let regions see each other that it says can't, so nothing is culled until the level is loaded again
+    def on_tile_changed(self, x, y, old_tile, new_tile):
+        if old_tile != 0 and new_tile == 0:
+            self.pvs = pvs.make_all_visible(self.pvs)
+
     def get_tile_at(self, pos):
         px = int(pos[0])
         py = int(pos[1])
@@ -138,129 +298,309 @@ class Gamemap:
         return pos
 
     def render_2d(self, surface: pygame.Surface):
+        # Without a rendered frame there's nothing explored yet, so the whole map is shown
+        fog = FOG_OF_WAR and self.visible_frame > 0
+
         for y in range(self.height):
             for x in range(self.width):
+                if fog and not self.explored_tiles[y][x]:
+                    continue
+
                 tile_id = self.get_tile_at((x, y))
 
                 color = (100, 100, 100)
                 if tile_id != 0:
                     color = (200, 200, 200)
 
+                # Tiles seen in the last frame are a bit brighter
+                if fog and self.visible_tiles[y][x] >= self.visible_frame:
+                    color = (color[0] + 30, color[1] + 30, color[2] + 30)
+
                 rect = (x * self.tilesize, y * self.tilesize, self.tilesize - 1, self.tilesize - 1)
                 pygame.draw.rect(surface, color, rect)
 
-    def numba_load(self):
-        # Call this methods using random values
-        #test(self.buffer, self.zbuffer, 0.531, 0.531, 0.531, 0.531, 0.531, 0.531) # [(0.42, 0.5), (0.6, 59)]
-        # def test(buffer, zbuffer, positions, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y):
-        #distances = [textures.sprites[0], textures.sprites[0]]
-        #test2(distances)
-        #print(test2.inspect_types())
-        pass
-        #render_skybox(self.buffer, math.atan2(1, 1))
-        #render_walls_and_floors_optimized(self.buffer, self.zbuffer, 0, 0, self.mapW, self.mapF, self.mapC, self.width, self.height, self.tilesize, 0, 0, 0, 0)
-        #render_sprites(self.buffer, self.zbuffer, [textures.sprites[0]], [(2, 2)], [0, 2.5],  3, 2, 2, 3, 4, 4)
-
-        #print(render_sprites.inspect_types())
-    
-    def cast_ray(self, start_pos, end_pos):
-        x1, y1 = start_pos
-        x2, y2 = end_pos
-
-        delta_x = x2 - x1
-        delta_y = y2 - y1
-
-        # Get magnitude of delta
-
-        # The angle is the normalization of xy1 pointing to xy2
-        dir_x = delta_x
-        dir_y = delta_y
-
-        tile_pos, perp_wall_dist, side = cast_ray_optimized(self.mapW, self.width, self.height, x1, y1, dir_x, dir_y)
-        hit = False
-        if side != -1:
-            hit = True
-
-        return hit, tile_pos
+    # Load every render kernel from the numba cache (or compile it) with the types of a tiny frame
+    # They are the same types as in render, so the first real frame doesn't compile anything
+    # Safe to run in a background thread while a loading screen is shown (see main.py), returns the jit_cache report
+    def numba_load(self, surface: pygame.Surface):
+        size = 16
 
+        # Tiny framebuffer of the same type as the one render uses for that surface
+        if DIRECT_FRAMEBUFFER and self.is_packed_surface(surface):
+            warmup_surface = pygame.surface.Surface((size, size), 0, surface)
+            buffer = pygame.surfarray.pixels2d(warmup_surface)
+        else:
+            buffer = np.zeros((size, size), dtype=np.uint32)
+
+        zbuffer = np.zeros((size), dtype=np.float64)
+        floor_starts = np.zeros((size), dtype=np.int64)
+        open_tops = np.zeros((size), dtype=np.int64)
+        sky_columns = np.zeros((size), dtype=np.int64)
+        sky_rows = np.zeros((size), dtype=np.int64)
+        column_writes = np.zeros((size), dtype=np.int64)
+        row_writes = np.zeros((size + 1), dtype=np.int64)
+        row_distances = calculate_row_distances(size)
+        visible_tiles = np.full((3, 3), -1, dtype=np.int64)
+        explored_tiles = np.zeros((3, 3), dtype=np.bool_)
+        bank = textures.get_bank()
+
+        # A room of 1 tile surrounded by walls
+        mapW = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=np.uint8)
+        mapF = np.ones((3, 3), dtype=np.uint8)
+        mapC = np.ones((3, 3), dtype=np.uint8)
+
+        pos_x = pos_y = 1.5 * self.tilesize
+        dir_x, dir_y = 1.0, 0.0
+        plane_x, plane_y = 0.0, 0.66
+
+        # One sprite in front of the camera
+        positions = np.array([[2.0, 1.5]], dtype=np.float64)
+        sprite_ids = np.zeros((1), dtype=np.int64)
+        order = np.zeros((1), dtype=np.int64)
+        distances = np.ones((1), dtype=np.float64)
+
+        report = [
+            jit_cache.warm_up(build_sky_lookup, sky_columns, sky_rows, bank, 0.0),
+            jit_cache.warm_up(render_walls_and_floors_optimized, buffer, zbuffer, floor_starts, open_tops, column_writes, True, bank, row_distances,
+                              sky_columns, sky_rows, visible_tiles, explored_tiles, 1,
+                              pos_x, pos_y, mapW, mapF, mapC, 3, 3, self.tilesize, plane_x, plane_y, dir_x, dir_y),
+            jit_cache.warm_up(render_floors_horizontal, buffer, bank, row_distances, floor_starts, open_tops, row_writes,
+                              sky_columns, sky_rows, pos_x, pos_y, mapF, mapC, 3, 3, self.tilesize, plane_x, plane_y, dir_x, dir_y),
+            jit_cache.warm_up(render_skybox, buffer, bank, sky_columns, sky_rows, floor_starts, column_writes),
+            jit_cache.warm_up(cull_and_sort_sprites, positions, visible_tiles, 1, 1.5, 1.5, plane_x, plane_y, dir_x, dir_y, SPRITE_MAX_DEPTH, size, size),
+            jit_cache.warm_up(render_sprites, buffer, zbuffer, column_writes, bank, sprite_ids, positions, order, distances,
+                              1.5, 1.5, plane_x, plane_y, dir_x, dir_y),
+            jit_cache.warm_up(gather_sprite_rows, positions, positions, sprite_ids, -1, 1.0, 0, self.pvs.bits, pvs.REGION_SIZE, 1, 1, 64.0,
+                              positions, sprite_ids),
+            jit_cache.warm_up(pathfinding.astar, mapW, 1, 1, 1, 1, False, False, -1, -1,
+                              np.zeros((9)), np.zeros((9), dtype=np.int64), np.zeros((9), dtype=np.int64), np.zeros((9), dtype=np.int64), 1),
+            jit_cache.warm_up(flowfield.build_distances, mapW, 1, 1, -1, np.zeros((3, 3), dtype=np.int64), np.zeros((9), dtype=np.int64)),
+            jit_cache.warm_up(hpa.search_cluster, mapW, 0, 0, 3, 3, 1, 1, np.zeros((9), dtype=np.int64), np.zeros((9), dtype=np.int64), np.zeros((9), dtype=np.int64)),
+            jit_cache.warm_up(hpa.search_cluster_costs, mapW, 3, 1, 0, 4, np.zeros((1), dtype=np.int64), np.zeros((4), dtype=np.int64),
+                              np.zeros((4), dtype=np.int64), np.zeros((4, 4), dtype=np.int32)),
+            jit_cache.warm_up(hpa.build_cluster_costs, mapW, 3, 1, np.zeros((1), dtype=np.int64), 4, np.zeros((1), dtype=np.int64),
+                              np.zeros((4), dtype=np.int64), np.zeros((4), dtype=np.int64), np.zeros((4, 4), dtype=np.int32)),
+            jit_cache.warm_up(line_of_sight.cast_segments, mapW, positions, positions, np.zeros((1), dtype=np.bool_), np.zeros((1, 2), dtype=np.int64), np.zeros((1))),
+            jit_cache.warm_up(collision.move_circles, mapW, float(self.tilesize), positions, np.ones((1, 2)), np.ones((1))),
+            jit_cache.warm_up(hpa.search_graph, 4, np.zeros((1), dtype=np.int64), np.zeros((4), dtype=np.int64), np.zeros((4), dtype=np.int64),
+                              np.zeros((4, 4), dtype=np.int32), np.zeros((4, 2), dtype=np.int64), np.zeros((4)), np.zeros((4)), 1, 1),
+        ]
+
+        # Release the surface pixels
+        del buffer
+        return report
+    
+    # Distance of the floor (or ceiling) drawn at each row of the screen
+    def get_row_distances(self):
+        return self.row_distances
+
+    # Pixel writes per screen pixel in the last frame, 1.0 means every pixel was written exactly once
+    # Anything above it is overdraw (pixels drawn and then covered by something else)
+    def get_overdraw(self):
+        width, height = self.resolution
+        return (self.column_writes.sum() + self.row_writes.sum()) / (width * height)
+
+    # Can the kernels write directly into the surface pixels?
+    def is_packed_surface(self, surface: pygame.Surface):
+        return surface.get_bitsize() == 32 and surface.get_masks()[:3] == PACKED_MASKS
+
+    # Copy the buffer into a surface (Only used when the frame is not written directly)
+    def copy_buffer(self, surface: pygame.Surface):
+        if self.is_packed_surface(surface):
+            pygame.surfarray.blit_array(surface, self.buffer)
+            return
+
+        # Let pygame convert it to the pixel format of the surface
+        if self.buffer_surface is None or self.buffer_surface.get_size() != surface.get_size():
+            self.buffer_surface = pygame.surface.Surface(surface.get_size(), 0, 32)
+
+        pygame.surfarray.blit_array(self.buffer_surface, self.buffer)
+        surface.blit(self.buffer_surface, (0, 0))
+
+    # Everything the renderer needs from the game state, taken at the start of the frame
+    # The frame can then be drawn while the game state keeps changing (see render_pipeline)
+    # Alpha is how far the simulation is between the last two ticks, the sprites are taken interpolated with it
+    def take_snapshot(self, pos, alpha = 1.0):
+        tilesize = self.tilesize
+
+        # Always floats, so the kernels are called with the same types they were compiled (and cached) with
+        # Sprites in parts of the map that can't be seen from here are left out
+        count = World.gather_sprites(ignore=World.player, alpha=alpha, viewer=pos)
+        return RenderSnapshot(
+            float(pos[0]), float(pos[1]),
+            float(Camera.plane_x), float(Camera.plane_y),
+            float(Camera.dir_x), float(Camera.dir_y),
+            World.sprite_positions[:count] / tilesize,
+            World.sprite_ids[:count].copy(),
+            # Textures, sprites and the skybox can be replaced at any time, so they are passed to the kernels every frame
+            textures.get_bank(),
+        )
+
+    def render(self, surface: pygame.Surface, pos, surface_debug = None, alpha = 1.0):
+        self.render_snapshot(surface, self.take_snapshot(pos, alpha))
+
+    # Draw a snapshot into a surface, safe to call from another thread as long as nothing else uses the surface
+    def render_snapshot(self, surface: pygame.Surface, snapshot):
+        # The frame is drawn with the size of the surface
+        if surface.get_size() != self.resolution:
+            self.set_resolution(*surface.get_size())
+
+        # Get the framebuffer, the surface pixels (zero copy) or our own buffer
+        direct = DIRECT_FRAMEBUFFER and self.is_packed_surface(surface)
+        if direct:
+            buffer = pygame.surfarray.pixels2d(surface)
+        else:
+            buffer = self.buffer
 
-    def render(self, surface: pygame.Surface, pos, surface_debug = None):
-        buffer = self.buffer
+        self.render_buffer(buffer, snapshot)
 
-        pos_x, pos_y = pos[0], pos[1]
+        # Draw buffer
+        start = time.perf_counter()
+        if direct:
+            # Release the surface pixels, a surface can't be blitted while they are referenced
+            del buffer
+        else:
+            self.copy_buffer(surface)
+        frame_timer.mark(frame_timer.BLIT_ARRAY, start)
 
-        # Gets plane
-        plane_x, plane_y = Camera.get_plane()
-        dir_x, dir_y = Camera.get_dir()
+        # Clear buffer
+        #buffer.fill(0)
 
-        # Render skybox walls and floors
-        render_skybox(buffer, math.atan2(dir_y, dir_x))
-        render_walls_and_floors_optimized(buffer, self.zbuffer, pos[0], pos[1], self.mapW, self.mapF, self.mapC, self.width, self.height, self.tilesize, plane_x, plane_y, dir_x, dir_y)
+    # Draw a snapshot into a packed pixels buffer
+    def render_buffer(self, buffer, snapshot):
+        pos_x, pos_y = snapshot.pos_x, snapshot.pos_y
+        plane_x, plane_y = snapshot.plane_x, snapshot.plane_y
+        dir_x, dir_y = snapshot.dir_x, snapshot.dir_y
+        bank = snapshot.bank
+
+        self.column_writes.fill(0)
+        self.row_writes.fill(0)
+
+        # Render walls, floors and the skybox
+        # The floor pass draws the sky itself where there's no ceiling, so every pixel above a wall is written once
+        # The skybox pass then only fills the columns without a wall
+        start = time.perf_counter()
+        build_sky_lookup(self.sky_columns, self.sky_rows, bank, math.atan2(dir_y, dir_x))
+
+        # The wall rays stamp the tiles they go through with this frame
+        frame = self.visible_frame + 1
+
+        horizontal_floors = FLOOR_CASTING == "horizontal"
+        render_walls_and_floors_optimized(buffer, self.zbuffer, self.floor_starts, self.open_tops, self.column_writes, not horizontal_floors, bank, self.row_distances,
+                                          self.sky_columns, self.sky_rows, self.visible_tiles, self.explored_tiles, frame, pos_x, pos_y, self.mapW, self.mapF, self.mapC, self.width, self.height, self.tilesize, plane_x, plane_y, dir_x, dir_y)
+        if horizontal_floors:
+            render_floors_horizontal(buffer, bank, self.row_distances, self.floor_starts, self.open_tops, self.row_writes,
+                                     self.sky_columns, self.sky_rows, pos_x, pos_y, self.mapF, self.mapC, self.width, self.height, self.tilesize, plane_x, plane_y, dir_x, dir_y)
+        self.visible_frame = frame
+        start = frame_timer.mark(frame_timer.RENDER_WALLS_AND_FLOORS, start)
+
+        render_skybox(buffer, bank, self.sky_columns, self.sky_rows, self.floor_starts, self.column_writes)
+        start = frame_timer.mark(frame_timer.RENDER_SKYBOX, start)
 
         # Draw sprites
-        entities = World.get_entities(ignore_player=True)
-        distances = np.empty([len(entities)])#[] # Each index here is equivalent to the entity in the list above
+        # Cull and sort them (back to front) in one go
+        positions = snapshot.sprite_positions
+        if len(positions) > 0:
+            tilesize = self.tilesize
+            order, distances = cull_and_sort_sprites(positions, self.visible_tiles, frame, pos_x/tilesize, pos_y/tilesize, plane_x, plane_y, dir_x, dir_y, SPRITE_MAX_DEPTH, buffer.shape[0], buffer.shape[1])
+            start = frame_timer.mark(frame_timer.SPRITE_SORT, start)
+
+            render_sprites(buffer, self.zbuffer, self.column_writes, bank, snapshot.sprite_ids, positions, order, distances, pos_x/tilesize, pos_y/tilesize, plane_x, plane_y, dir_x, dir_y)
+            start = frame_timer.mark(frame_timer.RENDER_SPRITES, start)
+        else:
+            start = frame_timer.mark(frame_timer.SPRITE_SORT, start)
 
-        if len(entities) > 0:
+        # Render hud overlay (finnlly this is the last thing)
+        if textures.hud_overlay != -1:
+            tex = textures.hud_textures[textures.hud_overlay]
 
-            # Perfom euclidean distance from the camera x,y to every sprite (except the player)
-            for i, ent in enumerate(entities):
-                ent_x, ent_y = ent.pos
-                # Sqrt is not needed
-                distances[i] = ((pos_x - ent_x) * (pos_x - ent_x) + (pos_y - ent_y) * (pos_y - ent_y))
+# Get the colormap light level of a light factor between 0 and 1
+@njit(cache=True)
+def light_level(factor):
+    return int(factor * (textures.LIGHT_LEVELS - 1) + 0.5)
+
+# Get the mip level for an amount of texels per screen pixel, every level halves the texels
+@njit(cache=True)
+def mip_level(texels_per_pixel):
+    level = 0
+    if MIPMAPPING:
+        while texels_per_pixel >= 2 and level < MIP_LEVELS - 1:
+            texels_per_pixel *= 0.5
+            level += 1
+    return level
+
+# Get a texel from the mips of a texture, texture_x and texture_y are full size coordinates
+@njit(cache=True)
+def sample_mip(mips, level, texture_x, texture_y):
+    return mips[MIP_OFFSETS[level] + (texture_x >> level) * (TEX_WIDTH >> level) + (texture_y >> level)]
+
+
+# Was the tile, or one of the 8 around it, stamped with this frame (or a later one) in visible_tiles?
+@njit(cache=True)
+def tile_area_visible(visible_tiles, frame, tile_x, tile_y):
+    height, width = visible_tiles.shape
+    for y in range(max(tile_y - 1, 0), min(tile_y + 2, height)):
+        for x in range(max(tile_x - 1, 0), min(tile_x + 2, width)):
+            if visible_tiles[y][x] >= frame:
+                return True
+    return False
+
+# Get which sprites are visible and the order they need to be drawn (furthest to closest)
+# A sprite is culled when it's behind the camera plane, beyond max_depth, completely outside the screen or behind walls
+# Returns the sprite indices in drawing order and their distance to the camera
+@njit(fastmath=True, nogil=True, cache=True)
+def cull_and_sort_sprites(positions, visible_tiles, frame, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y, max_depth, screen_width, screen_height):
+    count = len(positions)
+
+    # Inverse camera matrix
+    inv_det = 1.0 / (plane_x * dir_y - dir_x * plane_y)
+
+    visible = np.empty(count, dtype=np.int64)
+    distances = np.empty(count)
+    visible_count = 0
+
+    for i in range(count):
+        # Sprite position relative to the camera
+        sprite_x = positions[i, 0] - pos_x
+        sprite_y = positions[i, 1] - pos_y
+
+        # Depth inside of the screen
+        transform_y = inv_det * (-plane_y * sprite_x + plane_x * sprite_y)
+        if transform_y <= 0 or transform_y > max_depth:
+            continue
 
-            # Use bubble sort to perform the sorting operation
-            sorted = 0
-            while sorted < len(entities) - 1:
-                sorted = 0
-                for i in range(1, len(entities)):
-                    dist1 = distances[i - 1]
-                    dist2 = distances[i]
+        # Horizontal screen position and half of the width of the sprite
+        transform_x = inv_det * (dir_y * sprite_x - dir_x * sprite_y)
+        sprite_screen_x = (screen_width / 2) * (1 + transform_x / transform_y)
+        half_width = screen_height / transform_y / 2
+        if sprite_screen_x + half_width < 0 or sprite_screen_x - half_width >= screen_width:
+            continue
 
-                    # We actually store from furthest to smallest that's why it's >
-                    if dist2 > dist1:
-                        # Swap values
-                        distances[i - 1], distances[i] = distances[i], distances[i - 1]
-                        entities[i - 1], entities[i] = entities[i], entities[i - 1]
-                    else:
-                        sorted += 1
+        # Behind a wall, no ray of this frame went near its tile
+        if not tile_area_visible(visible_tiles, frame, int(positions[i, 0]), int(positions[i, 1])):
+            continue
 
-            zbuffer = self.zbuffer
+        visible[visible_count] = i
+        distances[visible_count] = sprite_x * sprite_x + sprite_y * sprite_y # Sqrt is only needed for the visible ones
+        visible_count += 1
 
-            sprites = [ent.sprite for ent in entities]
-            positions = [(ent.pos[0]/self.tilesize, ent.pos[1]/self.tilesize) for ent in entities]
+    # We store from furthest to closest, that's why the distances are negated
+    order = np.argsort(-distances[:visible_count])
+    return visible[:visible_count][order], np.sqrt(distances[:visible_count][order])
 
-            render_sprites(buffer, zbuffer, sprites, positions, pos_x/self.tilesize, pos_y/self.tilesize, plane_x, plane_y, dir_x, dir_y)
+# Draw the sprites in the given order (which is the painter's order, so this loop can't run in parallel)
+# Distances is used for shading
+@njit(fastmath=True, parallel=True, nogil=True, cache=True)
+def render_sprites(buffer, zbuffer, column_writes, bank, sprite_ids, positions, order, distances, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y):
+    screen_width, screen_height = buffer.shape
+    sprites, colormap = bank.sprite_mips, bank.colormap
 
-        # Render hud overlay (finnlly this is the last thing)
-        if textures.hud_overlay != -1:
-            tex = textures.hud_textures[textures.hud_overlay]
+    # Inverse camera matrix
+    inv_det = 1.0 / (plane_x * dir_y - dir_x * plane_y)
 
-        # Draw buffer
-        pygame.surfarray.blit_array(surface, buffer)
-
-        # Clear buffer
-        #buffer.fill(0)
-
-#@njit("void(Array(float64, 2, C))")
-@njit#("void(Array(uint8[:,:,::1]))")
-def test2(sprites):
-    pass
-
-#@njit("void(uint8[:,:,::1], uint8[::1], list(uint8[:,:,::1]), float64[:,::1], float64, float64, float64, float64, float64, float64)")
-def test(buffer, zbuffer, sprites, positions, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y):
-    pass
-
-#
-#@njit("void(Array(uint8, 3d, C), Array(uint8, 1d, C), list(Array(uint8, 3d, C)), list(UniTuple(float64, float64)), float64, float64, float64, float64, float64, float64)", fastmath=True, parallel=True)
-#@njit("void(uint8[:,:,::1], uint8[::1], list(uint8[:,:,::1]), list(UniTuple(float64, float64)), float64, float64, float64, float64, float64, float64)", fastmath=True, parallel=True)
-@njit(fastmath=True, parallel=True, cache=True)
-def render_sprites(buffer, zbuffer, sprites, positions, pos_x, pos_y, plane_x, plane_y, dir_x, dir_y):
-    # Draw sprites
-    # Distances is used for shading
-    
-    for i in nb.prange(len(sprites)):
-        sprite = sprites[i]
+    for n in range(len(order)):
+        i = order[n]
+        sprite = sprites[sprite_ids[i]]
 
         if not sprite.any():
             continue
@@ -269,16 +609,12 @@ def render_sprites(buffer, zbuffer, sprites, positions, pos_x, pos_y, plane_x, p
         sprite_x = positions[i][0] - pos_x
         sprite_y = positions[i][1] - pos_y
 
-        # Get distance to the camera
-        shade_multiplication_factor = 1
+        # Get the colors of the sprite light level, based on the distance to the camera
+        shades = colormap[FULL_LIGHT_LEVEL]
         if not DISABLE_SPRITE_SHADE:
-            dist = math.sqrt((pos_x - sprite_x)**2 + (pos_y - sprite_y)**2)
-            shade_multiplication_factor = min(max((1/(dist/2)), 0.1), 1)
-            
+            shades = colormap[light_level(min(max((1/(distances[n]/2)), 0.1), 1))]
 
         # Transform sprite with the inverse camera matrix
-        inv_det = 1.0 / (plane_x * dir_y - dir_x * plane_y)
-
         transform_x = inv_det * (dir_y * sprite_x - dir_x * sprite_y)
         transform_y = inv_det * (-plane_y * sprite_x + plane_x * sprite_y) # Depth inside of the screen
 
@@ -288,23 +624,26 @@ def render_sprites(buffer, zbuffer, sprites, positions, pos_x, pos_y, plane_x, p
         if transform_y == 0:
             transform_y += 0.00000001
 
-        sprite_screen_x = int((WIDTH / 2) * (1 + transform_x / transform_y))
+        sprite_screen_x = int((screen_width / 2) * (1 + transform_x / transform_y))
 
         # Height of the sprite on the screen
-        sprite_height = abs(int(HEIGHT / transform_y)) # Transform y prevents fish eye
+        sprite_height = abs(int(screen_height / transform_y)) # Transform y prevents fish eye
 
         # Calculate lowest and highest pixel to fill in
-        draw_start_y = -sprite_height / 2 + HEIGHT / 2
+        draw_start_y = -sprite_height / 2 + screen_height / 2
         if (draw_start_y < 0): draw_start_y = 0
-        draw_end_y = sprite_height / 2 + HEIGHT / 2
-        if (draw_end_y >= HEIGHT): draw_end_y = HEIGHT - 1
+        draw_end_y = sprite_height / 2 + screen_height / 2
+        if (draw_end_y >= screen_height): draw_end_y = screen_height - 1
 
         # Calculate width of the sprite
-        sprite_width = abs(int(HEIGHT / (transform_y)))
+        sprite_width = abs(int(screen_height / (transform_y)))
         draw_start_x = -sprite_width / 2 + sprite_screen_x
         if (draw_start_x < 0): draw_start_x = 0
         draw_end_x = sprite_width / 2 + sprite_screen_x
-        if (draw_end_x >= WIDTH): draw_end_x = WIDTH - 1
+        if (draw_end_x >= screen_width): draw_end_x = screen_width - 1
+
+        # Sprites further away sample smaller mips
+        level = mip_level(TEX_HEIGHT / max(sprite_height, 1))
 
         # Loop through every vertical stripe of the sprite on the screen
         for stripe in nb.prange(int(draw_start_x), int(draw_end_x), 1):
@@ -314,23 +653,26 @@ def render_sprites(buffer, zbuffer, sprites, positions, pos_x, pos_y, plane_x, p
             # 2) Has to be on the screen (left or right)
             # 3) Zbuffer, with perpendicular distance
 
-            if (transform_y > 0 and stripe > 0 and stripe < WIDTH and transform_y < zbuffer[stripe]):
+            if (transform_y > 0 and stripe > 0 and stripe < screen_width and transform_y < zbuffer[stripe]):
+                writes = 0
                 for y in nb.prange(int(draw_start_y), int(draw_end_y), 1): # every pixel of the current stripe
-                    d = (y) * 256 - HEIGHT * 128 + sprite_height * 128
+                    d = (y) * 256 - screen_height * 128 + sprite_height * 128
                     tex_y = ((d * TEX_HEIGHT) / sprite_height) / 256
-                    color = sprite[int(tex_x)][int(tex_y)]
-                    if color.any():#not np.array_equal(color, textures.TRANSPARENT_COLOR): # Black is transparent
-                        if not DISABLE_SPRITE_SHADE:
-                            buffer[stripe][y] = color * shade_multiplication_factor
-                        else:
-                            buffer[stripe][y] = color
-
-@njit(fastmath=True, parallel=True)#, cache=True)
-def render_skybox(buffer, angle):
-    SKYBOX_WIDTH, SKYBOX_HEIGHT = textures.SKYBOX_WIDTH, textures.SKYBOX_HEIGHT
+                    index = sample_mip(sprite, level, int(tex_x), int(tex_y))
+                    if index != 0: # Black is transparent
+                        buffer[stripe][y] = shades[index]
+                        writes += 1
+                column_writes[stripe] += writes
+
+# Fill the skybox column of each screen column and the skybox row of each screen row (above the horizon)
+# The column only depends on the camera angle, so it's worked out once per frame instead of once per pixel
+@njit(fastmath=True, nogil=True, cache=True)
+def build_sky_lookup(sky_columns, sky_rows, bank, angle):
+    screen_width, screen_height = len(sky_columns), len(sky_rows)
+    SKYBOX_WIDTH, SKYBOX_HEIGHT = bank.skybox.shape
 
     # Horizon position
-    horizon = int(HEIGHT / 2)
+    horizon = int(screen_height / 2)
 
     # How much can you see of the image at once
     # If you have a fov of 360 degrees you would see all of the image at once
@@ -344,45 +686,200 @@ def render_skybox(buffer, angle):
     left_most_ray = 0 if left_most_ray == 0 else (left_most_ray/TWO_PI) * SKYBOX_WIDTH
 
     # This is not exactly right, but it does the job i guess, i think there's still a little bit of loop around at certain points
-    ideal_width = WIDTH * 4
+    ideal_width = screen_width * 4
     tex_x_step = SKYBOX_WIDTH/ideal_width
 
-    for y in nb.prange(horizon):
-        tex_x = left_most_ray
-        tex_y = int(SKYBOX_HEIGHT * (y/horizon)) #% SKYBOX_HEIGHT
-        for x in nb.prange(WIDTH):
-            color = textures.skybox[int(tex_x) % SKYBOX_WIDTH][tex_y]
-            buffer[x][y] = color
-            tex_x += tex_x_step
+    for x in range(screen_width):
+        sky_columns[x] = int(left_most_ray + x * tex_x_step) % SKYBOX_WIDTH
+
+    for y in range(horizon):
+        sky_rows[y] = int(SKYBOX_HEIGHT * (y/horizon)) #% SKYBOX_HEIGHT
+
+# Draw the sky of the columns without a wall (the rest of the sky is drawn by the floor passes, where there's no ceiling)
+# It runs after the walls, so no sky pixel is drawn to be covered later
+@njit(fastmath=True, parallel=True, nogil=True, cache=True)
+def render_skybox(buffer, bank, sky_columns, sky_rows, floor_starts, column_writes):
+    screen_width, screen_height = buffer.shape
+    skybox = bank.skybox
+
+    # Horizon position
+    horizon = int(screen_height / 2)
+
+    for x in nb.prange(screen_width):
+        # The wall pass leaves floor_starts at the bottom of the screen when the ray didn't hit anything
+        if floor_starts[x] < screen_height:
+            continue
+
+        sky_column = skybox[sky_columns[x]]
+        for y in range(horizon):
+            buffer[x][y] = sky_column[sky_rows[y]]
+        column_writes[x] += horizon
+
+
+# Draw the floor pixel (x, y) and its ceiling (x, screen_height - y), floor_x and floor_y is the position of the pixel on the map
+# Returns the palette index of the ceiling texel (or -1 if there's no ceiling) and how many pixels were written
+@njit(fastmath=True, cache=True)
+def draw_floor_and_ceiling(buffer, bank, x, y, floor_x, floor_y, level, mapF, mapC, width, height):
+    screen_height = buffer.shape[1]
+    texture_mips, colormap = bank.texture_mips, bank.colormap
+
+    floor_tex_x = int(floor_x * TEX_WIDTH) % TEX_WIDTH
+    floor_tex_y = int(floor_y * TEX_HEIGHT) % TEX_HEIGHT
+
+    map_x = int(floor_x)
+    map_y = int(floor_y)
+
+    # Color
+    if not (map_x >= 0 and map_x < width and map_y >= 0 and map_y < height):
+        return -1, 0
+
+    texture_floor_id   = mapF[map_y][map_x] - 1
+    texture_ceiling_id = mapC[map_y][map_x] - 1
+
+    writes = 0
+    if texture_floor_id != -1:
+        writes += 1
+        # Render the floor
+        # Make the floor darker if there's ceiling above
+        index = sample_mip(texture_mips[texture_floor_id], level, floor_tex_x, floor_tex_y)
+        if texture_ceiling_id == -1 and not DISABLE_FLOOR_SHDADOWS:
+            buffer[x][y] = colormap[SKY_LIT_LEVEL][index]
+        else:
+            buffer[x][y] = colormap[HALF_LIGHT_LEVEL][index]
+
+    if texture_ceiling_id == -1:
+        return -1, writes
+
+    # Ceiling
+    index = sample_mip(texture_mips[texture_ceiling_id], level, floor_tex_x, floor_tex_y)
+    buffer[x][screen_height - y] = colormap[HALF_LIGHT_LEVEL][index]
+    return index, writes + 1
+
+# Get the ceiling thickness color at the ceiling row (screen_height - y) of a column without a ceiling, or -1 if there's none
+# The vertical floor pass draws the thickness upwards from each ceiling pixel and the closer ones overwrite it
+# Here it's gathered instead, from the closest ceiling pixel below (rows y - 2, y - 3...) whose thickness reaches this row
+@njit(fastmath=True, cache=True)
+def ceiling_thickness_at(bank, row_distances, y, floor_start, rx, ry, ray_dir_x, ray_dir_y, floor_texels_per_pixel, mapC, width, height):
+    screen_height = len(row_distances)
+    texture_mips, colormap = bank.texture_mips, bank.colormap
+    row = screen_height - y
+
+    edge = y - 2
+    while edge >= floor_start:
+        current_dist = row_distances[edge]
+
+        # The thickness of rows further away is shorter, so none of them reach this row either
+        if row < int(screen_height - edge - CEILING_THICKNESS / current_dist):
+            return -1
+
+        floor_x = rx + current_dist * ray_dir_x
+        floor_y = ry + current_dist * ray_dir_y
+        map_x = int(floor_x)
+        map_y = int(floor_y)
+
+        if map_x >= 0 and map_x < width and map_y >= 0 and map_y < height and mapC[map_y][map_x] != 0:
+            floor_tex_x = int(floor_x * TEX_WIDTH) % TEX_WIDTH
+            floor_tex_y = int(floor_y * TEX_HEIGHT) % TEX_HEIGHT
+            level = mip_level(current_dist * floor_texels_per_pixel)
+            index = sample_mip(texture_mips[mapC[map_y][map_x] - 1], level, floor_tex_x, floor_tex_y)
+            return colormap[QUARTER_LIGHT_LEVEL][index]
+
+        edge -= 1
+
+    return -1
+
+# Horizontal floor casting, the floors and ceilings are drawn row by row (in parallel) after the walls
+# Every row has a single distance, so the map position only moves by a constant step from one pixel to the next
+# Only the pixels below the wall of each column are drawn (floor_starts is filled by the wall pass)
+# And above it the ceiling, its thickness or the sky, so those pixels are written once (open_tops is filled by the wall pass too)
+@njit(fastmath=True, parallel=True, nogil=True, cache=True)
+def render_floors_horizontal(buffer, bank, row_distances, floor_starts, open_tops, row_writes, sky_columns, sky_rows, pos_x, pos_y, mapF, mapC, width, height, tilesize, plane_x, plane_y, dir_x, dir_y):
+    screen_width, screen_height = buffer.shape
+    skybox = bank.skybox
+
+    rx = pos_x / tilesize
+    ry = pos_y / tilesize
+
+    # Direction of the leftmost ray and how much it changes per column
+    ray_dir_x0 = dir_x - plane_x
+    ray_dir_y0 = dir_y - plane_y
+    ray_step_x = 2 * plane_x / screen_width
+    ray_step_y = 2 * plane_y / screen_width
+
+    floor_texels_per_pixel = TEX_WIDTH * 2 * math.sqrt(plane_x * plane_x + plane_y * plane_y) / screen_width
+
+    first_row = screen_height
+    for x in range(screen_width):
+        first_row = min(first_row, floor_starts[x])
+
+    # The extra row (y = screen_height) has no floor, it's the first screen row which can only have ceiling thickness
+    for y in nb.prange(first_row, screen_height + 1):
+        current_dist = row_distances[min(y, screen_height - 1)]
+        level = mip_level(current_dist * floor_texels_per_pixel)
+
+        # Map position of the leftmost pixel of the row and the step to the next one
+        floor_x = rx + current_dist * ray_dir_x0
+        floor_y = ry + current_dist * ray_dir_y0
+        step_x = current_dist * ray_step_x
+        step_y = current_dist * ray_step_y
+
+        writes = 0
+        for x in range(screen_width):
+            # Columns without a wall are left to the skybox pass
+            if y < floor_starts[x] or floor_starts[x] == screen_height:
+                continue
+
+            index = -1
+            if y < screen_height:
+                index, floor_writes = draw_floor_and_ceiling(buffer, bank, x, y, floor_x + step_x * x, floor_y + step_y * x, level, mapF, mapC, width, height)
+                writes += floor_writes
 
+            # No ceiling, and the row isn't covered by the wall
+            if index == -1 and screen_height - y < open_tops[x]:
+                color = ceiling_thickness_at(bank, row_distances, y, floor_starts[x], rx, ry, ray_dir_x0 + ray_step_x * x, ray_dir_y0 + ray_step_y * x, floor_texels_per_pixel, mapC, width, height)
+                if color == -1:
+                    color = skybox[sky_columns[x]][sky_rows[screen_height - y]]
+                buffer[x][screen_height - y] = color
+                writes += 1
 
-@njit(fastmath=True, parallel=True)#, cache=True)
-def render_walls_and_floors_optimized(buffer, zbuffer, pos_x, pos_y, mapW, mapF, mapC, width, height, tilesize, plane_x, plane_y, dir_x, dir_y):
+        row_writes[y] = writes
+
+@njit(fastmath=True, parallel=True, nogil=True, cache=True)
+def render_walls_and_floors_optimized(buffer, zbuffer, floor_starts, open_tops, column_writes, draw_floors, bank, row_distances, sky_columns, sky_rows, visible_tiles, explored_tiles, frame, pos_x, pos_y, mapW, mapF, mapC, width, height, tilesize, plane_x, plane_y, dir_x, dir_y):
     # Convert the position into a map position (still float)
     # And it will be the ray position
+    screen_width, screen_height = buffer.shape
+    texture_mips, colormap, skybox = bank.texture_mips, bank.colormap, bank.skybox
+
     rx = pos_x / tilesize
     ry = pos_y / tilesize
 
     wall_amplifier = WALL_AMPLIFIER
 
+    # Floor texels covered by a screen pixel, per unit of distance (used for the floor mip levels)
+    floor_texels_per_pixel = TEX_WIDTH * 2 * math.sqrt(plane_x * plane_x + plane_y * plane_y) / screen_width
+
     # Render walls
     # Enable parallelization in this iterator
     # THIS IMPROVED THE FPS BY 100 WHAT?????????????????????????
-    for x in nb.prange(WIDTH):
+    for x in nb.prange(screen_width):
         # Calculate camera x position
         # Goes from -1 to +1
         # X coordinate in camera space
-        camera_x = 2 * x / WIDTH - 1
+        camera_x = 2 * x / screen_width - 1
 
         # Get the ray direction and convert back to radians
         ray_dir_x = dir_x + plane_x * camera_x
         ray_dir_y = dir_y + plane_y * camera_x
 
-        # Calculate collision
-        tile_pos, perp_wall_dist, side = cast_ray_optimized(mapW, width, height, rx, ry, ray_dir_x, ray_dir_y)
+        # Calculate collision (and mark every tile the ray sees)
+        tile_pos, perp_wall_dist, side = cast_ray_visible(mapW, width, height, rx, ry, ray_dir_x, ray_dir_y, visible_tiles, explored_tiles, frame)
 
         # No intersection
         if side == -1:
+           zbuffer[x] = 1e30
+           floor_starts[x] = screen_height
+           open_tops[x] = int(screen_height / 2)
            continue
 
         # Get tile id / texture id
@@ -393,15 +890,15 @@ def render_walls_and_floors_optimized(buffer, zbuffer, pos_x, pos_y, mapW, mapF,
         
         # TEXTURED VERSION
         # Calculate height of the wall to draw on the screen
-        line_height = int((wall_amplifier * HEIGHT) / perp_wall_dist)
-        #line_height = int(HEIGHT / perp_wall_dist)
+        line_height = int((wall_amplifier * screen_height) / perp_wall_dist)
+        #line_height = int(screen_height / perp_wall_dist)
 
         # # Clamp values if they clip through the screen
-        line_start = -line_height / 2 + HEIGHT / 2
+        line_start = -line_height / 2 + screen_height / 2
         if (line_start < 0): line_start = 0
 
-        line_end   = line_height / 2 + HEIGHT / 2
-        if (line_end >= HEIGHT): line_end = HEIGHT - 1
+        line_end   = line_height / 2 + screen_height / 2
+        if (line_end >= screen_height): line_end = screen_height - 1
 
         # Get wall X in the camera space
         if (side == 0): 
@@ -421,37 +918,43 @@ def render_walls_and_floors_optimized(buffer, zbuffer, pos_x, pos_y, mapW, mapF,
         step = 1.0 * TEX_HEIGHT / line_height
 
         # Starting texture coordinate
-        texture_pos = (line_start - HEIGHT / 2 + line_height / 2) * step
+        texture_pos = (line_start - screen_height / 2 + line_height / 2) * step
 
         # calculate shade multiplication factor
         shade_multiplication_factor = 1
         if not DISABLE_SHADE:
             shade_multiplication_factor = min(max((1/(perp_wall_dist/2)), 0.1), 1)
 
+        # Make color darker for y sides
+        if (side == 1):
+            shade_multiplication_factor *= 0.5
+
+        # Colors of this stripe light level
+        shades = colormap[light_level(shade_multiplication_factor)]
+
+        # Mip level of the stripe (walls further away have more than a texel per pixel)
+        # Only the column of that level is sampled
+        level = mip_level(step)
+        mips = texture_mips[texture_id]
+        mip_column = MIP_OFFSETS[level] + (texture_x >> level) * (TEX_WIDTH >> level)
+
         # Now we render the texture to the buffer
         #render_line_to_buffer_optimized(buffer, step, texture_id, side, int(line_start), int(line_end), x, texture_pos, texture_x)
         # Extra wall height to compensate for ceiling thickness
         #texture_pos # LOOP the texture position back, so that the top of the wall withoute xtra thickness start at texture 0 position
 
+        open_top = int(line_start)
+        open_tops[x] = open_top
+        writes = max(int(line_end) - int(line_start), 0)
+
         for y in nb.prange(int(line_start), int(line_end)):
             # Cast the texture coordinate to integer and mask with (texHeight - 1) in case of overflow
             texture_y = int(texture_pos) & (TEX_HEIGHT - 1)
 
             texture_pos += step
 
-            # Get the color at that spot
-            color = textures.texture[texture_id][texture_x][texture_y]
-
-            # Add pixel to the buffer
-            # Make color darker for y sides (dividing each rgb value using a shift)
-            if (side == 1):
-                buffer[x][y] = textures.texure_halves[texture_id][texture_x][texture_y]#color // 2
-            else:
-                buffer[x][y] = color
-
-            # Add a shade for further away walls
-            if not DISABLE_SHADE:
-                buffer[x][y] = buffer[x][y] * shade_multiplication_factor
+            # Get the color at that spot (already shaded) and add it to the buffer
+            buffer[x][y] = shades[mips[mip_column + (texture_y >> level)]]
 
         # Render the floor
         # FLOOR CASTING (vertical version, directly after drawing the vertical wall stripe for the current x)
@@ -473,130 +976,98 @@ def render_walls_and_floors_optimized(buffer, zbuffer, pos_x, pos_y, mapW, mapF,
         dist_wall = perp_wall_dist
         dist_player = 0.0
 
-        if (line_end < 0): line_end = HEIGHT #becomes < 0 when the integer overflows
+        if (line_end < 0): line_end = screen_height #becomes < 0 when the integer overflows
+
+        # The horizontal floor pass draws it later, starting at this row
+        floor_starts[x] = int(line_end)
+        if not draw_floors:
+            column_writes[x] += writes
+            continue
 
         # Draw the floor from line end to the bottom of the screen
         # MUDEI ESSA LINHA
-        #for y in nb.prange(int(line_end) + 1, HEIGHT):
-        
+        #for y in nb.prange(int(line_end) + 1, screen_height):
+
+        # The rows above the wall get the ceiling, its thickness or the sky, every pixel is written once
+        # The thickness goes up from each ceiling pixel (and the closer ones cover the ones further away)
+        # So an open pixel gets the thickness of the last ceiling drawn at least 2 rows below it, when it's tall enough
+        # The one before it is kept for the pixel right above the last ceiling
+        sky_column = skybox[sky_columns[x]]
+        thickness_shades = colormap[QUARTER_LIGHT_LEVEL]
+        last_y, last_top, last_color = -1, 0, thickness_shades[0]
+        before_y, before_top, before_color = -1, 0, thickness_shades[0]
+
         # Draw the floor from line end to the bottom of the screen
-        for y in nb.prange(int(line_end), HEIGHT):
+        # The extra row (y = screen_height) has no floor, it's the first screen row
+        for y in range(int(line_end), screen_height + 1):
+            row = screen_height - y
 
             # Check division by zero also
-            #current_dist_calc = (2.0 * y - HEIGHT)
-            #current_dist = 1e30 if (current_dist_calc == 0) else HEIGHT / current_dist_calc
-            current_dist = current_distances_lookup[y]
+            #current_dist_calc = (2.0 * y - screen_height)
+            #current_dist = 1e30 if (current_dist_calc == 0) else screen_height / current_dist_calc
+            current_dist = row_distances[min(y, screen_height - 1)]
 
-            weight = (current_dist - dist_player) / (dist_wall - dist_player)
+            index = -1
+            if y < screen_height:
+                level = mip_level(current_dist * floor_texels_per_pixel)
 
-            current_floor_x = weight * floor_x_wall + (1.0 - weight) * rx
-            current_floor_y = weight * floor_y_wall + (1.0 - weight) * ry
+                weight = (current_dist - dist_player) / (dist_wall - dist_player)
 
-            floor_tex_x = int(current_floor_x * TEX_WIDTH) % TEX_WIDTH
-            floor_tex_y = int(current_floor_y * TEX_HEIGHT) % TEX_HEIGHT
+                current_floor_x = weight * floor_x_wall + (1.0 - weight) * rx
+                current_floor_y = weight * floor_y_wall + (1.0 - weight) * ry
 
-            current_floor_x = int(current_floor_x)
-            current_floor_y = int(current_floor_y)
+                # Draw the floor and the ceiling
+                index, floor_writes = draw_floor_and_ceiling(buffer, bank, x, y, current_floor_x, current_floor_y, level, mapF, mapC, width, height)
+                writes += floor_writes
 
-            # Color
-            if not (current_floor_x >= 0 and current_floor_x < width and current_floor_y >= 0 and current_floor_y < height):
+            if index != -1:
+                before_y, before_top, before_color = last_y, last_top, last_color
+                last_y = y
+                last_top = max(int((screen_height - y - CEILING_THICKNESS / current_dist)), 0)
+                last_color = thickness_shades[index]
                 continue
-        
-            texture_floor_id   = mapF[current_floor_y][current_floor_x] - 1
-            texture_ceiling_id = mapC[current_floor_y][current_floor_x] - 1
-
-            if texture_floor_id != -1:
-                # Render the floor
-                # Make the floor darker if there's ceiling above
-                if texture_ceiling_id == -1 and not DISABLE_FLOOR_SHDADOWS:
-                    buffer[x][y] = textures.texure_halves[texture_floor_id][floor_tex_x][floor_tex_y] + SKYBOX_HALF_LIGHT_COLOR
-                else:
-                    buffer[x][y] = textures.texure_halves[texture_floor_id][floor_tex_x][floor_tex_y]#textures.texture[texture_floor_id][floor_tex_x][floor_tex_y] // 2
-            
-            if texture_ceiling_id != -1:
-                # Ceiling
-                buffer[x][HEIGHT - y] = textures.texure_halves[texture_ceiling_id][floor_tex_x][floor_tex_y]#textures.texture[texture_ceiling_id][floor_tex_x][floor_tex_y] // 2
-
-                # Ceiling thickness?
-                if not (HEIGHT - y - 1) < 0:
-                    ceiling_thickness_start = max(int((HEIGHT - y - CEILING_THICKNESS / current_dist)), 0)
-                    buffer[x][ceiling_thickness_start:HEIGHT - y - 1] = textures.texture[texture_ceiling_id][floor_tex_x][floor_tex_y] // 4
+
+            # Covered by the wall
+            if row >= open_top:
+                continue
+
+            color = sky_column[sky_rows[row]]
+            if last_y != -1 and last_y < y - 1:
+                if last_top <= row:
+                    color = last_color
+            elif before_y != -1 and before_top <= row:
+                color = before_color
+
+            buffer[x][row] = color
+            writes += 1
+
+        column_writes[x] += writes
 
             #if not DISABLE_SHADE:
             #    buffer[x][y] = buffer[x][y] * shade_multiplication_factor
-#@profile
-@njit("Tuple((Tuple((int16, int16)), float64, uint8))(uint8[:,::1], uint8, uint8, float32, float32, float64, float64)", cache=True)
-#Tuple((Tuple(int32, int32), float64, uint8))
-# Requires 
-# mapW: Map walls
-# width, height: map width and height
-# rx, ry: Ray x and y position in the grid (in float)
-# Ray x and y direction
-def cast_ray_optimized(mapW, width, height, rx, ry, rdir_x, rdir_y):
-    # Distance to the wall
-    perp_wall_dist = -1
-
-    # Get which box of the map we are in
-    mx = int(rx)
-    my = int(ry)
-
-    # Distance to the wall (if the direction is straight then it's essentially infinite to that perpendicular direction)
-    delta_dist_x = 1e30 if (rdir_x == 0) else abs(1 / rdir_x)
-    delta_dist_y = 1e30 if (rdir_y == 0) else abs(1 / rdir_y)
-    
-    # Length of the ray from the current position to the next x or y side
-    side_dist_x = 0
-    side_dist_y = 0
-
-    hit = 0     # Was there a hit in a wall?
-    side = -1   # North/South or East/West hit
-
-    # Calculate step and initial side dist
-    step_x = 0
-    step_y = 0
-    # If the ray is going to the left, the step in the tile map is of -1, or else 1, same thing for up and down direction
-    # The distance is the ray position in float minus the fixed map grid position
-    # It's then multiplied to the nearest grid delta distance (So in the case of going to the left)
-    # If we are looking straight to the left almost touching the grid to the right, the distance will be of 1
-    if (rdir_x < 0):
-        step_x = -1
-        side_dist_x = (rx - mx) * delta_dist_x
-    else:
-        step_x = 1
-        side_dist_x = (mx + 1.0 - rx) * delta_dist_x
-
-    if (rdir_y < 0):
-        step_y = -1
-        side_dist_y = (ry - my) * delta_dist_y
-    else:
-        step_y = 1
-        side_dist_y = (my + 1.0 - ry) * delta_dist_y
-
-    # Perform DDA
-    while (hit == 0):
-        # Go to the next square either in the x or y direction
-        if (side_dist_x < side_dist_y): # Horizontal
-            side_dist_x += delta_dist_x
-            mx += step_x
-            side = 0
-        else: # Vertical
-            side_dist_y += delta_dist_y
-            my += step_y
-            side = 1
-
-        # If it's out of bounds then it won't collide with anything
+# Wall ray from (rx, ry) (in tiles, see game/dda.py), returns the wall tile it hits, the perpendicular distance to it and the side
+# (0 for an x side, 1 for a y side), or (-1, -1), -1, -1 if it leaves the map
+# Every tile it goes through (and the wall it hits) is stamped with frame in visible_tiles and marked in explored_tiles,
+# used by the wall pass so the visible tiles come for free with the walls
+@njit(cache=True)
+def cast_ray_visible(mapW, width, height, rx, ry, rdir_x, rdir_y, visible_tiles, explored_tiles, frame):
+    ray = dda.start(rx, ry, rdir_x, rdir_y)
+    mx, my = ray[0], ray[1]
+
+    # The tile the camera is in
+    if mx >= 0 and mx < width and my >= 0 and my < height:
+        visible_tiles[my][mx] = frame
+        explored_tiles[my][mx] = True
+
+    while True:
+        ray, side, perp_wall_dist = dda.step(ray)
+        mx, my = ray[0], ray[1]
+
         if not (mx >= 0 and mx < width and my >= 0 and my < height):
-            return (-1, -1), -1, -1
-        
-        # Check if a wall was hit
-        if mapW[my][mx] > 0:
-            hit = 1
+            return (-1, -1), -1.0, -1
 
-    # Calculate the distance to the wall
-    # WE WON'T USE EUCLIDEAN DISTANCE BECAUSE IT CAUSES FISH EYE EFFECT
-    if (side == 0):
-        perp_wall_dist = (side_dist_x - delta_dist_x)
-    else:
-        perp_wall_dist = (side_dist_y - delta_dist_y)
+        visible_tiles[my][mx] = frame
+        explored_tiles[my][mx] = True
 
-    return (mx, my), perp_wall_dist, side
+        if mapW[my][mx] > 0:
+            return (mx, my), perp_wall_dist, side
@@ -0,0 +1,439 @@
+import time
+import heapq
+import numpy as np
+import numba as nb
+from numba import njit
+from collections import namedtuple
+
+# Hierarchical pathfinding (HPA*)
+# The map is split in square clusters of CLUSTER_SIZE tiles. Where two clusters touch, every run of open tiles across
+# the border (an entrance) gets a pair of nodes, one on each side, linked with a cost of 1. Inside of every cluster the
+# steps between each pair of its nodes are worked out once (breadth first search that stays in the cluster)
+# A long search is then an A* over those few nodes, and only the clusters the route goes through are searched tile by tile
+# The paths are a bit longer than the shortest ones (they go through the entrance nodes), in exchange the search time
+# barely grows with the map size. Straight moves only, like the enemies
+# A wall change only changes the entrances on the borders of its cluster, so only that cluster and the ones next to it
+# are worked out again (see on_tile_changed)
+#
+# Usage:
+#   path = hpa.find_path(mapW, (x1, y1), (x2, y2)) # The graph is built the first time a map is searched
+#   hpa.get_graph(mapW, parallel=True)            # Build it ahead of time on every thread (Gamemap.load_level does)
+
+# Size of the clusters in tiles
+CLUSTER_SIZE = 16
+
+# Entrances this wide or wider get a node at each end instead of one in the middle
+# More nodes give shorter paths through wide openings, but a slower abstract search
+WIDE_ENTRANCE = 6
+
+DIRECTIONS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0)], dtype=np.int64)
+
+# Abstract graph, every cluster has max_nodes slots for its nodes, the node_counts[c] nodes of cluster c are
+# c * max_nodes to c * max_nodes + node_counts[c] in node_x and node_y
+# costs[n][j] are the steps from node n to the node j of its cluster (-1 if it can't get there without leaving it)
+# links[n] are the nodes next to n in other clusters, -1 if there's none (a corner tile can be in two entrances)
+# With a fixed place for every cluster a wall change only rewrites the clusters around it
+# The cluster of a tile is (y // cluster_size) * clusters_x + x // cluster_size
+Graph = namedtuple("Graph", ["cluster_size", "clusters_x", "clusters_y", "max_nodes", "node_counts", "node_x", "node_y",
+                             "costs", "links"])
+
+# Graph of the last map and the map it was built for
+graph = None
+graph_map = None
+
+# How long the last build, and the last update after a wall change took (in seconds)
+build_time = 0.0
+update_time = 0.0
+
+
+# Steps from (x, y) to every tile of the rectangle x0, y0 to x1, y1 (excluded) without leaving it
+# distances and parents are the size of the rectangle (row by row), -1 means it can't be reached
+@njit(nogil=True, cache=True)
+def search_cluster(mapW, x0, y0, x1, y1, x, y, distances, parents, queue):
+    width = x1 - x0
+    distances[:] = -1
+
+    if mapW[y][x] != 0:
+        return
+
+    start = (y - y0) * width + (x - x0)
+    distances[start] = 0
+    parents[start] = -1
+    queue[0] = start
+    head = 0
+    tail = 1
+
+    while head < tail:
+        tile = queue[head]
+        head += 1
+        tx = tile % width
+        ty = tile // width
+
+        for i in range(len(DIRECTIONS)):
+            nx = tx + DIRECTIONS[i][0]
+            ny = ty + DIRECTIONS[i][1]
+            if not (nx >= 0 and nx < width and ny >= 0 and ny < y1 - y0):
+                continue
+
+            child = ny * width + nx
+            if distances[child] != -1 or mapW[y0 + ny][x0 + nx] != 0:
+                continue
+
+            distances[child] = distances[tile] + 1
+            parents[child] = tile
+            queue[tail] = child
+            tail += 1
+
+# Steps between every pair of nodes of a cluster, written in their rows of costs
+@njit(nogil=True, cache=True)
+def search_cluster_costs(mapW, cluster_size, clusters_x, cluster, max_nodes, node_counts, node_x, node_y, costs):
+    height, width = mapW.shape
+    x0 = (cluster % clusters_x) * cluster_size
+    y0 = (cluster // clusters_x) * cluster_size
+    x1 = min(x0 + cluster_size, width)
+    y1 = min(y0 + cluster_size, height)
+
+    distances = np.zeros(((x1 - x0) * (y1 - y0)), dtype=np.int64)
+    parents = np.zeros_like(distances)
+    queue = np.zeros_like(distances)
+
+    first = cluster * max_nodes
+    count = node_counts[cluster]
+    for i in range(count):
+        search_cluster(mapW, x0, y0, x1, y1, node_x[first + i], node_y[first + i], distances, parents, queue)
+        for j in range(count):
+            costs[first + i][j] = distances[(node_y[first + j] - y0) * (x1 - x0) + node_x[first + j] - x0]
+
+# The same for a list of clusters, in parallel
+# Only used to build a whole graph when a level is loaded, before the render thread starts (see render_pipeline)
+@njit(parallel=True, cache=True)
+def build_cluster_costs(mapW, cluster_size, clusters_x, clusters, max_nodes, node_counts, node_x, node_y, costs):
+    for i in nb.prange(len(clusters)):
+        search_cluster_costs(mapW, cluster_size, clusters_x, clusters[i], max_nodes, node_counts, node_x, node_y, costs)
+
+# A* over the abstract graph, from the nodes with a start cost to the nodes with a goal cost (-1 means no link)
+# Returns the nodes of the route (empty if there's none)
+@njit(nogil=True, cache=True)
+def search_graph(max_nodes, node_counts, node_x, node_y, costs, links, start_costs, goal_costs, goal_x, goal_y):
+    nodes = len(node_x)
+    goal = nodes # Virtual node every node with a goal cost links to
+
+    g_costs = np.full((nodes + 1), np.inf)
+    parents = np.full((nodes + 1), -1, dtype=np.int64)
+    closed = np.zeros((nodes + 1), dtype=np.bool_)
+
+    # (f, node), the heuristic is the straight steps to the goal tile
+    heap = [(0.0, goal)]
+    heap.pop()
+    for n in range(nodes):
+        if start_costs[n] >= 0:
+            g_costs[n] = start_costs[n]
+            heapq.heappush(heap, (start_costs[n] + abs(node_x[n] - goal_x) + abs(node_y[n] - goal_y), n))
+
+    while len(heap) > 0:
+        _, n = heapq.heappop(heap)
+        if closed[n]:
+            continue
+        closed[n] = True
+
+        if n == goal:
+            break
+
+        if goal_costs[n] >= 0 and g_costs[n] + goal_costs[n] < g_costs[goal]:
+            g_costs[goal] = g_costs[n] + goal_costs[n]
+            parents[goal] = n
+            heapq.heappush(heap, (g_costs[goal], goal))
+
+        # The other nodes of its cluster, then the ones it's linked to
+        first = (n // max_nodes) * max_nodes
+        count = node_counts[n // max_nodes]
+        for e in range(count + 2):
+            if e < count:
+                child = first + e
+                cost = costs[n][e]
+                if cost <= 0:
+                    continue
+            else:
+                child = links[n][e - count]
+                cost = 1
+                if child == -1:
+                    continue
+
+            g = g_costs[n] + cost
+            if not closed[child] and g < g_costs[child]:
+                g_costs[child] = g
+                parents[child] = n
+                heapq.heappush(heap, (g + abs(node_x[child] - goal_x) + abs(node_y[child] - goal_y), child))
+
+    if not closed[goal]:
+        return np.zeros((0), dtype=np.int64)
+
+    count = 0
+    n = parents[goal]
+    while n != -1:
+        count += 1
+        n = parents[n]
+
+    route = np.zeros((count), dtype=np.int64)
+    n = parents[goal]
+    for i in range(count - 1, -1, -1):
+        route[i] = n
+        n = parents[n]
+    return route
+
+# Runs of open tiles across the border between two clusters, a and b are the tiles on each side ((x, y) functions of i)
+def add_entrances(mapW, positions, side_a, side_b, transitions):
+    run = []
+    for i in list(positions) + [None]:
+        if i is not None:
+            ax, ay = side_a(i)
+            bx, by = side_b(i)
+            if mapW[ay][ax] == 0 and mapW[by][bx] == 0:
+                run.append(i)
+                continue
+
+        if len(run) >= WIDE_ENTRANCE:
+            transitions.append((side_a(run[0]), side_b(run[0])))
+            transitions.append((side_a(run[-1]), side_b(run[-1])))
+        elif len(run) > 0:
+            middle = run[len(run) // 2]
+            transitions.append((side_a(middle), side_b(middle)))
+        run = []
+
+# Most nodes a border can have, the entrances are a tile apart at least, and a wide one needs WIDE_ENTRANCE tiles
+# for its two nodes
+def get_max_border_nodes(cluster_size):
+    return (cluster_size + 1) // 2 if WIDE_ENTRANCE >= 3 else cluster_size
+
+def get_cluster(graph, x, y):
+    return (y // graph.cluster_size) * graph.clusters_x + x // graph.cluster_size
+
+# The borders of a cluster as (cluster, side), every border belongs to the cluster on its left (side 0) or above it (side 1)
+def get_cluster_borders(graph, cluster):
+    borders = [(cluster, 0), (cluster, 1)]
+    if cluster % graph.clusters_x > 0:
+        borders.append((cluster - 1, 0))
+    if cluster // graph.clusters_x > 0:
+        borders.append((cluster - graph.clusters_x, 1))
+    return borders
+
+# Transitions ((x, y) in the cluster, (x, y) next to it in the other one) on the right (side 0) or bottom (side 1)
+# border of a cluster, none on the edges of the map
+def get_border_transitions(mapW, graph, cluster, side):
+    height, width = mapW.shape
+    size = graph.cluster_size
+    cx, cy = cluster % graph.clusters_x, cluster // graph.clusters_x
+    x0, y0 = cx * size, cy * size
+
+    transitions = []
+    if side == 0 and cx + 1 < graph.clusters_x:
+        x = x0 + size - 1
+        add_entrances(mapW, range(y0, min(y0 + size, height)), lambda y: (x, y), lambda y: (x + 1, y), transitions)
+    elif side == 1 and cy + 1 < graph.clusters_y:
+        y = y0 + size - 1
+        add_entrances(mapW, range(x0, min(x0 + size, width)), lambda x: (x, y), lambda x: (x, y + 1), transitions)
+    return transitions
+
+# Work out the nodes, links and costs of some clusters again, the other clusters keep theirs
+def update_clusters(mapW, graph, clusters, parallel=False):
+    max_nodes = graph.max_nodes
+    clusters = sorted(set(clusters))
+    updated = set(clusters)
+
+    borders = {border for cluster in clusters for border in get_cluster_borders(graph, cluster)}
+    transitions = [transition for border in borders for transition in get_border_transitions(mapW, graph, *border)]
+
+    # Nodes, every tile of a transition (sorted, so a cluster always gets the same order)
+    tiles = {cluster: set() for cluster in clusters}
+    for transition in transitions:
+        for x, y in transition:
+            cluster = get_cluster(graph, x, y)
+            if cluster in updated:
+                tiles[cluster].add((x, y))
+
+    # Links of every node being changed (plain lists, numpy is slow with a few items at a time)
+    node_ids = {}
+    node_links = {}
+    for cluster in clusters:
+        first = cluster * max_nodes
+        cluster_tiles = sorted(tiles[cluster])
+        count = len(cluster_tiles)
+
+        graph.node_counts[cluster] = count
+        graph.node_x[first:first + count] = [x for x, _ in cluster_tiles]
+        graph.node_y[first:first + count] = [y for _, y in cluster_tiles]
+        for i, tile in enumerate(cluster_tiles):
+            node_ids[tile] = first + i
+            node_links[first + i] = []
+
+    # The nodes of the clusters around keep their place, only their links to the updated clusters are done again
+    def get_node(tile):
+        if tile in node_ids:
+            return node_ids[tile]
+
+        cluster = get_cluster(graph, *tile)
+        first = cluster * max_nodes
+        count = graph.node_counts[cluster]
+        cluster_tiles = zip(graph.node_x[first:first + count].tolist(), graph.node_y[first:first + count].tolist())
+        node = first + list(cluster_tiles).index(tile)
+
+        node_ids[tile] = node
+        node_links[node] = [target for target in graph.links[node].tolist() if target != -1 and target // max_nodes not in updated]
+        return node
+
+    for a, b in transitions:
+        node_a, node_b = get_node(a), get_node(b)
+        if node_b not in node_links[node_a]:
+            node_links[node_a].append(node_b)
+            node_links[node_b].append(node_a)
+
+    for node, links in node_links.items():
+        graph.links[node] = links + [-1] * (2 - len(links))
+
+    clusters = np.array(clusters, dtype=np.int64)
+    if parallel:
+        build_cluster_costs(mapW, graph.cluster_size, graph.clusters_x, clusters, max_nodes, graph.node_counts,
+                            graph.node_x, graph.node_y, graph.costs)
+    else:
+        for cluster in clusters:
+            search_cluster_costs(mapW, graph.cluster_size, graph.clusters_x, cluster, max_nodes, graph.node_counts,
+                                 graph.node_x, graph.node_y, graph.costs)
+
+# Build the abstract graph of a wall map
+# parallel works the clusters out on every thread, only when no other thread runs parallel kernels (see render_pipeline)
+def build(mapW, parallel=False):
+    mapW = np.ascontiguousarray(mapW)
+    height, width = mapW.shape
+    size = CLUSTER_SIZE
+    clusters_x = (width + size - 1) // size
+    clusters_y = (height + size - 1) // size
+    clusters = clusters_x * clusters_y
+
+    max_nodes = 4 * get_max_border_nodes(size)
+    slots = clusters * max_nodes
+    graph = Graph(size, clusters_x, clusters_y, max_nodes,
+                  np.zeros((clusters), dtype=np.int64), np.zeros((slots), dtype=np.int64), np.zeros((slots), dtype=np.int64),
+                  np.full((slots, max_nodes), -1, dtype=np.int32), np.full((slots, 2), -1, dtype=np.int64))
+
+    update_clusters(mapW, graph, range(clusters), parallel)
+    return graph
+
+# Graph of a map, built if it's the first time
+# A search builds it serially (the AI jobs run next to the render thread), see build for parallel
+def get_graph(mapW, parallel=False):
+    global graph, graph_map, build_time
+
+    if mapW is not graph_map:
+        start = time.perf_counter()
+        graph = build(mapW, parallel)
+        build_time = time.perf_counter() - start
+        graph_map = mapW
+    return graph
+
+# Forget the graph of the last level, the tile changes of the new one aren't for it (see Gamemap.load_level)
+def clear():
+    global graph, graph_map
+    graph = None
+    graph_map = None
+
+# Listener of Gamemap.set_tile (the map is changed in place), the cluster of the tile and the ones next to it
+# get their entrances and costs again
+def on_tile_changed(x, y, old_tile, new_tile):
+    global update_time
+
+    if graph_map is None or (old_tile == 0) == (new_tile == 0):
+        return
+
+    start = time.perf_counter()
+    cx, cy = x // graph.cluster_size, y // graph.cluster_size
+    clusters = []
+    for nx, ny in ((cx, cy), (cx - 1, cy), (cx + 1, cy), (cx, cy - 1), (cx, cy + 1)):
+        if nx >= 0 and nx < graph.clusters_x and ny >= 0 and ny < graph.clusters_y:
+            clusters.append(ny * graph.clusters_x + nx)
+
+    update_clusters(graph_map, graph, clusters)
+    update_time = time.perf_counter() - start
+
+# Rectangle of the cluster a tile is in
+def get_cluster_rect(mapW, graph, x, y):
+    height, width = mapW.shape
+    x0 = (x // graph.cluster_size) * graph.cluster_size
+    y0 = (y // graph.cluster_size) * graph.cluster_size
+    return x0, y0, min(x0 + graph.cluster_size, width), min(y0 + graph.cluster_size, height)
+
+# Search from a tile inside of its cluster, returns the rectangle and the distances and parents of search_cluster
+def search_from(mapW, graph, x, y):
+    x0, y0, x1, y1 = rect = get_cluster_rect(mapW, graph, x, y)
+    distances = np.zeros(((x1 - x0) * (y1 - y0)), dtype=np.int64)
+    parents = np.zeros_like(distances)
+    search_cluster(mapW, x0, y0, x1, y1, x, y, distances, parents, np.zeros_like(distances))
+    return rect, distances, parents
+
+# Tiles from the search start to (x, y), start and end included
+def get_cluster_path(rect, parents, x, y):
+    x0, y0, x1, y1 = rect
+    width = x1 - x0
+    path = []
+    tile = (y - y0) * width + (x - x0)
+    while tile != -1:
+        path.append((x0 + tile % width, y0 + tile // width))
+        tile = parents[tile]
+    return path[::-1]
+
+# Costs from a tile to the nodes of its cluster (-1 for the other nodes)
+def get_node_costs(graph, rect, distances, x, y):
+    x0, y0, x1, y1 = rect
+    cluster = get_cluster(graph, x, y)
+    first = cluster * graph.max_nodes
+    last = first + graph.node_counts[cluster]
+
+    costs = np.full((len(graph.node_x)), -1.0)
+    nodes = distances[(graph.node_y[first:last] - y0) * (x1 - x0) + graph.node_x[first:last] - x0]
+    costs[first:last] = np.where(nodes >= 0, nodes, -1)
+    return costs
+
+# Find a path from start to end (x, y tiles), returns a list of x, y tiles, start and end included, empty if there's none
+def find_path(mapW, start, end):
+    graph = get_graph(mapW)
+    x1, y1 = int(start[0]), int(start[1])
+    x2, y2 = int(end[0]), int(end[1])
+    height, width = mapW.shape
+
+    if not (x1 >= 0 and x1 < width and y1 >= 0 and y1 < height and x2 >= 0 and x2 < width and y2 >= 0 and y2 < height):
+        return []
+    if mapW[y1][x1] != 0 or mapW[y2][x2] != 0:
+        return []
+
+    start_rect, start_distances, start_parents = search_from(mapW, graph, x1, y1)
+
+    # In the same cluster, and it can get there without leaving it
+    if get_cluster_rect(mapW, graph, x2, y2) == start_rect:
+        x0, y0, x3, _ = start_rect
+        if start_distances[(y2 - y0) * (x3 - x0) + x2 - x0] != -1:
+            return get_cluster_path(start_rect, start_parents, x2, y2)
+
+    # The searches from the start and from the end link them to the nodes of their clusters
+    end_rect, end_distances, end_parents = search_from(mapW, graph, x2, y2)
+    start_costs = get_node_costs(graph, start_rect, start_distances, x1, y1)
+    goal_costs = get_node_costs(graph, end_rect, end_distances, x2, y2)
+
+    route = search_graph(graph.max_nodes, graph.node_counts, graph.node_x, graph.node_y, graph.costs, graph.links,
+                         start_costs, goal_costs, x2, y2).tolist()
+    if len(route) == 0:
+        return []
+
+    # Tile by tile, only inside of the clusters the route goes through
+    node_x, node_y = graph.node_x, graph.node_y
+    path = get_cluster_path(start_rect, start_parents, node_x[route[0]], node_y[route[0]])
+    for a, b in zip(route[:-1], route[1:]):
+        ax, ay, bx, by = int(node_x[a]), int(node_y[a]), int(node_x[b]), int(node_y[b])
+        rect = get_cluster_rect(mapW, graph, ax, ay)
+        if rect == get_cluster_rect(mapW, graph, bx, by):
+            rect, _, parents = search_from(mapW, graph, ax, ay)
+            path += get_cluster_path(rect, parents, bx, by)[1:]
+        else:
+            path.append((bx, by))
+
+    # The search from the end goes backwards
+    path += get_cluster_path(end_rect, end_parents, node_x[route[-1]], node_y[route[-1]])[::-1][1:]
+    return [(int(x), int(y)) for x, y in path]
@@ -0,0 +1,48 @@
+import time
+import numba
+
+# Numba kernel warm up
+# Every kernel is compiled with cache=True, so numba saves the machine code on disk (__pycache__) after the first compile
+# Compiling a kernel for the same types the game calls it with either loads it from that cache or compiles it
+# Only the first launch (or the first one after changing a kernel) pays the compile time
+# It can be done from a background thread, as long as start_threads was called by the main thread before
+#
+# Usage:
+#   jit_cache.start_threads()
+#   report = [jit_cache.warm_up(kernel, args...), ...]
+#   jit_cache.print_report(report)
+
+# Start the numba threading layer (used by the parallel kernels) in this thread
+# Compiling a parallel kernel starts it too, and when that happens in a background thread the game can hang on exit
+def start_threads():
+    numba.get_num_threads()
+
+# Compile a kernel for the types of args, returns its name, how long it took (in seconds) and where it came from:
+#   "cache":    loaded from the disk cache
+#   "compiled": compiled now (and saved to the cache)
+#   "ready":    it was already loaded in this process
+def warm_up(kernel, *args):
+    hits = sum(kernel.stats.cache_hits.values())
+    misses = sum(kernel.stats.cache_misses.values())
+
+    start = time.perf_counter()
+    kernel.compile(tuple(numba.typeof(arg) for arg in args))
+    elapsed = time.perf_counter() - start
+
+    if sum(kernel.stats.cache_misses.values()) > misses:
+        source = "compiled"
+    elif sum(kernel.stats.cache_hits.values()) > hits:
+        source = "cache"
+    else:
+        source = "ready"
+
+    return kernel.__name__, elapsed, source
+
+# Print the warm up of every kernel and the totals
+def print_report(report):
+    for name, elapsed, source in report:
+        print(f"    {name:<36} {elapsed * 1000:>9.1f}ms  {source}")
+
+    compile_time = sum(elapsed for _, elapsed, source in report if source == "compiled")
+    cache_hits = sum(1 for _, _, source in report if source == "cache")
+    print(f"Kernels ready: {cache_hits}/{len(report)} from the cache, {compile_time:.2f}s compiling")
@@ -0,0 +1,70 @@
+import math
+import numpy as np
+from numba import njit
+import game.dda as dda
+
+# Batched line of sight
+# Every segment from origins[i] to targets[i] walks the wall map with a DDA (like the wall rays, see game/dda.py) in one kernel call,
+# so checking what every enemy can see costs one call instead of one python ray per enemy
+# It's serial, it runs on the main thread while the render thread is running its parallel kernels (see render_pipeline)
+# The segments end at the target, walls behind it don't count
+#
+# Usage:
+#   blocked, hit_tiles, distances = line_of_sight.cast(mapW, tilesize, origins, targets) # (n, 2) arrays in world units
+
+
+# blocked[i]: a wall is in the way, hit_tiles[i]: that wall tile (-1, -1 if none)
+# distances[i]: distance to the wall, or to the target when nothing is in the way (in tiles)
+@njit(nogil=True, cache=True)
+def cast_segments(mapW, origins, targets, blocked, hit_tiles, distances):
+    height, width = mapW.shape
+
+    for i in range(len(origins)):
+        rx, ry = origins[i][0], origins[i][1]
+        dx, dy = targets[i][0] - rx, targets[i][1] - ry
+        length = math.sqrt(dx * dx + dy * dy)
+
+        ray = dda.start(rx, ry, dx, dy)
+        mx, my = ray[0], ray[1]
+
+        blocked[i] = False
+        hit_tiles[i][0] = -1
+        hit_tiles[i][1] = -1
+        distances[i] = length
+
+        # Starting inside of a wall
+        if mx >= 0 and mx < width and my >= 0 and my < height and mapW[my][mx] > 0:
+            blocked[i] = True
+            hit_tiles[i][0] = mx
+            hit_tiles[i][1] = my
+            distances[i] = 0.0
+            continue
+
+        # The distances are in parts of the segment, 1 is the target
+        while True:
+            ray, _, t = dda.step(ray)
+            mx, my = ray[0], ray[1]
+
+            # Got to the target
+            if t > 1:
+                break
+
+            # Outside of the map there's nothing to hit, but the segment can come back into it
+            if mx >= 0 and mx < width and my >= 0 and my < height and mapW[my][mx] > 0:
+                blocked[i] = True
+                hit_tiles[i][0] = mx
+                hit_tiles[i][1] = my
+                distances[i] = t * length
+                break
+
+# Cast every segment from origins to targets ((n, 2) arrays of world positions)
+# Returns blocked (n), hit_tiles (n, 2) and distances (n) in world units, see cast_segments
+def cast(mapW, tilesize, origins, targets):
+    count = len(origins)
+    blocked = np.zeros((count), dtype=np.bool_)
+    hit_tiles = np.zeros((count, 2), dtype=np.int64)
+    distances = np.zeros((count))
+
+    cast_segments(mapW, np.asarray(origins, dtype=np.float64) / tilesize, np.asarray(targets, dtype=np.float64) / tilesize,
+                  blocked, hit_tiles, distances)
+    return blocked, hit_tiles, distances * tilesize
@@ -1,8 +1,406 @@
+import math
+import heapq
+import numpy as np
+from numba import njit
+from collections import namedtuple, OrderedDict
 from game.world import World
+import game.hpa as hpa
 
 # This uses A* Algorithm
 # Thanks: https://medium.com/@nicholas.w.swift/easy-a-star-pathfinding-7e6689c7f7b2
 
+# Search engine used by PathFinder.search_path
+# "numba":        A* compiled with numba, on mapW directly (see find_path), hierarchical on big maps
+# "hierarchical": always hierarchical (see game/hpa.py), only for straight moves, with diagonals it's the numba A*
+# "legacy":       the original python A*, kept to compare against (see benchmark_pathfinding.py)
+ENGINE = "numba"
+
+# Maps this wide or tall (in tiles) use the hierarchical search for straight moves, -1 to never use it
+# On smaller maps the flat A* is as fast, and finds the shortest paths
+HIERARCHICAL_MIN_SIZE = 512
+
+# Jump point search, only used with diagonals
+# It skips the straight runs of open tiles and only puts the tiles where the path can turn in the heap
+# Fewer tiles are expanded, but on big open areas the jumps scan the same runs over and over and it ends up slower
+# (python benchmark_pathfinding.py compares both)
+JUMP_POINT_SEARCH = False
+
+# Tiles around the start and the end (their bounding box) a search can go through, -1 for the whole map
+# Keeps long searches on big maps bounded, but paths that need to go around further than that aren't found
+SEARCH_WINDOW = -1
+
+SQRT2 = math.sqrt(2)
+
+# All possible direction of movements, the first 4 are the straight ones
+DIRECTIONS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)], dtype=np.int64)
+
+# Scratch grids of the numba search, one cell per tile (index y * width + x)
+# The stamps say which cells belong to the current search, so they never need to be cleared
+g_costs = np.zeros((0))                # Cost from the start
+parents = np.zeros((0), dtype=np.int64) # Previous tile of the path (or jump point)
+opened  = np.zeros((0), dtype=np.int64) # Search id when the cell was put in the heap
+closed  = np.zeros((0), dtype=np.int64) # Search id when the cell was expanded
+search_id = 0
+
+# Tiles expanded by the last search
+last_expansions = 0
+
+# Path cache
+# Enemies ask for the same paths over and over (the same patrol tiles to the same player tile), so the paths found are
+# kept by (start tile, end tile, allow_diagonals) and the least recently used one is dropped when it's full
+# When the walls change (Gamemap.set_tile) only the paths the change can affect are dropped (see on_tile_changed)
+PATH_CACHE = True
+PATH_CACHE_SIZE = 512
+
+# path: tuple of x, y tiles (empty if there was none), tiles: the same as a set, cost: length of the path
+CachedPath = namedtuple("CachedPath", ["path", "tiles", "cost"])
+
+path_cache = OrderedDict()
+cache_map = None # mapW the cached paths were found on, another map (a level was loaded) empties the cache
+cache_hits = 0
+cache_misses = 0
+
+
+@njit(cache=True)
+def is_walkable(mapW, x, y, min_x, min_y, max_x, max_y):
+    return x >= min_x and x <= max_x and y >= min_y and y <= max_y and mapW[y][x] == 0
+
+# Cost of the shortest path between two tiles without walls, admissible
+@njit(cache=True)
+def heuristic(dx, dy, allow_diagonals):
+    dx = abs(dx)
+    dy = abs(dy)
+    if allow_diagonals:
+        return max(dx, dy) + (SQRT2 - 1) * min(dx, dy) # Octile
+    return dx + dy # Manhattan
+
+# Jump straight (dx or dy is 0) from x, y, returns the jump point or (-1, -1) when there's none
+# A jump point is the end, or a tile with an open side that was closed in the tile before it (the path can turn there)
+@njit(cache=True)
+def jump_straight(mapW, x, y, dx, dy, end_x, end_y, min_x, min_y, max_x, max_y):
+    while True:
+        if not is_walkable(mapW, x, y, min_x, min_y, max_x, max_y):
+            return -1, -1
+
+        if x == end_x and y == end_y:
+            return x, y
+
+        if dx != 0:
+            if (is_walkable(mapW, x, y - 1, min_x, min_y, max_x, max_y) and not is_walkable(mapW, x - dx, y - 1, min_x, min_y, max_x, max_y)) or \
+               (is_walkable(mapW, x, y + 1, min_x, min_y, max_x, max_y) and not is_walkable(mapW, x - dx, y + 1, min_x, min_y, max_x, max_y)):
+                return x, y
+        else:
+            if (is_walkable(mapW, x - 1, y, min_x, min_y, max_x, max_y) and not is_walkable(mapW, x - 1, y - dy, min_x, min_y, max_x, max_y)) or \
+               (is_walkable(mapW, x + 1, y, min_x, min_y, max_x, max_y) and not is_walkable(mapW, x + 1, y - dy, min_x, min_y, max_x, max_y)):
+                return x, y
+
+        x += dx
+        y += dy
+
+# Jump from x, y in any direction, returns the jump point or (-1, -1)
+# Diagonally a tile is a jump point when one of the straight jumps from it finds one
+# Diagonal moves can't cut corners, both straight tiles next to them have to be open
+@njit(cache=True)
+def jump(mapW, x, y, dx, dy, end_x, end_y, min_x, min_y, max_x, max_y):
+    if dx == 0 or dy == 0:
+        return jump_straight(mapW, x, y, dx, dy, end_x, end_y, min_x, min_y, max_x, max_y)
+
+    while True:
+        if not is_walkable(mapW, x, y, min_x, min_y, max_x, max_y):
+            return -1, -1
+
+        if x == end_x and y == end_y:
+            return x, y
+
+        if jump_straight(mapW, x + dx, y, dx, 0, end_x, end_y, min_x, min_y, max_x, max_y)[0] != -1 or \
+           jump_straight(mapW, x, y + dy, 0, dy, end_x, end_y, min_x, min_y, max_x, max_y)[0] != -1:
+            return x, y
+
+        if not (is_walkable(mapW, x + dx, y, min_x, min_y, max_x, max_y) and is_walkable(mapW, x, y + dy, min_x, min_y, max_x, max_y)):
+            return -1, -1
+
+        x += dx
+        y += dy
+
+# A* from (x1, y1) to (x2, y2) on the wall map, with a binary heap as the open set and flat grids for the costs
+# Returns the path (array of x, y tiles, start and end included, empty if there's none) and how many tiles were expanded
+# window: tiles around the bounding box of the start and the end the search can use (-1 for the whole map)
+# max_expansions: give up after expanding that many tiles (-1 for no limit)
+@njit(nogil=True, cache=True)
+def astar(mapW, x1, y1, x2, y2, allow_diagonals, jump_points, window, max_expansions, g_costs, parents, opened, closed, search_id):
+    height, width = mapW.shape
+    no_path = np.zeros((0, 2), dtype=np.int64)
+
+    if window >= 0:
+        min_x, max_x = max(min(x1, x2) - window, 0), min(max(x1, x2) + window, width - 1)
+        min_y, max_y = max(min(y1, y2) - window, 0), min(max(y1, y2) + window, height - 1)
+    else:
+        min_x, max_x, min_y, max_y = 0, width - 1, 0, height - 1
+
+    if not (is_walkable(mapW, x1, y1, min_x, min_y, max_x, max_y) and is_walkable(mapW, x2, y2, min_x, min_y, max_x, max_y)):
+        return no_path, 0
+
+    jump_points = jump_points and allow_diagonals
+    directions_count = 8 if allow_diagonals else 4
+
+    start = y1 * width + x1
+    end = y2 * width + x2
+
+    g_costs[start] = 0.0
+    parents[start] = -1
+    opened[start] = search_id
+
+    # (f, h, tile), the h breaks ties towards the end
+    h = heuristic(x2 - x1, y2 - y1, allow_diagonals)
+    heap = [(h, h, start)]
+
+    # Directions to try from the current tile
+    next_directions = np.zeros((8, 2), dtype=np.int64)
+
+    expansions = 0
+    while len(heap) > 0:
+        _, _, tile = heapq.heappop(heap)
+
+        # Already expanded with a lower cost (the heap keeps the old entries)
+        if closed[tile] == search_id:
+            continue
+        closed[tile] = search_id
+
+        if tile == end:
+            break
+
+        expansions += 1
+        if max_expansions >= 0 and expansions > max_expansions:
+            return no_path, expansions
+
+        x = tile % width
+        y = tile // width
+
+        # Directions, jump point search only follows the ones the path could need coming from the parent
+        count = 0
+        parent = parents[tile]
+        if jump_points and parent != -1:
+            dx = np.sign(x - parent % width)
+            dy = np.sign(y - parent // width)
+            if dx != 0 and dy != 0:
+                open_y = is_walkable(mapW, x, y + dy, min_x, min_y, max_x, max_y)
+                open_x = is_walkable(mapW, x + dx, y, min_x, min_y, max_x, max_y)
+                if open_y:
+                    next_directions[count] = (0, dy)
+                    count += 1
+                if open_x:
+                    next_directions[count] = (dx, 0)
+                    count += 1
+                if open_x and open_y:
+                    next_directions[count] = (dx, dy)
+                    count += 1
+            elif dx != 0:
+                open_next = is_walkable(mapW, x + dx, y, min_x, min_y, max_x, max_y)
+                open_down = is_walkable(mapW, x, y + 1, min_x, min_y, max_x, max_y)
+                open_up = is_walkable(mapW, x, y - 1, min_x, min_y, max_x, max_y)
+                if open_next:
+                    next_directions[count] = (dx, 0)
+                    count += 1
+                    if open_down:
+                        next_directions[count] = (dx, 1)
+                        count += 1
+                    if open_up:
+                        next_directions[count] = (dx, -1)
+                        count += 1
+                if open_down:
+                    next_directions[count] = (0, 1)
+                    count += 1
+                if open_up:
+                    next_directions[count] = (0, -1)
+                    count += 1
+            else:
+                open_next = is_walkable(mapW, x, y + dy, min_x, min_y, max_x, max_y)
+                open_right = is_walkable(mapW, x + 1, y, min_x, min_y, max_x, max_y)
+                open_left = is_walkable(mapW, x - 1, y, min_x, min_y, max_x, max_y)
+                if open_next:
+                    next_directions[count] = (0, dy)
+                    count += 1
+                    if open_right:
+                        next_directions[count] = (1, dy)
+                        count += 1
+                    if open_left:
+                        next_directions[count] = (-1, dy)
+                        count += 1
+                if open_right:
+                    next_directions[count] = (1, 0)
+                    count += 1
+                if open_left:
+                    next_directions[count] = (-1, 0)
+                    count += 1
+        else:
+            for i in range(directions_count):
+                dx, dy = DIRECTIONS[i][0], DIRECTIONS[i][1]
+                # No cutting corners
+                if dx != 0 and dy != 0 and not (is_walkable(mapW, x + dx, y, min_x, min_y, max_x, max_y) and is_walkable(mapW, x, y + dy, min_x, min_y, max_x, max_y)):
+                    continue
+                next_directions[count] = (dx, dy)
+                count += 1
+
+        for i in range(count):
+            dx, dy = next_directions[i][0], next_directions[i][1]
+
+            if jump_points:
+                nx, ny = jump(mapW, x + dx, y + dy, dx, dy, x2, y2, min_x, min_y, max_x, max_y)
+                if nx == -1:
+                    continue
+            else:
+                nx, ny = x + dx, y + dy
+                if not is_walkable(mapW, nx, ny, min_x, min_y, max_x, max_y):
+                    continue
+
+            child = ny * width + nx
+            if closed[child] == search_id:
+                continue
+
+            g = g_costs[tile] + heuristic(nx - x, ny - y, True) # Straight or diagonal runs, octile is the exact cost
+            if opened[child] != search_id or g < g_costs[child]:
+                opened[child] = search_id
+                g_costs[child] = g
+                parents[child] = tile
+                h = heuristic(x2 - nx, y2 - ny, allow_diagonals)
+                heapq.heappush(heap, (g + h, h, child))
+
+    if closed[end] != search_id:
+        return no_path, expansions
+
+    # Walk the parents back, jump points are filled with the tiles between them
+    length = 1
+    tile = end
+    while parents[tile] != -1:
+        parent = parents[tile]
+        length += max(abs(tile % width - parent % width), abs(tile // width - parent // width))
+        tile = parent
+
+    path = np.zeros((length, 2), dtype=np.int64)
+    i = length - 1
+    tile = end
+    path[i] = (tile % width, tile // width)
+    while parents[tile] != -1:
+        parent = parents[tile]
+        x, y = tile % width, tile // width
+        dx = np.sign(parent % width - x)
+        dy = np.sign(parent // width - y)
+        while tile != parent:
+            x += dx
+            y += dy
+            tile = y * width + x
+            i -= 1
+            path[i] = (x, y)
+
+    return path, expansions
+
+# Find a path on a wall map (tiles with 0 are open) from start to end (x, y tiles) with the numba A*
+# Returns an array of x, y tiles, start and end included, empty if there's no path
+# jump_points and window default to JUMP_POINT_SEARCH and SEARCH_WINDOW
+def find_path(mapW, start, end, allow_diagonals=False, jump_points=None, window=None, max_expansions=-1):
+    global g_costs, parents, opened, closed, search_id, last_expansions
+
+    if jump_points is None:
+        jump_points = JUMP_POINT_SEARCH
+    if window is None:
+        window = SEARCH_WINDOW
+
+    if len(g_costs) != mapW.size:
+        g_costs = np.zeros((mapW.size))
+        parents = np.zeros((mapW.size), dtype=np.int64)
+        opened = np.zeros((mapW.size), dtype=np.int64)
+        closed = np.zeros((mapW.size), dtype=np.int64)
+        search_id = 0
+
+    search_id += 1
+    path, last_expansions = astar(mapW, int(start[0]), int(start[1]), int(end[0]), int(end[1]), allow_diagonals, jump_points,
+                                  window, max_expansions, g_costs, parents, opened, closed, search_id)
+    return path
+
+# Cost of a path, 1 per straight step and sqrt(2) per diagonal one
+def get_path_cost(path):
+    cost = 0.0
+    for (x1, y1), (x2, y2) in zip(path[:-1], path[1:]):
+        cost += SQRT2 if x1 != x2 and y1 != y2 else 1.0
+    return cost
+
+# Cached path for key (start tile, end tile, allow_diagonals), None if it isn't cached
+def get_cached_path(mapW, key):
+    global cache_map, cache_hits, cache_misses
+
+    if mapW is not cache_map:
+        clear_path_cache()
+        cache_map = mapW
+
+    cached = path_cache.get(key)
+    if cached is None:
+        cache_misses += 1
+        return None
+
+    cache_hits += 1
+    path_cache.move_to_end(key)
+    return cached.path
+
+def cache_path(mapW, key, path):
+    global cache_map
+
+    if mapW is not cache_map:
+        clear_path_cache()
+        cache_map = mapW
+
+    path = tuple(path)
+    path_cache[key] = CachedPath(path, frozenset(path), get_path_cost(path))
+    path_cache.move_to_end(key)
+    while len(path_cache) > PATH_CACHE_SIZE:
+        path_cache.popitem(last=False)
+
+def clear_path_cache():
+    path_cache.clear()
+
+def get_cache_stats():
+    lookups = cache_hits + cache_misses
+    return {
+        "size": len(path_cache),
+        "hits": cache_hits,
+        "misses": cache_misses,
+        "hit_rate": 0.0 if lookups == 0 else cache_hits / lookups,
+    }
+
+# Drop the cached paths a wall change can affect (listener of Gamemap.set_tile)
+# A new wall only breaks the paths that go through it (or, with diagonals, cut the corner next to it)
+# An opened tile can only make a path shorter if going through it could be: start -> tile -> end at least
+# costs the heuristic both ways, so paths already cheaper than that stay. Paths that weren't found are all dropped
+def on_tile_changed(x, y, old_tile, new_tile):
+    if (old_tile == 0) == (new_tile == 0):
+        return
+
+    blocked = new_tile != 0
+    for key, cached in list(path_cache.items()):
+        (x1, y1), (x2, y2), allow_diagonals = key
+
+        if blocked:
+            if allow_diagonals:
+                affected = any((x + dx, y + dy) in cached.tiles for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+            else:
+                affected = (x, y) in cached.tiles
+        elif len(cached.path) == 0:
+            affected = True
+        else:
+            # A diagonal step can use the tile as a corner without going through it, from a tile next to it
+            bound = heuristic(x - x1, y - y1, allow_diagonals) + heuristic(x2 - x, y2 - y, allow_diagonals)
+            if allow_diagonals:
+                bound -= 2 * SQRT2
+            affected = bound < cached.cost
+
+        if affected:
+            del path_cache[key]
+
+# Are the straight moves on this map searched hierarchically? (see ENGINE and HIERARCHICAL_MIN_SIZE)
+def uses_hierarchical(mapW):
+    if ENGINE == "legacy":
+        return False
+    return ENGINE == "hierarchical" or (HIERARCHICAL_MIN_SIZE != -1 and max(mapW.shape) >= HIERARCHICAL_MIN_SIZE)
+
 class PathFinder:
 
     class Node:
@@ -30,7 +428,33 @@ class PathFinder:
         self.gamemap = World.gamemap
         self.linked_entity = linked_entity # If there's a link, it will always start searching from the entity map position
 
+    # Find a path from start_pos (or the linked entity tile) to end_pos, returns a list of x, y tiles
     def search_path(self, end_pos, start_pos=None, allow_diagonals=False):
+        if start_pos is None:
+            start_pos = self.linked_entity.get_map_pos()
+
+        mapW = self.gamemap.mapW
+        key = ((int(start_pos[0]), int(start_pos[1])), (int(end_pos[0]), int(end_pos[1])), allow_diagonals)
+        if PATH_CACHE:
+            cached = get_cached_path(mapW, key)
+            if cached is not None:
+                self.path_found = list(cached)
+                return self.path_found
+
+        if ENGINE == "legacy":
+            self.path_found = self.legacy_search_path(end_pos, start_pos, allow_diagonals)
+        elif not allow_diagonals and uses_hierarchical(mapW):
+            self.path_found = hpa.find_path(mapW, start_pos, end_pos)
+        else:
+            path = find_path(mapW, start_pos, end_pos, allow_diagonals)
+            self.path_found = [tuple(tile) for tile in path.tolist()]
+
+        if PATH_CACHE:
+            cache_path(mapW, key, self.path_found)
+        return self.path_found
+
+    # The original A*, the open and closed lists are scanned for every node
+    def legacy_search_path(self, end_pos, start_pos=None, allow_diagonals=False):
         x2, y2 = end_pos
         x2, y2 = int(x2), int(y2)
 
@@ -5,6 +5,8 @@ from game.entity import *
 
 class Player(Entity):
 
+    __slots__ = ("allow_mouse_movement", "state", "footsteps_sound", "footstep_sound_timer_start", "footstep_sound_timer")
+
     def __init__(self, pos=..., angle=0) -> None:
         super().__init__(pos, angle)
         Camera.look_at(self.angle)
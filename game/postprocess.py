@@ -0,0 +1,179 @@
+import pygame
+import numpy as np
+import numba as nb
+from numba import njit
+import game.jit_cache as jit_cache
+
+# Output stage
+# Upscales the game surface into the window (nearest neighbour) and applies the post processing in the same pass
+# So the frame is read and written only once, and nothing is allocated per frame
+
+# Fog, blends far away pixels into the fog color (distances in tiles)
+FOG = False
+FOG_COLOR = (0, 0, 0)
+FOG_START = 4
+FOG_END = 16
+
+# Gamma correction (1 means no correction)
+GAMMA = 1.0
+
+# Darken the corners of the screen, 0 is disabled and 1 is the strongest
+VIGNETTE = 0.0
+
+# Packed layout of the game surface (see textures.pack_rgb)
+PACKED_MASKS = (0xFF0000, 0x00FF00, 0x0000FF)
+
+# Look up tables, they are only rebuilt when the sizes or the settings change
+lookup_key = None
+col_starts = None
+row_starts = None
+gamma_lookup = None
+vignette_x = None
+vignette_y = None
+
+# Used when the window can't be written directly
+scaled_surface = None
+
+
+# Build the look up tables for a source and destination size
+def build_lookups(src_size, dst_size):
+    global lookup_key, col_starts, row_starts, gamma_lookup, vignette_x, vignette_y
+
+    key = (src_size, dst_size, GAMMA, VIGNETTE)
+    if key == lookup_key:
+        return
+    lookup_key = key
+
+    src_width, src_height = src_size
+    dst_width, dst_height = dst_size
+
+    # First destination column/row of every source column/row (nearest neighbour)
+    # The last entry is the destination size, so source pixel i covers [starts[i], starts[i + 1])
+    col_starts = np.ceil(np.arange(src_width + 1) * dst_width / src_width).astype(np.int64)
+    row_starts = np.ceil(np.arange(src_height + 1) * dst_height / src_height).astype(np.int64)
+
+    gamma_lookup = (255 * (np.arange(256) / 255) ** (1 / GAMMA)).astype(np.uint8)
+
+    # The vignette is separable, a column factor times a row factor
+    vignette_x = 1 - VIGNETTE * np.linspace(-1, 1, src_width) ** 2
+    vignette_y = 1 - VIGNETTE * np.linspace(-1, 1, src_height) ** 2
+
+
+# Draw the game surface into the window
+# zbuffer and row_distances are the wall distance of each column and the floor distance of each row, used by the fog
+def present(game_surface: pygame.Surface, window: pygame.Surface, zbuffer, row_distances):
+    global scaled_surface
+
+    # Only 32 bit surfaces can be written word by word
+    if window.get_bitsize() != 32 or game_surface.get_bitsize() != 32 or game_surface.get_masks()[:3] != PACKED_MASKS:
+        if scaled_surface is None or scaled_surface.get_size() != window.get_size():
+            scaled_surface = pygame.surface.Surface(window.get_size(), 0, game_surface)
+
+        pygame.transform.scale(game_surface, window.get_size(), scaled_surface)
+        window.blit(scaled_surface, (0, 0))
+        return
+
+    build_lookups(game_surface.get_size(), window.get_size())
+
+    r_shift, g_shift, b_shift, _ = window.get_shifts()
+    fog_color = (FOG_COLOR[0] << 16) | (FOG_COLOR[1] << 8) | FOG_COLOR[2]
+
+    src = pygame.surfarray.pixels2d(game_surface)
+    dst = pygame.surfarray.pixels2d(window)
+    upscale_and_postprocess(src, dst, col_starts, row_starts, zbuffer, row_distances,
+                            FOG, fog_color, FOG_START, FOG_END,
+                            GAMMA != 1, gamma_lookup,
+                            VIGNETTE > 0, vignette_x, vignette_y,
+                            r_shift, g_shift, b_shift)
+
+    # Release the surface pixels
+    del src, dst
+
+
+# Load the output kernel from the numba cache (or compile it) with tiny surfaces of the same formats
+# Returns the jit_cache report
+def numba_load(game_surface: pygame.Surface, window: pygame.Surface):
+    src_surface = pygame.surface.Surface((4, 4), 0, game_surface)
+    dst_surface = pygame.surface.Surface((8, 8), 0, window)
+    src = pygame.surfarray.pixels2d(src_surface)
+    dst = pygame.surfarray.pixels2d(dst_surface)
+    build_lookups(src_surface.get_size(), dst_surface.get_size())
+
+    r_shift, g_shift, b_shift, _ = dst_surface.get_shifts()
+    distances = np.zeros((4), dtype=np.float64)
+    report = [jit_cache.warm_up(upscale_and_postprocess, src, dst, col_starts, row_starts, distances, distances,
+                                FOG, 0, FOG_START, FOG_END,
+                                GAMMA != 1, gamma_lookup,
+                                VIGNETTE > 0, vignette_x, vignette_y,
+                                r_shift, g_shift, b_shift)]
+
+    # Release the surface pixels
+    del src, dst
+    return report
+
+
+# Every source pixel is processed once and written to its block of destination pixels
+# Parallel over the source rows, each one owns its own destination rows
+@njit(fastmath=True, parallel=True, nogil=True, cache=True)
+def upscale_and_postprocess(src, dst, col_starts, row_starts, zbuffer, row_distances,
+                            fog, fog_color, fog_start, fog_end,
+                            gamma, gamma_lookup,
+                            vignette, vignette_x, vignette_y,
+                            r_shift, g_shift, b_shift):
+    src_width, src_height = src.shape
+
+    # Without post processing and with the same pixel layout the colors are copied as they are
+    copy_only = not fog and not vignette and not gamma and r_shift == 16 and g_shift == 8 and b_shift == 0
+
+    fog_r = (fog_color >> 16) & 0xFF
+    fog_g = (fog_color >> 8) & 0xFF
+    fog_b = fog_color & 0xFF
+
+    for y in nb.prange(src_height):
+        first_row = row_starts[y]
+        last_row = row_starts[y + 1]
+        if first_row == last_row:
+            continue
+
+        # Floors and ceilings get closer as they get further away from the horizon
+        row_distance = abs(row_distances[y])
+
+        for x in range(src_width):
+            color = src[x, y]
+
+            if copy_only:
+                for dst_x in range(col_starts[x], col_starts[x + 1]):
+                    dst[dst_x, first_row] = color
+                continue
+
+            r = (color >> 16) & 0xFF
+            g = (color >> 8) & 0xFF
+            b = color & 0xFF
+
+            if fog:
+                # The pixel is either the wall of the column or a floor/ceiling in front of it
+                distance = min(zbuffer[x], row_distance)
+                amount = min(max((distance - fog_start) / (fog_end - fog_start), 0.0), 1.0)
+                r = int(r + (fog_r - r) * amount)
+                g = int(g + (fog_g - g) * amount)
+                b = int(b + (fog_b - b) * amount)
+
+            if vignette:
+                factor = vignette_x[x] * vignette_y[y]
+                r = int(r * factor)
+                g = int(g * factor)
+                b = int(b * factor)
+
+            if gamma:
+                r = gamma_lookup[r]
+                g = gamma_lookup[g]
+                b = gamma_lookup[b]
+
+            color = (r << r_shift) | (g << g_shift) | (b << b_shift)
+            for dst_x in range(col_starts[x], col_starts[x + 1]):
+                dst[dst_x, first_row] = color
+
+        # The other rows of the block are copies of the first one
+        for dst_y in range(first_row + 1, last_row):
+            for dst_x in range(dst.shape[0]):
+                dst[dst_x, dst_y] = dst[dst_x, first_row]
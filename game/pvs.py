@@ -0,0 +1,380 @@
+import os
+import sys
+import math
+import time
+import pickle
+import hashlib
+import numpy as np
+import numba as nb
+from numba import njit
+from collections import namedtuple
+
+# Potentially visible set (PVS)
+# The map is split in square regions of REGION_SIZE tiles, and for every pair of regions it's worked out once if anything
+# in one can see anything in the other
+# At runtime "can something here see something there?" is a bit lookup, so entities and sounds in unrelated rooms
+# can be skipped without any distance math or raycasts
+# It only depends on the walls, so it's baked next to the map file (map.dat -> map.dat.pvs) and built again when they change
+# It's conservative: two regions are only marked as not seeing each other if no straight line between them is clear of
+# walls, so culling with it never hides anything that's visible (it can keep things that are hidden though)
+#
+# How it's worked out: every point of an open tile is at most half a tile away (on x and on y) from one of its corners,
+# so if a line from region A to region B is clear, a line from a corner of a tile in A is clear of the walls shrunk by
+# half a tile on every side, and it ends at most half a tile away from B. The shrunk walls are thin lines between the
+# centers of wall tiles that are next to each other, and what a corner sees past them is found exactly (the slopes
+# that get through are kept as intervals, column by column, nothing is sampled)
+#
+# Usage:
+#   visibility = pvs.load_or_build("maps/test_map.dat", mapW)
+#   pvs.can_see(visibility, tile_x1, tile_y1, tile_x2, tile_y2)
+#
+# Bake it ahead of time with:
+#   python -m game.pvs maps/test_map.dat
+
+# Size of a region in tiles
+REGION_SIZE = 4
+
+# Most regions a map is split in, bigger maps get bigger regions (the set is regions x regions bits, 32 MB at most)
+MAX_REGIONS = 16384
+
+# Changing anything above needs a new version, so old baked files are built again
+VERSION = 3
+
+FILE_EXTENSION = ".pvs"
+
+# Set bits of every byte
+BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Region visibility, bits is a bit matrix (np.packbits of regions x regions booleans)
+# The region of a tile is (tile_y // region_size) * regions_x + tile_x // region_size
+VisibilitySet = namedtuple("VisibilitySet", ["region_size", "regions_x", "regions_y", "bits"])
+
+
+# Set the bit of region b in a packed row (the same bit order as np.packbits)
+@njit(cache=True)
+def set_bit(row, b):
+    row[b >> 3] |= np.uint8(128 >> (b & 7))
+
+@njit(cache=True)
+def get_bit(row, b):
+    return (row[b >> 3] >> (7 - (b & 7))) & 1 == 1
+
+# What a corner sees is found in 8 octants, (u, v) in an octant is (xx * u + xy * v, yx * u + yy * v) from the corner
+# In an octant u goes away from the corner and the slopes v / u are from 0 to 1
+OCTANTS = np.array([[1, 0, 0, 1], [0, 1, 1, 0], [0, -1, 1, 0], [-1, 0, 0, 1],
+                    [-1, 0, 0, -1], [0, -1, -1, 0], [0, 1, -1, 0], [1, 0, 0, -1]], dtype=np.int64)
+
+# Blocked slopes are made this much wider, so the ones that touch are merged (the gaps a line really gets through
+# are much wider than this, the slopes are fractions with small denominators)
+SLOPE_EPSILON = 1e-10
+
+# Is the thin wall between the centers of two tiles there? (Both tiles are walls, outside of the map is open)
+# The centers are in doubled octant coordinates (odd numbers) from the corner at (cx, cy)
+@njit(cache=True)
+def is_thin_wall(mapW, cx, cy, octant, u1, v1, u2, v2):
+    height, width = mapW.shape
+
+    x1 = cx + (octant[0] * u1 + octant[1] * v1 - 1) // 2
+    y1 = cy + (octant[2] * u1 + octant[3] * v1 - 1) // 2
+    x2 = cx + (octant[0] * u2 + octant[1] * v2 - 1) // 2
+    y2 = cy + (octant[2] * u2 + octant[3] * v2 - 1) // 2
+
+    if not (x1 >= 0 and x1 < width and y1 >= 0 and y1 < height and x2 >= 0 and x2 < width and y2 >= 0 and y2 < height):
+        return False
+    return mapW[y1][x1] != 0 and mapW[y2][x2] != 0
+
+# First of the sorted interval ends that's above a (count if there's none), a binary search
+@njit(cache=True)
+def first_above(highs, count, a):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if highs[middle] <= a:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# Take the slopes from a to b out of the open intervals (lows, highs) that are sorted, returns the new count
+# There's always room for one more interval, the arrays are as big as the most intervals there can be
+@njit(cache=True)
+def remove_slopes(lows, highs, count, a, b):
+    a -= SLOPE_EPSILON
+    b += SLOPE_EPSILON
+
+    # The intervals first to last overlap [a, b]
+    first = first_above(highs, count, a)
+    last = first - 1
+    while last + 1 < count and lows[last + 1] < b:
+        last += 1
+    if last < first:
+        return count
+
+    # What's left of them is on the left of a and on the right of b
+    left = lows[first] < a
+    right = highs[last] > b
+    low_left, high_right = lows[first], highs[last]
+    kept = int(left) + int(right)
+
+    shift = kept - (last - first + 1)
+    if shift > 0:
+        for i in range(count - 1, last, -1):
+            lows[i + shift] = lows[i]
+            highs[i + shift] = highs[i]
+    elif shift < 0:
+        for i in range(last + 1, count):
+            lows[i + shift] = lows[i]
+            highs[i + shift] = highs[i]
+
+    i = first
+    if left:
+        lows[i], highs[i] = low_left, a
+        i += 1
+    if right:
+        lows[i], highs[i] = b, high_right
+
+    return count + shift
+
+# Is any slope between a and b (not including them) open?
+@njit(cache=True)
+def has_slopes(lows, highs, count, a, b):
+    i = first_above(highs, count, a)
+    return i < count and lows[i] < b
+
+# Mark the regions of the 4 tiles around the tile corner (px, py)
+# tile_regions has the region of every tile with a border of -1 around the map, so tile (x, y) is at [y + 1][x + 1]
+@njit(cache=True)
+def mark_corner(row, tile_regions, px, py):
+    for y in range(py, py + 2):
+        for x in range(px, px + 2):
+            if tile_regions[y][x] >= 0:
+                set_bit(row, tile_regions[y][x])
+
+# Mark the regions the corner (cx, cy) sees past the thin walls (see the top), an octant at a time
+# The cells here are squares centered on tile corners, with the centers of the tiles around as their corners, so the
+# thin walls are their sides. A cell the corner sees marks the regions of the 4 tiles around it
+@njit(cache=True)
+def mark_corner_visibility(mapW, cx, cy, tile_regions, octants, row, lows, highs, block_lows, block_highs):
+    height, width = mapW.shape
+
+    mark_corner(row, tile_regions, cx, cy)
+
+    for o in range(len(octants)):
+        octant = octants[o]
+        lows[0], highs[0] = 0.0, 1.0
+        count = 1
+
+        # The first cell is the one of the corner, only the side away from it can block
+        if is_thin_wall(mapW, cx, cy, octant, 1, -1, 1, 1):
+            continue
+
+        u = 1
+        while count > 0:
+            # The slopes that get into the column, less the ones stopped by the sides between its cells (going up),
+            # are the ones that get into the cell above. The sides at the end of the column stop them at the next one
+            # Only the cells the open slopes go through are looked at, the walls of the others can't stop anything
+            blocks = 0
+            seen = False
+            v = max(int(math.floor(lows[0] * (u - 0.5) + 0.5)) - 1, 0)
+            while v <= u and count > 0:
+                if v > 0 and is_thin_wall(mapW, cx, cy, octant, 2 * u - 1, 2 * v - 1, 2 * u + 1, 2 * v - 1):
+                    count = remove_slopes(lows, highs, count, (v - 0.5) / (u + 0.5), (v - 0.5) / (u - 0.5))
+
+                low = (v - 0.5) / (u + 0.5) if v > 0 else (v - 0.5) / (u - 0.5)
+                if has_slopes(lows, highs, count, low, (v + 0.5) / (u - 0.5)):
+                    px = cx + octant[0] * u + octant[1] * v
+                    py = cy + octant[2] * u + octant[3] * v
+                    if px >= 0 and px <= width and py >= 0 and py <= height:
+                        mark_corner(row, tile_regions, px, py)
+                        seen = True
+
+                if is_thin_wall(mapW, cx, cy, octant, 2 * u + 1, 2 * v - 1, 2 * u + 1, 2 * v + 1):
+                    block_lows[blocks] = (v - 0.5) / (u + 0.5)
+                    block_highs[blocks] = (v + 0.5) / (u + 0.5)
+                    blocks += 1
+
+                # Skip to the lowest cell above this one that the next open slopes go through
+                i = first_above(highs, count, (v + 0.5) / (u + 0.5))
+                if i == count:
+                    break
+                v = max(v + 1, int(math.floor(lows[i] * (u - 0.5) + 0.5)) - 1)
+
+            # Nothing of this column is in the map, and a line that left the map doesn't come back
+            if not seen:
+                break
+
+            for i in range(blocks):
+                count = remove_slopes(lows, highs, count, block_lows[i], block_highs[i])
+            u += 1
+
+# Mark what the corners of every open tile of every region see, in its row of bits
+# Every thread fills the rows of its own regions, so nothing is shared
+@njit(parallel=True, cache=True)
+def build_region_visibility(mapW, region_size, regions_x, regions_y, tile_regions, octants, bits):
+    height, width = mapW.shape
+
+    # The most slope intervals there can be, every thin wall splits at most one of them
+    most_intervals = 2 * (width + 1) * (height + 1) + 2
+
+    for source in nb.prange(regions_x * regions_y):
+        row = bits[source]
+
+        # A region always sees itself (even when it's all walls)
+        set_bit(row, source)
+
+        lows = np.empty(most_intervals)
+        highs = np.empty(most_intervals)
+        block_lows = np.empty(width + height + 2)
+        block_highs = np.empty(width + height + 2)
+
+        x0 = (source % regions_x) * region_size
+        y0 = (source // regions_x) * region_size
+        x1 = min(x0 + region_size, width)
+        y1 = min(y0 + region_size, height)
+
+        # The corners of the open tiles of the region, each one once
+        for cy in range(y0, y1 + 1):
+            for cx in range(x0, x1 + 1):
+                corner_of_open_tile = False
+                for tile_y in range(max(cy - 1, y0), min(cy + 1, y1)):
+                    for tile_x in range(max(cx - 1, x0), min(cx + 1, x1)):
+                        if mapW[tile_y][tile_x] == 0:
+                            corner_of_open_tile = True
+
+                if corner_of_open_tile:
+                    mark_corner_visibility(mapW, cx, cy, tile_regions, octants, row, lows, highs, block_lows, block_highs)
+
+# Seeing is mutual, the corners of one side can see past walls that the corners of the other side can't
+@njit(cache=True)
+def make_symmetric(bits, regions):
+    for a in range(regions):
+        for b in range(a + 1, regions):
+            if get_bit(bits[a], b) != get_bit(bits[b], a):
+                set_bit(bits[a], b)
+                set_bit(bits[b], a)
+
+# Size of the regions of a map, and how many there are on each side
+# Bigger maps get bigger regions so there are at most MAX_REGIONS of them
+def get_layout(mapW):
+    height, width = mapW.shape
+    region_size = REGION_SIZE
+    while ((width + region_size - 1) // region_size) * ((height + region_size - 1) // region_size) > MAX_REGIONS:
+        region_size *= 2
+    return region_size, (width + region_size - 1) // region_size, (height + region_size - 1) // region_size
+
+# Bits of regions x regions that are all set (or all clear)
+def make_bits(regions, value):
+    return np.full((regions, (regions + 7) // 8), 255 if value else 0, dtype=np.uint8)
+
+# Build the visibility of a map
+def build(mapW):
+    region_size, regions_x, regions_y = get_layout(mapW)
+    regions = regions_x * regions_y
+
+    # The region of every tile, with a border of -1 (see mark_corner)
+    height, width = mapW.shape
+    tile_regions = np.full((height + 2, width + 2), -1, dtype=np.int64)
+    tile_regions[1:-1, 1:-1] = (np.arange(height)[:, None] // region_size) * regions_x + np.arange(width)[None, :] // region_size
+
+    bits = make_bits(regions, False)
+    build_region_visibility(np.ascontiguousarray(mapW), region_size, regions_x, regions_y, tile_regions, OCTANTS, bits)
+    make_symmetric(bits, regions)
+
+    return VisibilitySet(region_size, regions_x, regions_y, bits)
+
+# A visibility set where every region sees every other one, for when the walls changed and the set is out of date
+def make_all_visible(visibility):
+    return visibility._replace(bits=make_bits(visibility.regions_x * visibility.regions_y, True))
+
+# The same for a map that has no set yet (nothing is culled until it's loaded)
+def make_unknown(mapW):
+    region_size, regions_x, regions_y = get_layout(mapW)
+    return VisibilitySet(region_size, regions_x, regions_y, make_bits(regions_x * regions_y, True))
+
+# Identifies the walls and the settings a visibility set was built with
+def get_key(mapW):
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(mapW, dtype=np.uint8).tobytes())
+    key.update(repr((mapW.shape, REGION_SIZE, MAX_REGIONS, VERSION)).encode())
+    return key.hexdigest()
+
+def save(filepath, visibility, key):
+    with open(filepath, 'wb') as f:
+        pickle.dump((key, tuple(visibility)), f)
+
+# Load a baked visibility set, returns None if there's none or it was built for other walls (or settings)
+def load(filepath, key):
+    if not os.path.isfile(filepath):
+        return None
+
+    try:
+        with open(filepath, 'rb') as f:
+            file_key, values = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+    if file_key != key:
+        return None
+    return VisibilitySet(*values)
+
+# Load the visibility set baked next to the map file, or build it (and bake it) if it's missing or out of date
+def load_or_build(map_filepath, mapW):
+    filepath = map_filepath + FILE_EXTENSION
+    key = get_key(mapW)
+
+    visibility = load(filepath, key)
+    if visibility is not None:
+        return visibility
+
+    print("Building PVS...")
+    start = time.perf_counter()
+    visibility = build(mapW)
+    print(f"PVS built in {time.perf_counter() - start:.2f}s, {get_density(visibility) * 100:.1f}% of the region pairs see each other")
+
+    try:
+        save(filepath, visibility, key)
+    except OSError as e:
+        print(f"Couldn't save the PVS ({e}), it will be built again next time")
+
+    return visibility
+
+# Region of a tile, -1 if it's outside of the map
+def get_region(visibility, tile_x, tile_y):
+    region_x = tile_x // visibility.region_size
+    region_y = tile_y // visibility.region_size
+
+    if not (tile_x >= 0 and region_x < visibility.regions_x and tile_y >= 0 and region_y < visibility.regions_y):
+        return -1
+    return region_y * visibility.regions_x + region_x
+
+# Can anything in region a see anything in region b?
+def regions_see(visibility, a, b):
+    return (visibility.bits[a][b >> 3] >> (7 - (b & 7))) & 1 == 1
+
+# Can anything in tile 1 possibly see anything in tile 2?
+# Tiles outside of the map aren't known, so they can see everything
+def can_see(visibility, tile_x1, tile_y1, tile_x2, tile_y2):
+    a = get_region(visibility, tile_x1, tile_y1)
+    b = get_region(visibility, tile_x2, tile_y2)
+    if a == -1 or b == -1:
+        return True
+    return regions_see(visibility, a, b)
+
+# How many of the region pairs see each other (0 to 1)
+# The bits are counted a byte at a time, unpacking them would take 8 times the memory of the set
+def get_density(visibility):
+    regions = visibility.regions_x * visibility.regions_y
+    used = regions - 8 * (visibility.bits.shape[1] - 1) # Bits of the last byte that are regions (the rest is padding)
+    counts = BIT_COUNTS[visibility.bits[:, :-1]].sum() + BIT_COUNTS[visibility.bits[:, -1] & ((0xFF00 >> used) & 0xFF)].sum()
+    return counts / (regions * regions)
+
+# Bake the visibility sets of map files
+if __name__ == '__main__':
+    for map_filepath in sys.argv[1:]:
+        with open(map_filepath, 'rb') as f:
+            width, height, mapF, mapW, mapC, objects = pickle.load(f)
+
+        mapW = np.array(mapW, dtype=np.uint8)
+        visibility = build(mapW)
+        save(map_filepath + FILE_EXTENSION, visibility, get_key(mapW))
+        print(f"{map_filepath}{FILE_EXTENSION}: {visibility.regions_x}x{visibility.regions_y} regions, {get_density(visibility) * 100:.1f}% visible")
@@ -0,0 +1,90 @@
+import time
+import queue
+import threading
+
+# Pipelined rendering
+# The frame is drawn by a render thread from a snapshot of the game state (see Gamemap.take_snapshot)
+# While it draws frame N the main thread already simulates frame N + 1, so on multi-core machines the python
+# side (entities, AI, sound) hides behind the raycaster. The render kernels release the GIL (nogil) while they run
+# It adds a frame of latency, the frame shown is the one drawn during the previous frame
+#
+# Usage:
+#   render_pipeline.start()
+#   ...
+#   render_time = render_pipeline.wait() # The previous frame is ready, present it
+#   render_pipeline.submit(gamemap, surface, snapshot)
+#   ...
+#   render_pipeline.stop()
+#
+# Between submit and wait the main thread must not use the surface, or change the gamemap resolution
+# It must not launch parallel kernels either, the numba workqueue threading layer can't run two parallel launches at once
+# (the kernels the simulation calls every tick are serial)
+
+ENABLED = True
+
+# Frames waiting to be drawn, there's only ever one
+jobs = queue.Queue(maxsize=1)
+
+# Set when the last submitted frame is done
+done = threading.Event()
+done.set()
+
+worker = None
+
+# How long the last frame took to draw (in seconds), and the error it raised (if any)
+render_time = 0.0
+error = None
+
+
+def render_loop():
+    global render_time, error
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        gamemap, surface, snapshot = job
+        start = time.perf_counter()
+        try:
+            gamemap.render_snapshot(surface, snapshot)
+        except Exception as e:
+            error = e
+        render_time = time.perf_counter() - start
+        done.set()
+
+# Start the render thread
+def start():
+    global worker
+    if worker is not None:
+        return
+
+    worker = threading.Thread(target=render_loop, daemon=True)
+    worker.start()
+
+# Stop the render thread after it finishes the current frame
+def stop():
+    global worker
+    if worker is None:
+        return
+
+    jobs.put(None)
+    worker.join()
+    worker = None
+
+# Draw a snapshot into a surface in the render thread
+def submit(gamemap, surface, snapshot):
+    done.clear()
+    jobs.put((gamemap, surface, snapshot))
+
+# Wait for the submitted frame, returns how long it took to draw
+# Errors raised in the render thread are raised again here
+def wait():
+    global error
+    done.wait()
+
+    if error is not None:
+        e, error = error, None
+        raise e
+
+    return render_time
@@ -4,6 +4,9 @@ from game.world import World
 
 TWO_PI = math.pi * 2
 
+# Sound sources in parts of the map that can't see the player (see Gamemap.can_see) are paused, like the ones out of range
+PVS_CULLING = True
+
 # Game music
 music = ["assets/music/nowhere_to_follow.wav"]
 
@@ -48,7 +51,7 @@ sound_entities = []
 
 class Sound2D:
 
-    def __init__(self, sound, pos=None, linked_entity=None, base_volume=1, audible_range=200) -> None:
+    def __init__(self, sound, pos=None, linked_entity=None, base_volume=1, audible_range=200, activate_on_sight=False) -> None:
         self.pos = [0, 0] if pos is None else pos
         self.base_volume = base_volume
         self.audible_range = audible_range
@@ -58,6 +61,10 @@ class Sound2D:
         self.playing = True
         self.timestamp = 0 # Time into the sound
 
+        # When enabled the sound stays paused until the player has seen its source once (see Gamemap.is_visible)
+        self.activate_on_sight = activate_on_sight
+        self.activated = not activate_on_sight
+
         # If this sound2d is linked to an entity, then it will follow the entity
         self.linked_entity = linked_entity
 
@@ -104,8 +111,15 @@ class Sound2D:
         x2, y2 = self.pos[0], self.pos[1]
         player_dist = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
 
+        # Wait for the source to be on the screen
+        if not self.activated:
+            self.activated = World.gamemap is not None and World.gamemap.is_visible(self.pos)
+
+        # In another room
+        occluded = PVS_CULLING and World.gamemap is not None and not World.gamemap.can_see(player.pos, self.pos)
+
         # Check if player is in hearing range
-        if player_dist > self.audible_range:
+        if player_dist > self.audible_range or not self.activated or occluded:
             # Stop playing channel
             if self.playing == True:
                 #self.timestamp = pygame.mixer.music.get_pos() / 1000
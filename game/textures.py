@@ -1,5 +1,7 @@
+import os
 import numpy as np 
 import pygame
+from collections import namedtuple
 from settings import *
 
 # Only used in sprites for now
@@ -9,6 +11,7 @@ TEXTURES_FOLDER_PATH = "assets/textures/"
 SPRITES_FOLDER_PATH = "assets/sprites/"
 UI_HUD_FOLDER_PATH = "assets/ui/"
 
+# Textures are square with a power of two size, larger ones are fine as distant pixels sample the mipmaps
 TEX_WIDTH  = 64
 TEX_HEIGHT = 64
 
@@ -16,23 +19,58 @@ TEX_HEIGHT = 64
 SKYBOX_WIDTH  = 1080
 SKYBOX_HEIGHT = 120
 SKYBOX_LIGHT_COLOR = np.array([255, 255, 255], dtype=np.uint8)
-skybox = None
+skybox = np.zeros((SKYBOX_WIDTH, SKYBOX_HEIGHT), dtype=np.uint32) # Packed colors (see pack_rgb)
+
+# Skyboxes swapped by toggle_day_night
+DAY_SKYBOX   = "skybox.png"
+NIGHT_SKYBOX = "night_skybox.png"
 
 #texture = np.array([np.zeros((TEX_HEIGHT, TEX_WIDTH), dtype=np.uint8) for _ in range(8)])
 # The texture array holds lists
 # Each list contain a texture, all the arrays are 1D of size tex_width * tex_height
 TEXTURES_AMOUNT = 8
 
+# Palette and colormaps (Doom style)
+# Textures and sprites store palette indices (uint8) instead of colors
+# The colormap translates an index into a packed color (see pack_rgb) for each light level
+# So shading a pixel is a table lookup: colormap[light_level][index]
+PALETTE_SIZE = 256
+LIGHT_LEVELS = 32 # Level 0 is black and LIGHT_LEVELS - 1 is the full color
+
+# Extra colormap row after the light levels, half of the color plus half of the skybox light color
+# Used by floors with an open ceiling above them
+SKY_LIT_LEVEL = LIGHT_LEVELS
+
+# Index 0 is always black, which is transparent in sprites
+palette = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+colormap = np.zeros((LIGHT_LEVELS + 1, PALETTE_SIZE), dtype=np.uint32)
+
+# Mipmaps
+# Every texture and sprite has a chain of levels, each one half the size of the previous one (down to 1x1)
+# The levels of a texture are stored one after the other in a flat array, level 0 being the full texture
+# Texel (x, y) of a level is at MIP_OFFSETS[level] + x * size + y, where size = TEX_WIDTH >> level
+MIP_LEVELS = TEX_WIDTH.bit_length()
+MIP_OFFSETS = np.array([sum((TEX_WIDTH >> i) ** 2 for i in range(level)) for level in range(MIP_LEVELS + 1)], dtype=np.int64)
+MIP_TEXELS = int(MIP_OFFSETS[-1])
+
 # Texture is a list of texture
 # each one
-texture = np.zeros((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT, 3), dtype=np.uint8)
+# Every texture is stored as palette indices, texture is a view of the first mip level
+texture_mips = np.zeros((TEXTURES_AMOUNT, MIP_TEXELS), dtype=np.uint8)
+texture = texture_mips[:, :TEX_WIDTH * TEX_HEIGHT].reshape((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT))
 
 print("Side texture")
 # Each texture may or may no have a equivalent side texture, it should be at the same index
 side_texture = None
 
 # Sprite textures
-sprites = np.zeros((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT, 3), dtype=np.uint8)
+sprite_mips = np.zeros((TEXTURES_AMOUNT, MIP_TEXELS), dtype=np.uint8)
+sprites = sprite_mips[:, :TEX_WIDTH * TEX_HEIGHT].reshape((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT))
+
+# Loaded rgb images of the textures and sprites (None if not loaded)
+# The palette is built from them, see build_palette
+texture_sources = [None for _ in range(TEXTURES_AMOUNT)]
+sprite_sources = [None for _ in range(TEXTURES_AMOUNT)]
 
 # UI and HUD Textures
 hud_textures = np.zeros((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT, 3), dtype=np.uint8)
@@ -42,24 +80,143 @@ hud_overlay = -1
 
 # texture_names = {"plank": 0, "brick": 1} -> points to the texture list above
 
-# Used for optimization
-# Store the texture halves that sometimes are needed
-# Specifically for shadow and light interpolation
-texure_halves = np.zeros((TEXTURES_AMOUNT, TEX_WIDTH, TEX_HEIGHT, 3), dtype=np.uint8)
+# Texture bank, every array the render kernels read, passed to them as a single argument (see get_bank)
+# The kernels are compiled for the types of the arrays and not for their contents
+# So textures, sprites and the skybox can be replaced at any time without compiling anything again
+TextureBank = namedtuple("TextureBank", ["texture_mips", "sprite_mips", "colormap", "skybox"])
+
+# Files and arguments of what was loaded, used to reload them (see reload_changed)
+texture_files = [None for _ in range(TEXTURES_AMOUNT)]
+sprite_files = [None for _ in range(TEXTURES_AMOUNT)]
+skybox_file = None
+
+# Modification time of every loaded file
+file_times = {}
+
+# Get the texture bank with the current textures
+def get_bank():
+    return TextureBank(texture_mips, sprite_mips, colormap, skybox)
+
+
+# Pack a (..., 3) rgb array into 0xRRGGBB uint32 values
+# This is the pixel layout of a 32 bit pygame surface without alpha
+def pack_rgb(rgb):
+    rgb = np.asarray(rgb).astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+# Unpack 0xRRGGBB uint32 values back into a (..., 3) rgb array
+def unpack_rgb(packed):
+    packed = np.asarray(packed, dtype=np.uint32)
+    return np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1).astype(np.uint8)
+
+# Reduce a list of unique colors into at most amount colors (median cut)
+# The box with the widest channel is split in half until there are enough boxes, each box becomes its average color
+def median_cut(colors, amount):
+    boxes = [colors]
+
+    while len(boxes) < amount:
+        ranges = [np.ptp(box, axis=0).max() if len(box) > 1 else -1 for box in boxes]
+        widest = int(np.argmax(ranges))
+        if ranges[widest] <= 0:
+            break
+
+        box = boxes.pop(widest)
+        channel = np.argmax(np.ptp(box, axis=0))
+        box = box[np.argsort(box[:, channel])]
+        half = len(box) // 2
+        boxes.append(box[:half])
+        boxes.append(box[half:])
+
+    return np.array([np.round(box.mean(axis=0)) for box in boxes], dtype=np.uint8)
+
+# Get the index of the closest palette color (ignoring the black at index 0) for every rgb color
+def closest_palette_index(rgb):
+    colors, inverse = np.unique(rgb.reshape(-1, 3), axis=0, return_inverse=True)
+    distances = ((colors[:, None, :].astype(np.int32) - palette[None, 1:, :].astype(np.int32)) ** 2).sum(axis=2)
+    indices = (np.argmin(distances, axis=1) + 1).astype(np.uint8)
+
+    # Black stays black (and transparent in sprites)
+    indices[(colors == 0).all(axis=1)] = 0
+    return indices[inverse.reshape(-1)].reshape(rgb.shape[:-1])
+
+# Build the palette from every loaded texture and sprite, index them and generate the colormaps
+# Needs to be called again when a texture, sprite or the skybox is loaded
+def build_palette():
+    sources = [rgb for rgb in texture_sources + sprite_sources if rgb is not None]
+    if len(sources) == 0:
+        return
+
+    colors = np.unique(np.concatenate([rgb.reshape(-1, 3) for rgb in sources]), axis=0)
+    colors = colors[(colors != 0).any(axis=1)] # Black is always index 0
+
+    # Keep every color if they fit in the palette
+    if len(colors) > PALETTE_SIZE - 1:
+        colors = median_cut(colors, PALETTE_SIZE - 1)
+
+    palette[:] = 0
+    palette[1:len(colors) + 1] = colors
+
+    for i, rgb in enumerate(texture_sources):
+        if rgb is not None:
+            build_mips(rgb, texture_mips[i])
 
+    for i, rgb in enumerate(sprite_sources):
+        if rgb is not None:
+            build_mips(rgb, sprite_mips[i], transparent=True)
+
+    build_colormap()
+
+# Generate every mip level of an rgb image as palette indices
+# Each level averages 2x2 texels of the previous one, with transparent (black) texels it only averages the visible ones
+def build_mips(rgb, mips, transparent=False):
+    colors = rgb.astype(np.float64)
+    visible = (rgb != 0).any(axis=2) if transparent else np.ones(rgb.shape[:2], dtype=bool)
+
+    for level in range(MIP_LEVELS):
+        size = TEX_WIDTH >> level
+
+        if level > 0:
+            weights = visible.reshape(size, 2, size, 2).sum(axis=(1, 3))
+            colors = (colors * visible[..., None]).reshape(size, 2, size, 2, 3).sum(axis=(1, 3)) / np.maximum(weights, 1)[..., None]
+
+            # Half or more of the texels need to be visible
+            if transparent:
+                visible = weights >= 2
+            else:
+                visible = weights > 0
+
+        indices = closest_palette_index(np.round(colors).astype(np.uint8))
+        indices[~visible] = 0
+        mips[MIP_OFFSETS[level]:MIP_OFFSETS[level + 1]] = indices.reshape(-1)
+
+# Generate a row of packed colors for each light level, plus the sky lit row
+def build_colormap():
+    for level in range(LIGHT_LEVELS):
+        colormap[level] = pack_rgb(palette * (level / (LIGHT_LEVELS - 1)))
+
+    colormap[SKY_LIT_LEVEL] = pack_rgb(np.minimum(palette * 0.5 + np.asarray(SKYBOX_LIGHT_COLOR) * 0.5, 255))
 
 # Add a shade to a texture, it looks good on walls
-def add_shade(texture_id):
+def add_shade(rgb):
     for x in range(TEX_WIDTH):
         for y in range(TEX_HEIGHT):
-            texture[texture_id][x][y] = texture[texture_id][x][y] * (1-(y/TEX_HEIGHT/2))
+            rgb[x][y] = rgb[x][y] * (1-(y/TEX_HEIGHT/2))
+
+# Remember when a file was modified, to know if it needs to be reloaded
+def track_file(filepath):
+    file_times[filepath] = os.path.getmtime(filepath)
+
+def file_changed(filepath):
+    return os.path.getmtime(filepath) != file_times.get(filepath)
 
 # Load sprite image file
 def load_sprite(sprite_id, filename):
     filepath = SPRITES_FOLDER_PATH + filename
+    sprite_files[sprite_id] = filename
+    track_file(filepath)
     image = pygame.image.load(filepath).convert_alpha()
     image = pygame.transform.scale(image, (TEX_WIDTH, TEX_HEIGHT))
-    sprites[sprite_id] = pygame.surfarray.array3d(image) * 0.5
+    sprite_sources[sprite_id] = (pygame.surfarray.array3d(image) * 0.5).astype(np.uint8)
 
 # Load hud textures
 def load_hud(ui_hud_id, filename):
@@ -71,25 +228,28 @@ def load_hud(ui_hud_id, filename):
 # Load texture image file
 def load_texture(texture_id, filename, do_add_shade=False):
     filepath = TEXTURES_FOLDER_PATH + filename
+    texture_files[texture_id] = (filename, do_add_shade)
+    track_file(filepath)
 
     # Load image, remove alpha and scale it down
     image = pygame.image.load(filepath).convert_alpha()
     #image = pygame.transform.smoothscale(image, (TEX_WIDTH, TEX_HEIGHT))
     image = pygame.transform.scale(image, (TEX_WIDTH, TEX_HEIGHT))
 
-    texture[texture_id] = pygame.surfarray.array3d(image)
-
-    # Add texture halve
-    texure_halves[texture_id] = texture[texture_id] * 0.5
+    rgb = pygame.surfarray.array3d(image)
      
     # Add a shading to make it more realistic
     if do_add_shade:
-        add_shade(texture_id)
+        add_shade(rgb)
+
+    texture_sources[texture_id] = rgb
 
 # Load skybox texture
 def load_skybox(filename, skybox_light_color = None):
-    global skybox, SKYBOX_LIGHT_COLOR
+    global skybox, skybox_file, SKYBOX_LIGHT_COLOR
     filepath = TEXTURES_FOLDER_PATH + filename
+    skybox_file = (filename, skybox_light_color)
+    track_file(filepath)
 
     # Load image, remove alpha and scale it down
     image = pygame.image.load(filepath).convert_alpha()
@@ -97,14 +257,52 @@ def load_skybox(filename, skybox_light_color = None):
     image = pygame.transform.scale(image, (SKYBOX_WIDTH, SKYBOX_HEIGHT))
 
     # Convert into numpy array
-    skybox = pygame.surfarray.array3d(image)
+    rgb = pygame.surfarray.array3d(image)
+    skybox = pack_rgb(rgb)
 
     # Average skybox color
     if skybox_light_color is None:
-        SKYBOX_LIGHT_COLOR = np.mean(skybox, axis=(0, 1))
+        SKYBOX_LIGHT_COLOR = np.mean(rgb, axis=(0, 1))
     else:
         SKYBOX_LIGHT_COLOR = skybox_light_color
 
+    # The sky lit colors depend on the skybox light color
+    build_colormap()
+
+# Reload every texture, sprite and skybox whose file changed since it was loaded
+# Textures and sprites are indexed again, the new ones are drawn in the next frame
+# Returns how many files were reloaded
+def reload_changed():
+    reloaded = 0
+
+    for texture_id, loaded in enumerate(texture_files):
+        if loaded is not None and file_changed(TEXTURES_FOLDER_PATH + loaded[0]):
+            load_texture(texture_id, *loaded)
+            reloaded += 1
+
+    for sprite_id, filename in enumerate(sprite_files):
+        if filename is not None and file_changed(SPRITES_FOLDER_PATH + filename):
+            load_sprite(sprite_id, filename)
+            reloaded += 1
+
+    # The skybox doesn't change the palette, only the sky lit colors
+    palette_changed = reloaded > 0
+    if skybox_file is not None and file_changed(TEXTURES_FOLDER_PATH + skybox_file[0]):
+        load_skybox(*skybox_file)
+        reloaded += 1
+
+    if palette_changed:
+        build_palette()
+
+    return reloaded
+
+# Swap between the day and the night skybox
+def toggle_day_night():
+    if skybox_file is not None and skybox_file[0] == NIGHT_SKYBOX:
+        load_skybox(DAY_SKYBOX)
+    else:
+        load_skybox(NIGHT_SKYBOX)
+
 # Generate textures
 def generate_textures():
     print("Loading textures...")
@@ -115,7 +313,7 @@ def generate_textures():
     load_texture(2, "blue_floor.png")
 
     # Game skybox
-    load_skybox("night_skybox.png")
+    load_skybox(NIGHT_SKYBOX)
 
     # Load sprites
     load_sprite(0, "red_oger.png")
@@ -123,4 +321,7 @@ def generate_textures():
     # Gun holding
     load_hud(0, "gun.png")
 
+    # Index every texture and sprite
+    build_palette()
+
     print("Textures loaded!")
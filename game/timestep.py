@@ -0,0 +1,83 @@
+import time
+
+# Fixed timestep
+# The simulation (entities, sounds) always advances in steps of TICK_TIME, no matter how long a frame takes
+# So slow frames can't push entities through walls and the game behaves the same at any frame rate
+# Rendering happens once per frame and interpolates between the last two ticks (see get_alpha)
+#
+# Usage:
+#   for _ in range(timestep.update()):
+#       simulate(timestep.TICK_TIME)
+#   render(timestep.get_alpha())
+#   timestep.limit_frame()
+
+TICK_RATE = 60
+TICK_TIME = 1 / TICK_RATE
+
+# Most ticks simulated in a single frame
+# When a frame takes longer than that (loading, a breakpoint, a very slow machine) the game slows down instead of
+# trying to catch up, which would make the next frame even slower
+MAX_TICKS_PER_FRAME = 5
+
+# Frame rate limit, 0 means unlimited
+# Rendering faster than the screen wastes a whole core
+FRAME_LIMIT = 144
+
+# time.sleep can wake up late by a millisecond or two, so the end of the wait is busy waited
+SPIN_TIME = 0.002
+
+# Simulation time not simulated yet (always less than a tick after update)
+accumulator = 0.0
+
+# Time of the last update and duration of the last frame
+prev_time = time.perf_counter()
+frame_time = 0.0
+
+# When the current frame started, for the frame limiter
+frame_start = prev_time
+
+
+# Start counting from now, so the time spent before (loading) isn't simulated
+def reset():
+    global accumulator, prev_time, frame_time, frame_start
+    accumulator = 0.0
+    prev_time = time.perf_counter()
+    frame_time = 0.0
+    frame_start = prev_time
+
+# Add the time since the last call, returns how many ticks need to be simulated this frame
+def update():
+    global accumulator, prev_time, frame_time
+
+    now = time.perf_counter()
+    frame_time = now - prev_time
+    prev_time = now
+
+    accumulator = min(accumulator + frame_time, MAX_TICKS_PER_FRAME * TICK_TIME)
+    ticks = int(accumulator / TICK_TIME)
+    accumulator -= ticks * TICK_TIME
+    return ticks
+
+# How far the simulation is between the previous tick (0) and the last one (1)
+def get_alpha():
+    return min(accumulator / TICK_TIME, 1.0)
+
+# Wait until the frame took 1 / FRAME_LIMIT seconds
+def limit_frame():
+    global frame_start
+
+    if FRAME_LIMIT <= 0:
+        frame_start = time.perf_counter()
+        return
+
+    target = frame_start + 1 / FRAME_LIMIT
+    remaining = target - time.perf_counter()
+    if remaining > SPIN_TIME:
+        time.sleep(remaining - SPIN_TIME)
+
+    while time.perf_counter() < target:
+        pass
+
+    # When a frame was too slow the next one starts now, instead of trying to make up for it
+    now = time.perf_counter()
+    frame_start = target if now - target < 1 / FRAME_LIMIT else now
@@ -1,3 +1,47 @@
+import math
+import numpy as np
+from numba import njit
+import game.pvs as pvs
+import game.line_of_sight as line_of_sight
+import game.collision as collision
+from settings import *
+
+# Size of the spatial hash cells (the same as the map tiles)
+CELL_SIZE = TILE_SIZE
+
+
+# Copy of an array with room for capacity rows
+def resize(array, capacity):
+    resized = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    resized[:len(array)] = array[:capacity]
+    return resized
+
+# Copy the interpolated position and the sprite of the entities that have one into the sprite buffers
+# Entities in regions the viewer region can't see (in the PVS bit matrix) are skipped, with viewer_region -1 nothing is
+# Returns how many were copied
+@njit(nogil=True, cache=True)
+def gather_sprite_rows(positions, prev_positions, entity_sprites, ignore_index, alpha,
+                       viewer_region, pvs_bits, region_size, regions_x, regions_y, tilesize, out_positions, out_ids):
+    count = 0
+    for i in range(len(positions)):
+        if entity_sprites[i] == -1 or i == ignore_index:
+            continue
+
+        x, y = positions[i][0], positions[i][1]
+        if viewer_region != -1:
+            region_x = int(x // tilesize) // region_size
+            region_y = int(y // tilesize) // region_size
+            if x >= 0 and y >= 0 and region_x < regions_x and region_y < regions_y:
+                region = region_y * regions_x + region_x
+                if (pvs_bits[viewer_region][region >> 3] >> (7 - (region & 7))) & 1 == 0:
+                    continue
+
+        out_positions[count][0] = prev_positions[i][0] + (x - prev_positions[i][0]) * alpha
+        out_positions[count][1] = prev_positions[i][1] + (y - prev_positions[i][1]) * alpha
+        out_ids[count] = entity_sprites[i]
+        count += 1
+    return count
+
 
 # Static class that hold the world values
 class World:
@@ -6,31 +50,217 @@ class World:
     entities = []   # Every single entity including the player
     player   = None # Player entity
 
+    # Struct of arrays with the state of every entity, the row of an entity is entity.index (see Entity)
+    # The arrays grow by doubling, so views into them (like entity.pos) shouldn't be kept around
+    count          = 0
+    positions      = np.zeros((0, 2))               # World position (x, y)
+    prev_positions = np.zeros((0, 2))               # Position at the previous simulation tick
+    angles         = np.zeros((0))
+    radii          = np.zeros((0))                  # Collider radius
+    motions        = np.zeros((0, 2))               # Motion asked for this tick with entity.move, applied by apply_motions
+    entity_sprites = np.zeros((0), dtype=np.int64)  # Index in textures.sprites, -1 means no sprite
+
+    # Struct of arrays with the entities that have a sprite, filled by gather_sprites every frame
+    # The arrays only grow, so no allocation happens once they are big enough
+    sprite_positions = np.zeros((0, 2))               # World position (x, y)
+    sprite_ids       = np.zeros((0), dtype=np.int64)  # Index in textures.sprites
+
+    # Line of sight of every entity to the player, filled by update_sight every tick (one kernel call for all of them)
+    sight_blocked = np.zeros((0), dtype=np.bool_) # A wall is in the way
+    sight_ends    = np.zeros((0, 2))              # Where the sight line stops, the wall or the player position
+
+    # Spatial hash, the entities of each cell (cell_x, cell_y) by the cell their position is in
+    # Every entity knows its cell (entity.cell), it's moved to another one by update_cell
+    cells = {}
+    max_radius = 0 # Biggest collider radius, entities can reach into the cells around theirs
+
     def add_gamemap(gamemap):
         World.gamemap = gamemap
 
+    # Give an entity its row in the arrays (the entity sets its position after, which puts it in the spatial hash)
     def add_entity(entity):
+        if World.count == len(World.positions):
+            capacity = max(16, 2 * World.count)
+            World.positions = resize(World.positions, capacity)
+            World.prev_positions = resize(World.prev_positions, capacity)
+            World.angles = resize(World.angles, capacity)
+            World.radii = resize(World.radii, capacity)
+            World.motions = resize(World.motions, capacity)
+            World.entity_sprites = resize(World.entity_sprites, capacity)
+
+        entity.index = World.count
+        World.motions[entity.index] = 0
+        entity.cell = None
         World.entities.append(entity)
+        World.count += 1
+
+    # Remove every entity and the player, used when a new level is loaded
+    def clear():
+        World.entities = []
+        World.player = None
+        World.count = 0
+        World.cells = {}
+        World.max_radius = 0
 
     def get_entities(ignore_player=False, ignore=None):
-        if ignore is None:
-            ignore = []
+        ignore = set() if ignore is None else set(ignore)
 
         if ignore_player:
-            ignore.append(World.player)
+            ignore.add(World.player)
+
+        return [ent for ent in World.entities if ent not in ignore]
+
+    # Move an entity to the cell of its position, setting entity.pos calls it
+    def update_cell(entity):
+        x, y = World.positions[entity.index].tolist()
+        cell = (int(x // CELL_SIZE), int(y // CELL_SIZE))
+        World.max_radius = max(World.max_radius, float(World.radii[entity.index]))
+
+        if cell == entity.cell:
+            return
+
+        if entity.cell is not None:
+            entities = World.cells[entity.cell]
+            entities.remove(entity)
+            if len(entities) == 0:
+                del World.cells[entity.cell]
+
+        World.cells.setdefault(cell, []).append(entity)
+        entity.cell = cell
+
+    # Entities whose collider touches the circle (pos, radius), only the cells around it are checked
+    def query_radius(pos, radius, ignore=None):
+        x, y = pos
+        reach = radius + World.max_radius
+        positions, radii = World.positions, World.radii
+
+        found = []
+        for cell_y in range(int((y - reach) // CELL_SIZE), int((y + reach) // CELL_SIZE) + 1):
+            for cell_x in range(int((x - reach) // CELL_SIZE), int((x + reach) // CELL_SIZE) + 1):
+                entities = World.cells.get((cell_x, cell_y))
+                if entities is None:
+                    continue
+
+                for ent in entities:
+                    if ent is ignore:
+                        continue
 
-        entities = []
-        for ent in World.entities:
-            if ent in ignore:
-                continue
+                    ex, ey = positions[ent.index].tolist()
+                    r = radius + radii[ent.index]
+                    if (ex - x)**2 + (ey - y)**2 < r * r:
+                        found.append(ent)
+        return found
 
-            entities.append(ent)
-        return entities
+    # Entities whose collider touches the segment from start to end (thickened by radius), closest to start first
+    # Only the cells along the segment (and the ones next to them) are checked
+    def query_ray(start, end, radius=0, ignore=None):
+        x1, y1 = start
+        x2, y2 = end
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+        positions, radii = World.positions, World.radii
+
+        # Cells around each cell of the segment that can hold an entity touching it
+        pad = math.ceil((radius + World.max_radius) / CELL_SIZE)
+
+        # Walk the cells of the segment (sampled every half cell)
+        steps = max(int(math.sqrt(length_sq) / (CELL_SIZE / 2)), 1)
+        visited = set()
+        found = []
+        for i in range(steps + 1):
+            cell_x = int((x1 + dx * i / steps) // CELL_SIZE)
+            cell_y = int((y1 + dy * i / steps) // CELL_SIZE)
+
+            for cy in range(cell_y - pad, cell_y + pad + 1):
+                for cx in range(cell_x - pad, cell_x + pad + 1):
+                    if (cx, cy) in visited:
+                        continue
+                    visited.add((cx, cy))
+
+                    entities = World.cells.get((cx, cy))
+                    if entities is None:
+                        continue
+
+                    for ent in entities:
+                        if ent is ignore:
+                            continue
+
+                        # Closest point of the segment to the entity
+                        ex, ey = positions[ent.index].tolist()
+                        t = 0 if length_sq == 0 else min(max(((ex - x1) * dx + (ey - y1) * dy) / length_sq, 0), 1)
+                        px, py = x1 + dx * t, y1 + dy * t
+
+                        r = radius + radii[ent.index]
+                        if (ex - px)**2 + (ey - py)**2 < r * r:
+                            found.append((t, ent))
+
+        found.sort(key=lambda hit: hit[0])
+        return [ent for _, ent in found]
+
+    # Line of sight from every entity to the target entity
+    def update_sight(target):
+        gamemap = World.gamemap
+        positions = World.positions[:World.count]
+        targets = np.broadcast_to(World.positions[target.index], positions.shape)
+
+        blocked, _, distances = line_of_sight.cast(gamemap.mapW, gamemap.tilesize, positions, targets)
+
+        # The part of the line before the wall
+        deltas = targets - positions
+        lengths = np.sqrt((deltas * deltas).sum(axis=1))
+        fractions = np.divide(distances, lengths, out=np.ones_like(distances), where=lengths > 0)
+
+        World.sight_blocked = blocked
+        World.sight_ends = positions + deltas * fractions[:, None]
+
+    # Move every entity by the motion it asked for this tick (see Entity.move)
+    # The slide along the other entities is done one by one, the walls for all of them in one kernel call
+    def apply_motions():
+        motions = World.motions[:World.count]
+        moving = np.flatnonzero(motions.any(axis=1)).tolist()
+        if len(moving) == 0:
+            return
+
+        for i in moving:
+            motions[i] = World.entities[i].slide_along_entities(motions[i])
+
+        gamemap = World.gamemap
+        if gamemap:
+            collision.move_circles(gamemap.mapW, float(gamemap.tilesize), World.positions[:World.count], motions, World.radii[:World.count])
+        else:
+            World.positions[:World.count] += motions
+
+        for i in moving:
+            World.update_cell(World.entities[i])
+        motions[:] = 0
+
+    # Remember where every entity was before simulating a tick (see Entity.get_interpolated_pos)
+    def store_previous_positions():
+        World.prev_positions[:World.count] = World.positions[:World.count]
 
     # Get all sprites related to the entities, if they dont have any, dont return it for the enitty
     def get_sprites():
-        sprites = []
-        for ent in World.entities:
-            if ent.sprite:
-                sprites.append(ent.sprite)
-        return sprites
\ No newline at end of file
+        sprites = World.entity_sprites[:World.count]
+        return sprites[sprites != -1].tolist()
+
+    # Fill the sprite buffers with every entity that has a sprite (except the ignored one)
+    # The positions are interpolated between the last two ticks with alpha
+    # With a viewer position the entities the PVS says can't be seen from there are skipped (see Gamemap.can_see)
+    # Returns how many entries were filled
+    def gather_sprites(ignore=None, alpha=1.0, viewer=None):
+        if len(World.sprite_positions) < World.count:
+            capacity = max(World.count, 2 * len(World.sprite_positions))
+            World.sprite_positions = np.zeros((capacity, 2))
+            World.sprite_ids = np.zeros((capacity), dtype=np.int64)
+
+        # Straight from the entity arrays, in one pass
+        gamemap = World.gamemap
+        visibility = gamemap.pvs
+        viewer_region = -1
+        if viewer is not None:
+            viewer_region = pvs.get_region(visibility, int(viewer[0] // gamemap.tilesize), int(viewer[1] // gamemap.tilesize))
+
+        return gather_sprite_rows(World.positions[:World.count], World.prev_positions[:World.count], World.entity_sprites[:World.count],
+                                  -1 if ignore is None else ignore.index, float(alpha),
+                                  viewer_region, visibility.bits, visibility.region_size, visibility.regions_x, visibility.regions_y, float(gamemap.tilesize),
+                                  World.sprite_positions, World.sprite_ids)
\ No newline at end of file
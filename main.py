@@ -2,18 +2,31 @@
 
 import pygame
 import time
+import threading
 from settings import *
 from game.world import World
 from game.player import Player
 from game.enemie import Enemie
 from game.camera import Camera
-from game.gamemap import Gamemap, pre_calculate
+from game.gamemap import Gamemap
 import game.sound as sound
 import game.textures as textures
+import game.frame_timer as frame_timer
+import game.postprocess as postprocess
+import game.jit_cache as jit_cache
+import game.dynamic_resolution as dynamic_resolution
+import game.timestep as timestep
+import game.render_pipeline as render_pipeline
+import game.ai_scheduler as ai_scheduler
+import game.pathfinding as pathfinding
 
 # For debug purporses
 MODE_2D = False
 
+# Files written when the frame timings are dumped (F3)
+FRAME_TIMES_CSV  = "frame_times.csv"
+FRAME_TIMES_JSON = "frame_times.json"
+
 # Thanks to: https://lodev.org/cgtutor/raycasting.html
 
 # Pygame initialization
@@ -22,20 +35,47 @@ clock = pygame.time.Clock()
 window = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.DOUBLEBUF)
 
 # Game surface which is scaled to fit the window
-game_surface = pygame.surface.Surface((WIDTH, HEIGHT), pygame.HWACCEL | pygame.DOUBLEBUF)
+# It is 32 bits so the renderer can write its packed pixels directly into it
+# Its size is the internal resolution, which changes with the dynamic resolution
+def create_game_surface(size):
+    return pygame.surface.Surface(size, pygame.HWACCEL | pygame.DOUBLEBUF, 32)
+
+game_surface = create_game_surface((WIDTH, HEIGHT))
+
+# Load the numba kernels (from the disk cache, or compiling them) and the PVS of the level in the background while drawing a loading screen
+# Returns False if the game was closed while loading
+def load_kernels(gamemap: Gamemap):
+    report = []
+
+    def load():
+        gamemap.load_pvs()
+        report.extend(gamemap.numba_load(game_surface))
+        report.extend(postprocess.numba_load(game_surface, window))
 
-# Get delta time
-prev_time = time.time()
-def get_deltatime() -> float:
-    global prev_time
-    # limit the framerate and get the delta time
-    #clock.tick(60)
+    jit_cache.start_threads()
+    loader = threading.Thread(target=load, daemon=True)
+    start = time.perf_counter()
+    loader.start()
 
-    now = time.time()
-    dt = now - prev_time
-    prev_time = now
+    font = pygame.font.Font(None, 48)
+    dots = 0
+    while loader.is_alive():
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+
+        window.fill((0, 0, 0))
+        text = font.render("Loading" + "." * (dots % 4), True, (200, 200, 200))
+        window.blit(text, text.get_rect(center=(SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)))
+        pygame.display.flip()
 
-    return dt
+        dots += 1
+        clock.tick(4)
+
+    loader.join()
+    print(f"Kernels loaded in {time.perf_counter() - start:.2f}s")
+    jit_cache.print_report(report)
+    return True
 
 
 def main():
@@ -47,7 +87,6 @@ def main():
     # Initialize the game map and load the objects
     gamemap = Gamemap()
     World.add_gamemap(gamemap)
-    pre_calculate()
 
     # Load the objects
     player = None
@@ -74,32 +113,38 @@ def main():
 
     World.player = player
     
-    # Render first frame to fully load the methods with numba
+    # Load every kernel (and the PVS) before the first frame, so it doesn't stutter while they compile
     print("Initializing rendering processs...")
-    #gamemap.render(game_surface, player.pos)
+    if not load_kernels(gamemap):
+        pygame.quit()
+        return
     print("Finished!")
 
-    # THIS IS AWFUL
-    # Delta time can be too big when starting, and the sprites could go beyound the walls
-    # To solve that, we are gonna intiialize the rendering process of a sprite earlier
-    gamemap.numba_load()
-
     #pygame.mixer.music.load(sound.music[0])
     #pygame.mixer.music.set_volume(0.25)
     #pygame.mixer.music.play()
 
+    # Don't simulate the loading time
+    global game_surface
+    timestep.reset()
+
+    if render_pipeline.ENABLED:
+        render_pipeline.start()
+
     running = True
     mouse_grabbed = False
     while running:
-        dt = get_deltatime()
-        fps = 0 if dt == 0 else int(1 / dt)
+        ticks = timestep.update()
+        fps = 0 if timestep.frame_time == 0 else int(1 / timestep.frame_time)
 
-        pygame.display.set_caption(f"RAYCASTING3D | FPS: {fps:.0f}")
+        pygame.display.set_caption(f"RAYCASTING3D | FPS: {fps:.0f} | {game_surface.get_width()}x{game_surface.get_height()}")
 
         # Clear the screen
         #window.fill((0, 0, 0))
         #game_surface.fill((0, 0, 0, 0))
 
+        start = frame_timer.begin_frame()
+
         # Handle all game events
         entities = World.get_entities()
         for event in pygame.event.get():
@@ -122,13 +167,44 @@ def main():
                     pygame.event.set_grab(False)
                     player.allow_mouse_movement = mouse_grabbed
 
+                # Reload the textures changed on disk (e.g. exported again from the image editor)
+                if event.key == pygame.K_F5:
+                    print(f"Reloaded {textures.reload_changed()} textures")
+
+                # Swap the day and night skyboxes
+                if event.key == pygame.K_F6:
+                    textures.toggle_day_night()
+
+                # Dump the timings of the last frames
+                if event.key == pygame.K_F3:
+                    frame_timer.dump_csv(FRAME_TIMES_CSV)
+                    frame_timer.dump_json(FRAME_TIMES_JSON)
+                    print(f"Frame times saved to {FRAME_TIMES_CSV} and {FRAME_TIMES_JSON}")
+
+                # Print how the AI is keeping up (queued path searches, skipped updates and the path cache)
+                if event.key == pygame.K_F4:
+                    print(ai_scheduler.get_stats())
+                    print("path cache:", pathfinding.get_cache_stats())
+
             for ent in entities:
                 ent.handle_event(event)
+        start = frame_timer.mark(frame_timer.EVENTS, start)
 
-        for ent in entities:
-            ent.update(dt)
+        # Simulate in fixed steps
+        for _ in range(ticks):
+            World.store_previous_positions()
+            World.update_sight(player)
+            for ent in entities:
+                ent.update(timestep.TICK_TIME)
+            World.apply_motions()
+            start = frame_timer.mark(frame_timer.ENTITIES_UPDATE, start)
 
-        sound.update_sound_entities(dt)
+            sound.update_sound_entities(timestep.TICK_TIME)
+            start = frame_timer.mark(frame_timer.SOUND_UPDATE, start)
+
+        # Path searches the enemies asked for, as many as fit in the budget
+        ai_scheduler.run()
+        start = frame_timer.mark(frame_timer.AI_JOBS, start)
 
         # Update mouse to be in the center of the window when it's grabbed
         if mouse_grabbed:
@@ -142,13 +218,53 @@ def main():
             for ent in entities:
                 ent.draw_2d(window)
         else:
-            gamemap.render(game_surface, player.pos)
-            
-            # Scale game surface and render
-            window.blit(pygame.transform.scale(game_surface, window.get_rect().size), (0, 0))
+            # Draw the frame between the last two ticks
+            # The mouse look is applied every frame, not only in the ticks
+            alpha = timestep.get_alpha()
+            Camera.look_at(player.angle)
+            snapshot = gamemap.take_snapshot(player.get_interpolated_pos(alpha), alpha)
+            start = frame_timer.mark(frame_timer.SNAPSHOT, start)
+
+            if render_pipeline.ENABLED:
+                # The previous frame was drawn by the render thread while this one was simulated
+                render_time = render_pipeline.wait()
+            else:
+                render_time = 0.0
+
+            # Scale game surface and render (with the post processing)
+            start = time.perf_counter()
+            if render_pipeline.ENABLED:
+                postprocess.present(game_surface, window, gamemap.zbuffer, gamemap.get_row_distances())
+
+            # Follow the resolution picked by the dynamic resolution (the render thread is idle now)
+            resolution = dynamic_resolution.get_resolution()
+            if game_surface.get_size() != resolution:
+                game_surface = create_game_surface(resolution)
+
+            if render_pipeline.ENABLED:
+                render_pipeline.submit(gamemap, game_surface, snapshot)
+            else:
+                render_start = time.perf_counter()
+                gamemap.render_snapshot(game_surface, snapshot)
+                render_time = time.perf_counter() - render_start
+
+                start = time.perf_counter()
+                postprocess.present(game_surface, window, gamemap.zbuffer, gamemap.get_row_distances())
+
+            present_time = time.perf_counter() - start
+            start = frame_timer.mark(frame_timer.SCALE, start)
+
+            dynamic_resolution.update(render_time + present_time)
         
+        start = time.perf_counter()
         pygame.display.flip()
+        start = frame_timer.mark(frame_timer.FLIP, start)
+
+        timestep.limit_frame()
+        frame_timer.mark(frame_timer.FRAME_LIMIT, start)
+        frame_timer.end_frame()
 
+    render_pipeline.stop()
     pygame.quit()
 
 if __name__ == '__main__':
@@ -4,4 +4,7 @@ WIDTH  = 640
 HEIGHT = 384#480
 
 SCREEN_WIDTH  = 1280
-SCREEN_HEIGHT = 768#960
\ No newline at end of file
+SCREEN_HEIGHT = 768#960
+
+# MAP
+TILE_SIZE = 64 # World units per map tile